@@ -1,5 +1,17 @@
 from django.contrib import admin
-from .models import Bookmark, Tag
+from .models import Bookmark, BookmarkImport, BookmarkTombstone, Job, Tag, UserTag
 
-admin.site.register(Bookmark)
+
+
+class BookmarkAdmin(admin.ModelAdmin):
+    # kept by api.signals and the link checker, and tag counts follow tag
+    # changes made here through the m2m_changed receiver
+    readonly_fields = ("seq", "url_hash", "link_status", "link_url", "link_checked")
+
+
+admin.site.register(Bookmark, BookmarkAdmin)
 admin.site.register(Tag)
+admin.site.register(BookmarkImport)
+admin.site.register(BookmarkTombstone)
+admin.site.register(UserTag)
+admin.site.register(Job)
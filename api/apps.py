@@ -1,5 +1,22 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from . import signals
+        # registers the job handlers
+        from . import enrich
+        from .db import configure_sqlite
+        from .search import install_fts
+        from .cache import install_cache_table
+        from .urlnorm import install_url_hashes
+        from .changes import install_seq
+        post_migrate.connect(install_fts, sender=self)
+        post_migrate.connect(install_cache_table, sender=self)
+        post_migrate.connect(install_url_hashes, sender=self)
+        post_migrate.connect(install_seq, sender=self)
+        connection_created.connect(configure_sqlite)
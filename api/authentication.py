@@ -0,0 +1,144 @@
+"""
+token authentication with an in-process cache of token -> user
+
+the Token + User lookup is the most frequent query we run, every bk.py
+request does it. Entries expire after TOKEN_CACHE_TTL seconds and the
+cache holds at most TOKEN_CACHE_SIZE tokens, least recently used go first.
+Rotating or deleting a token and saving or deleting a user drop the
+affected entries right away (see api.signals) and bump the `tokens` change
+counter. Every server process reads that counter at most once every
+TOKEN_CACHE_CHECK seconds and empties its cache when it moved, so the other
+workers stop accepting a revoked token within that time.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+
+class TokenCache(object):
+
+    def __init__(self, maxsize, ttl, check=1):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.check = check
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._next_check = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def sync(self, read_version):
+        """
+        look at the shared version read_version() returns, at most once every
+        `check` seconds. Nothing to look for before anything was cached.
+        """
+        if self._version is None or time.monotonic() < self._next_check:
+            return
+        self.seen(read_version())
+
+    def seen(self, version):
+        """the shared version is at least `version`, empty the cache if it moved"""
+        with self._lock:
+            self._next_check = time.monotonic() + self.check
+            if self._version is not None and version > self._version:
+                self._data.clear()
+            if self._version is None or version > self._version:
+                self._version = version
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, version=None):
+        with self._lock:
+            if version is not None and self._version is not None and version < self._version:
+                # looked up before a change another thread already saw
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_user(self, user_id):
+        with self._lock:
+            for key in [k for k, (_expire, (user, _token)) in self._data.items() if user.pk == user_id]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+            self._version = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "check": self.check,
+            }
+
+
+token_cache = TokenCache(getattr(settings, "TOKEN_CACHE_SIZE", 10000),
+                         getattr(settings, "TOKEN_CACHE_TTL", 60),
+                         getattr(settings, "TOKEN_CACHE_CHECK", 1))
+
+
+def tokens_version():
+    from .models import ChangeCounter
+    return ChangeCounter.get(ChangeCounter.TOKENS)[0]
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+
+    def authenticate_credentials(self, key):
+        token_cache.sync(tokens_version)
+        cached = token_cache.get(key)
+        if cached is None:
+            token = self.lookup(key)
+            version = token.tokens_version or 0
+            token_cache.seen(version)
+            cached = (token.user, token)
+            token_cache.set(key, cached, version)
+        user, token = cached
+        # views may change request.user, never hand out the cached instance
+        return copy.copy(user), token
+
+    def lookup(self, key):
+        """
+        what TokenAuthentication does, with the `tokens` version read in the
+        same query, so filling the cache costs no extra round trip
+        """
+        from .models import ChangeCounter
+        model = self.get_model()
+        version = "SELECT version FROM {} WHERE name = %s".format(ChangeCounter._meta.db_table)
+        try:
+            token = model.objects.select_related("user").extra(
+                select={"tokens_version": version}, select_params=[ChangeCounter.TOKENS]).get(key=key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_("Invalid token."))
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_("User inactive or deleted."))
+        return token
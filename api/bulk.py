@@ -0,0 +1,143 @@
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .enrich import enqueue_enrichment
+from .models import Bookmark, ChangeCounter, Tag
+from .serializers import BookmarkSerializer, get_tag_data
+from .tagcounts import tag_deltas, update_tag_counts
+from .urlnorm import url_hash
+
+
+def save_bookmarks(user, items, overwrite=True):
+    """
+    create or update a list of bookmarks for user in one transaction
+
+    bookmarks are matched on (user, url_hash), so on their canonical url: a
+    known url is updated and gets its tags replaced, or left alone and
+    reported as skipped when overwrite is False. Everything else is created,
+    with `added` taken from the item when it has one. Whatever the size of the
+    list, the writes take a fixed number of statements: one bulk insert and
+    one bulk update for bookmarks, one insert-or-ignore for tags, one delete
+    plus one insert on the bookmark/tag through table, a few for the tag
+    counts and one insert of enrichment jobs for new bookmarks without title.
+
+    returns one result per item, in the order of items
+    """
+    results = [None] * len(items)
+    rows = {}
+    urls = {}
+    hashes = {}
+    firsts = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {"status": "error", "errors": {"non_field_errors": ["expect an object"]}}
+            continue
+        serializer = BookmarkSerializer(data=item)
+        if not serializer.is_valid():
+            results[index] = {"status": "error", "errors": serializer.errors}
+            continue
+        data = serializer.validated_data
+        tags = get_tag_data(item)
+        if not isinstance(tags, list) or any(not isinstance(t, str) or len(t) > 100 for t in tags):
+            results[index] = {"status": "error", "errors": {"tags": ["expect a list of tag names"]}}
+            continue
+        if item.get("added"):
+            try:
+                added = parse_datetime(item["added"])
+            except (TypeError, ValueError):
+                added = None
+            if added:
+                data["added"] = added
+        key = url_hash(data["url"])
+        # the same url twice in one request: the first one creates or
+        # updates the bookmark, the later ones update it again, so the last
+        # one wins, or are skipped like a known url without overwrite
+        if overwrite or key not in rows:
+            rows[key] = (index, data, [t for t in tags if t])
+        firsts.setdefault(key, index)
+        urls[index] = data["url"]
+        hashes[index] = key
+
+    if not rows:
+        return results
+
+    with transaction.atomic():
+        existing = {b.url_hash: b for b in Bookmark.objects.filter(user=user, url_hash__in=list(rows))}
+        skipped = set()
+        if not overwrite:
+            skipped = set(existing)
+            rows_to_save = {key: row for key, row in rows.items() if key not in skipped}
+        else:
+            rows_to_save = rows
+        now = timezone.now()
+        to_create = []
+        to_update = []
+        for key, (index, data, _tags) in rows_to_save.items():
+            bookmark = existing.get(key)
+            if bookmark is None:
+                fields = dict(data)
+                fields.setdefault("added", now)
+                to_create.append(Bookmark(user=user, updated=now, url_hash=key, **fields))
+            else:
+                bookmark.title = data.get("title", "")
+                bookmark.comment = data.get("comment", "")
+                bookmark.updated = now
+                to_update.append(bookmark)
+
+        # bulk writes send no signals, take a range of the change sequence here
+        changed = to_update + to_create
+        if changed:
+            last = ChangeCounter.bump(ChangeCounter.bookmarks(user.id), len(changed))
+            for seq, bookmark in enumerate(changed, last - len(changed) + 1):
+                bookmark.seq = seq
+
+        if to_update:
+            Bookmark.objects.bulk_update(to_update, ["title", "comment", "updated", "seq"])
+        if to_create:
+            Bookmark.objects.bulk_create(to_create)
+            # sqlite does not hand back primary keys from a bulk insert
+            created = Bookmark.objects.filter(user=user, url_hash__in=[b.url_hash for b in to_create])
+            for bookmark in created.only("id", "url_hash"):
+                existing[bookmark.url_hash] = bookmark
+            for bookmark in to_create:
+                bookmark.id = existing[bookmark.url_hash].id
+            enqueue_enrichment(to_create)
+
+        names = {name for _index, _data, tags in rows_to_save.values() for name in tags}
+        if names:
+            Tag.objects.bulk_create([Tag(name=name) for name in names], ignore_conflicts=True)
+
+        through = Bookmark.tags.through
+        removed = []
+        if to_update:
+            old_links = through.objects.filter(bookmark_id__in=[b.id for b in to_update])
+            removed = list(old_links.values_list("tag_id", flat=True))
+            # one DELETE: the m2m_changed receiver keeps Django from fast deleting, counted below
+            old_links._raw_delete(old_links.db)
+        links = [through(bookmark_id=existing[key].id, tag_id=name)
+                 for key, (_index, _data, tags) in rows_to_save.items() for name in set(tags)]
+        if links:
+            through.objects.bulk_create(links)
+        update_tag_counts(user.id, tag_deltas([link.tag_id for link in links], removed))
+
+        if names:
+            ChangeCounter.bump("tags")
+
+    updated = {b.url_hash for b in to_update}
+    for index, url in urls.items():
+        key = hashes[index]
+        if firsts[key] != index:
+            status = "updated" if overwrite else "skipped"
+        elif key in skipped:
+            status = "skipped"
+        elif key in updated:
+            status = "updated"
+        else:
+            status = "created"
+        results[index] = {
+            "status": status,
+            "id": existing[key].id,
+            "url": url,
+        }
+    return results
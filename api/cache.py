@@ -0,0 +1,65 @@
+"""
+server side cache of rendered list responses
+
+entries are keyed by the etag of ConditionalMixin, which already covers the
+user, the full path with its query string, the media type, the scheme and
+host of the absolute next/previous links and the change counter version. Every bookmark or tag change bumps the counter, so a stale
+entry is simply never asked for again and nothing has to be purged, the
+cache timeout only bounds how long unused entries take space.
+
+the backend is a django cache, see RESPONSE_CACHE in settings: local
+memory per process, files or a table in the database shared by all workers.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.http import HttpResponse
+
+
+def response_cache():
+    alias = getattr(settings, "RESPONSE_CACHE", None)
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def cache_key(etag, last_modified):
+    # the counter timestamp guards against a version being reused after
+    # the counter row was reset
+    stamp = last_modified.isoformat() if last_modified else ""
+    return "response:{}:{}".format(etag.strip('"'), stamp)
+
+
+def cacheable(request):
+    # the browsable api embeds a csrf token and the user, json only
+    renderer = getattr(request, "accepted_renderer", None)
+    return request.method == "GET" and renderer is not None and renderer.format == "json"
+
+
+def cached_response(request, etag, last_modified, handler, *args, **kwargs):
+    """
+    answer from the cache, or run the handler and store what it renders
+    """
+    cache = response_cache()
+    if cache is None or not cacheable(request):
+        return handler(request, *args, **kwargs)
+    key = cache_key(etag, last_modified)
+    entry = cache.get(key)
+    if entry is not None:
+        content, content_type = entry
+        return HttpResponse(content, content_type=content_type)
+
+    response = handler(request, *args, **kwargs)
+    if response.status_code == 200 and hasattr(response, "add_post_render_callback"):
+        def store(rendered):
+            cache.set(key, (rendered.content, rendered["Content-Type"]))
+        response.add_post_render_callback(store)
+    return response
+
+
+def install_cache_table(sender, using="default", **kwargs):
+    """
+    post_migrate handler, creates the table of the database cache backend.
+    createcachetable skips tables that exist and other backends.
+    """
+    call_command("createcachetable", database=using, verbosity=0)
@@ -0,0 +1,47 @@
+"""
+the per-user change sequence behind delta sync
+
+every bookmark write takes the next number of the user's ChangeCounter as
+Bookmark.seq, see api.signals. Bookmarks saved before seq existed all have
+the column default 0, which no sync asks for: backfill_seq gives them
+numbers at the end of their user's sequence, oldest change first, so full
+and incremental syncs alike pick them up.
+"""
+import logging
+
+from django.db import connections, transaction
+
+from .models import Bookmark, ChangeCounter
+
+logger = logging.getLogger("booklets.changes")
+
+BATCH_SIZE = 500
+
+
+def backfill_seq(user_ids=None, using="default"):
+    """number the bookmarks with seq 0, of all users or the given ones, returns how many"""
+    bookmarks = Bookmark.objects.using(using).filter(seq=0)
+    if user_ids is None:
+        user_ids = bookmarks.order_by().values_list("user_id", flat=True).distinct()
+    total = 0
+    for user_id in list(user_ids):
+        with transaction.atomic(using=using):
+            ids = list(bookmarks.filter(user_id=user_id).order_by("updated", "id").values_list("id", flat=True))
+            if not ids:
+                continue
+            last = ChangeCounter.bump(ChangeCounter.bookmarks(user_id), len(ids))
+            rows = [Bookmark(id=pk, seq=seq) for seq, pk in enumerate(ids, last - len(ids) + 1)]
+            Bookmark.objects.using(using).bulk_update(rows, ["seq"], batch_size=BATCH_SIZE)
+        total += len(ids)
+    return total
+
+
+def install_seq(sender, using="default", **kwargs):
+    """post_migrate handler, numbers the bookmarks of a database upgraded to delta sync"""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if "api_bookmark" not in connection.introspection.table_names(cursor):
+            return
+    count = backfill_seq(using=using)
+    if count:
+        logger.info("change sequence numbers given to %s bookmarks", count)
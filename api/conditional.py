@@ -0,0 +1,114 @@
+"""
+ETag / Last-Modified support for api views
+
+validators come from ChangeCounter or Bookmark.updated, never from the
+response body, so a matching If-None-Match is answered with a 304 before
+the view runs a query or serializes anything. Writes honour If-Match and
+If-Unmodified-Since and fail with 412 when the resource changed meanwhile.
+
+views with cache_responses set also keep the rendered GET responses under
+the same etag, see api.cache.
+"""
+import hashlib
+
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from .cache import cached_response
+
+
+class ConditionalMixin(object):
+    cache_responses = False
+
+    def get_validators(self, request):
+        """
+        return (etag key, last modified datetime) for the requested resource.
+        None or (None, None), the default, skip conditional handling
+        """
+        return None, None
+
+    def validators(self, request):
+        validators = self.get_validators(request)
+        return None if validators is None or validators == (None, None) else validators
+
+    def get_etag(self, request, key, representation=True):
+        """
+        "<state>.<representation>": the state part covers the validator key,
+        the user and the path, the representation part the query string, the
+        media type and the scheme and host, which the absolute pagination
+        links are made of. Writes only compare the state, see precondition.
+        """
+        state = hashlib.sha1("|".join([str(key), str(request.user.pk), request.path]).encode()).hexdigest()
+        if not representation:
+            return state
+        variant = "|".join([request.META.get("QUERY_STRING", ""), getattr(request, "accepted_media_type", ""),
+                            request.scheme, request.get_host()])
+        return quote_etag("{}.{}".format(state, hashlib.sha1(variant.encode()).hexdigest()[:16]))
+
+    def precondition(self, request, key, timestamp):
+        """
+        412 when If-Match or If-Unmodified-Since of a write fail, else None
+
+        the object is fetched first, so a client that may not touch it gets
+        the 404 or 403 of that instead of learning whether the id exists.
+        If-Match takes the etag of any representation of the current state.
+        """
+        if_match = request.META.get("HTTP_IF_MATCH")
+        if_unmodified_since = request.META.get("HTTP_IF_UNMODIFIED_SINCE")
+        if not if_match and not if_unmodified_since:
+            return None
+        self.get_object()
+        if if_match:
+            state = self.get_etag(request, key, representation=False)
+            etags = parse_etags(if_match)
+            # strong comparison, weak etags never match
+            passes = etags == ["*"] or any(
+                not etag.startswith("W/") and etag.strip('"').partition(".")[0] == state for etag in etags)
+        else:
+            since = parse_http_date_safe(if_unmodified_since)
+            passes = since is None or timestamp is None or timestamp <= since
+        return None if passes else HttpResponse(status=412)
+
+    def conditional(self, handler, request, *args, **kwargs):
+        validators = self.validators(request)
+        if validators is None:
+            return handler(request, *args, **kwargs)
+        key, last_modified = validators
+        etag = self.get_etag(request, key)
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+        if request.method in ("GET", "HEAD"):
+            response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+            if response is None and self.cache_responses:
+                response = cached_response(request, etag, last_modified, handler, *args, **kwargs)
+            elif response is None:
+                response = handler(request, *args, **kwargs)
+        else:
+            response = self.precondition(request, key, timestamp)
+            if response is None:
+                response = handler(request, *args, **kwargs)
+                if 200 <= response.status_code < 300:
+                    validators = self.validators(request)
+                    etag = self.get_etag(request, validators[0]) if validators else None
+                    last_modified = validators[1] if validators else None
+        if etag and response.status_code in (200, 304):
+            response["ETag"] = etag
+            if last_modified:
+                response["Last-Modified"] = http_date(last_modified.timestamp())
+        patch_vary_headers(response, ("Accept", "Authorization"))
+        return response
+
+    def get(self, request, *args, **kwargs):
+        return self.conditional(super(ConditionalMixin, self).get, request, *args, **kwargs)
+
+
+class ConditionalWriteMixin(ConditionalMixin):
+
+    def put(self, request, *args, **kwargs):
+        return self.conditional(super(ConditionalWriteMixin, self).put, request, *args, **kwargs)
+
+    def patch(self, request, *args, **kwargs):
+        return self.conditional(super(ConditionalWriteMixin, self).patch, request, *args, **kwargs)
+
+    def delete(self, request, *args, **kwargs):
+        return self.conditional(super(ConditionalWriteMixin, self).delete, request, *args, **kwargs)
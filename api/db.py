@@ -0,0 +1,23 @@
+"""
+sqlite connection tuning
+
+settings.SQLITE_PRAGMAS is applied to every new sqlite connection through
+the connection_created signal. The production profile in settings turns on
+WAL, so readers no longer wait for writers, and gives writers a busy
+timeout instead of failing with "database is locked".
+"""
+
+
+def apply_pragmas(cursor, pragmas):
+    for name, value in pragmas.items():
+        cursor.execute("PRAGMA {} = {}".format(name, value))
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    from django.conf import settings
+
+    pragmas = getattr(settings, "SQLITE_PRAGMAS", None)
+    if connection.vendor != "sqlite" or not pragmas:
+        return
+    with connection.cursor() as cursor:
+        apply_pragmas(cursor, pragmas)
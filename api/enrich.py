@@ -0,0 +1,112 @@
+"""
+fill in what a client left out of a bookmark from the page it points to
+
+bookmarks saved without a title get an enrich_bookmark job in the same
+transaction, a worker fetches the page later and takes its <title>. The
+request that saved the bookmark never waits for the remote site.
+"""
+import re
+from html.parser import HTMLParser
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import Request
+
+from django.db import transaction
+
+from .fetch import BlockedAddress, opener
+from .jobs import PermanentError, enqueue, handler
+from .models import Bookmark
+
+ENRICH_BOOKMARK = "enrich_bookmark"
+USER_AGENT = "booklets-enrich/1.0"
+FETCH_TIMEOUT = 10
+# the title is in the head, no need for the whole page
+MAX_BYTES = 256 * 1024
+
+
+class TitleParser(HTMLParser):
+    """the text of the first <title>"""
+
+    def __init__(self):
+        super(TitleParser, self).__init__(convert_charrefs=True)
+        self.parts = None
+        self.title = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title" and self.title is None:
+            self.parts = []
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self.parts is not None and self.title is None:
+            self.title = "".join(self.parts)
+            self.parts = None
+
+    def handle_data(self, data):
+        if self.parts is not None:
+            self.parts.append(data)
+
+
+def page_title(html):
+    parser = TitleParser()
+    parser.feed(html)
+    title = parser.title if parser.title is not None else "".join(parser.parts or [])
+    return re.sub(r"\s+", " ", title).strip()[:1000]
+
+
+def fetch_title(url, timeout=FETCH_TIMEOUT):
+    """
+    title of the html page at url, "" when it has none. Answers that will
+    not change by asking again raise PermanentError, others are left to
+    raise and the job is tried again later. Pages on private addresses are
+    not fetched, see api.fetch.
+    """
+    request = Request(url, headers={"User-Agent": USER_AGENT, "Accept": "text/html"})
+    try:
+        with opener().open(request, timeout=timeout) as response:
+            if response.headers.get_content_type() not in ("text/html", "application/xhtml+xml"):
+                return ""
+            body = response.read(MAX_BYTES)
+            charset = response.headers.get_content_charset() or "utf-8"
+    except HTTPError as e:
+        e.close()
+        if 400 <= e.code < 500 and e.code not in (408, 429):
+            raise PermanentError("{} answered {}".format(url, e.code))
+        raise
+    except URLError as e:
+        if isinstance(e.reason, BlockedAddress):
+            raise PermanentError(str(e.reason))
+        raise
+    try:
+        html = body.decode(charset, "replace")
+    except LookupError:
+        html = body.decode("utf-8", "replace")
+    return page_title(html)
+
+
+def wants_enrichment(bookmark):
+    return not bookmark.title and urlsplit(bookmark.url).scheme in ("http", "https")
+
+
+def enqueue_enrichment(bookmarks):
+    """queue enrich_bookmark jobs for those of the saved bookmarks that need one"""
+    ids = [bookmark.id for bookmark in bookmarks if wants_enrichment(bookmark)]
+    if ids:
+        enqueue(ENRICH_BOOKMARK, [{"bookmark_id": pk} for pk in ids])
+
+
+@handler(ENRICH_BOOKMARK)
+def enrich_bookmark(bookmark_id):
+    bookmark = Bookmark.objects.filter(id=bookmark_id).only("url", "title").first()
+    if bookmark is None or not wants_enrichment(bookmark):
+        # deleted or given a title in the meantime
+        return
+    title = fetch_title(bookmark.url)
+    if not title:
+        return
+    with transaction.atomic():
+        bookmark = Bookmark.objects.filter(id=bookmark_id).first()
+        if bookmark is None or bookmark.title:
+            return
+        bookmark.title = title
+        # a normal save, so the change sequence and cached lists see the new title
+        bookmark.save(update_fields=["title", "updated", "seq"])
@@ -0,0 +1,94 @@
+"""
+stream a user's bookmarks out as ndjson, csv or netscape bookmark html
+
+rows are read in keyset chunks and the tags of a chunk are fetched with one
+query, so memory use does not depend on how many bookmarks there are.
+"""
+import csv
+import json
+from html import escape
+
+from rest_framework.fields import DateTimeField
+
+from .models import Bookmark
+
+CHUNK_SIZE = 500
+FIELDS = ("id", "title", "url", "comment", "tags", "added", "updated")
+
+
+def iter_bookmarks(user, chunk_size=CHUNK_SIZE):
+    """yield bookmarks of user as dicts, in id order"""
+    through = Bookmark.tags.through
+    last = 0
+    while True:
+        rows = list(Bookmark.objects.filter(user=user, id__gt=last).order_by("id")
+                    .values("id", "title", "url", "comment", "added", "updated")[:chunk_size])
+        if not rows:
+            return
+        tags = {}
+        links = (through.objects.filter(bookmark_id__in=[r["id"] for r in rows])
+                 .order_by("tag_id").values_list("bookmark_id", "tag_id"))
+        for bookmark_id, tag in links:
+            tags.setdefault(bookmark_id, []).append(tag)
+        for row in rows:
+            row["tags"] = tags.get(row["id"], [])
+            yield row
+        last = rows[-1]["id"]
+
+
+def to_ndjson(bookmarks, username):
+    datetime = DateTimeField()
+    for row in bookmarks:
+        row["added"] = datetime.to_representation(row["added"])
+        row["updated"] = datetime.to_representation(row["updated"])
+        row["user"] = username
+        yield json.dumps(row) + "\n"
+
+
+class Echo(object):
+    """file-like object for csv.writer, hands back what is written"""
+
+    def write(self, value):
+        return value
+
+
+def to_csv(bookmarks, username):
+    datetime = DateTimeField()
+    writer = csv.writer(Echo())
+    yield writer.writerow(FIELDS)
+    for row in bookmarks:
+        yield writer.writerow([
+            row["id"], row["title"], row["url"], row["comment"], ",".join(row["tags"]),
+            datetime.to_representation(row["added"]), datetime.to_representation(row["updated"])
+        ])
+
+
+NETSCAPE_HEADER = """<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<!-- This is an automatically generated file.
+     It will be read and overwritten.
+     DO NOT EDIT! -->
+<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">
+<TITLE>Bookmarks</TITLE>
+<H1>Bookmarks</H1>
+<DL><p>
+"""
+
+
+def to_html(bookmarks, username):
+    """netscape bookmark file, the format browsers import and export"""
+    yield NETSCAPE_HEADER
+    for row in bookmarks:
+        line = '    <DT><A HREF="{}" ADD_DATE="{}" LAST_MODIFIED="{}" TAGS="{}">{}</A>\n'.format(
+            escape(row["url"]), int(row["added"].timestamp()), int(row["updated"].timestamp()),
+            escape(",".join(row["tags"])), escape(row["title"] or row["url"]))
+        if row["comment"]:
+            line += "    <DD>{}\n".format(escape(row["comment"]))
+        yield line
+    yield "</DL><p>\n"
+
+
+FORMATS = {
+    "ndjson": (to_ndjson, "application/x-ndjson"),
+    "csv": (to_csv, "text/csv"),
+    "html": (to_html, "text/html"),
+}
@@ -0,0 +1,94 @@
+"""
+http requests to the urls users bookmarked
+
+a bookmark can point anywhere, including the network the server sits in:
+http://127.0.0.1:8080/, http://169.254.169.254/ (cloud metadata),
+http://192.168.1.1/. The link checker and the title fetcher open urls
+through opener(), whose connections resolve the host themselves and refuse
+any address that is not globally routable before connecting. Redirects open
+a new connection, so every hop is checked, and the address checked is the
+one connected to, so a host resolving differently the second time gains
+nothing. FETCH_PRIVATE_ADDRESSES turns the check off, for a server that is
+meant to check links on its own network.
+"""
+import http.client
+import ipaddress
+import socket
+from urllib.request import HTTPHandler, HTTPSHandler, build_opener
+
+from django.conf import settings
+
+
+class BlockedAddress(OSError):
+    """
+    the host resolves to an address we do not fetch from. urllib hands it
+    on as the reason of a URLError.
+    """
+
+    def __init__(self, host, address):
+        super(BlockedAddress, self).__init__("{} resolves to {}, a private address".format(host, address))
+        self.host = host
+        self.address = address
+
+
+def public(address):
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """socket.create_connection to the checked addresses of host"""
+    if getattr(settings, "FETCH_PRIVATE_ADDRESSES", False):
+        return socket.create_connection(address, timeout, source_address)
+    host, port = address
+    infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    for _family, _type, _proto, _name, sockaddr in infos:
+        if not public(sockaddr[0]):
+            raise BlockedAddress(host, sockaddr[0])
+    error = None
+    for family, type_, proto, _name, sockaddr in infos:
+        sock = socket.socket(family, type_, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            error = e
+            sock.close()
+    raise error or OSError("getaddrinfo returned nothing for {}".format(host))
+
+
+class CheckedHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, *args, **kwargs):
+        super(CheckedHTTPConnection, self).__init__(*args, **kwargs)
+        self._create_connection = create_connection
+
+
+class CheckedHTTPSConnection(http.client.HTTPSConnection):
+
+    def __init__(self, *args, **kwargs):
+        super(CheckedHTTPSConnection, self).__init__(*args, **kwargs)
+        self._create_connection = create_connection
+
+
+class CheckedHTTPHandler(HTTPHandler):
+
+    def http_open(self, req):
+        return self.do_open(CheckedHTTPConnection, req)
+
+
+class CheckedHTTPSHandler(HTTPSHandler):
+
+    def https_open(self, req):
+        return self.do_open(CheckedHTTPSConnection, req, context=self._context)
+
+
+def opener(*handlers):
+    """build_opener with connections that refuse private addresses"""
+    return build_opener(CheckedHTTPHandler(), CheckedHTTPSHandler(), *handlers)
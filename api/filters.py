@@ -0,0 +1,49 @@
+from django.db.models import Count
+
+from .models import Bookmark
+
+
+def split_tags(params, key):
+    """collect tag names from a query param, supports both `a,b` and repeated keys"""
+    names = []
+    for value in params.getlist(key, []):
+        for name in value.split(","):
+            name = name.strip()
+            if name and name not in names:
+                names.append(name)
+    return names
+
+
+def filter_by_tags(queryset, params):
+    """
+    filter bookmarks by tags
+
+    - tag=a / tags=a,b: bookmark has all of the tags
+    - any=c,d: bookmark has at least one of the tags
+    - exclude=e: bookmark has none of the tags
+
+    every condition becomes a subquery on the bookmark/tag through table, so
+    the whole filter still runs as a single SQL statement
+    """
+    through = Bookmark.tags.through
+    all_tags = split_tags(params, "tag")
+    for name in split_tags(params, "tags"):
+        if name not in all_tags:
+            all_tags.append(name)
+    any_tags = split_tags(params, "any")
+    exclude_tags = split_tags(params, "exclude")
+
+    if all_tags:
+        matched = (through.objects.filter(tag_id__in=all_tags)
+                   .values("bookmark_id")
+                   .annotate(n=Count("tag_id"))
+                   .filter(n=len(all_tags))
+                   .values("bookmark_id"))
+        queryset = queryset.filter(id__in=matched)
+    if any_tags:
+        queryset = queryset.filter(
+            id__in=through.objects.filter(tag_id__in=any_tags).values("bookmark_id"))
+    if exclude_tags:
+        queryset = queryset.exclude(
+            id__in=through.objects.filter(tag_id__in=exclude_tags).values("bookmark_id"))
+    return queryset
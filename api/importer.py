@@ -0,0 +1,199 @@
+"""
+import bookmarks from netscape bookmark html (what browsers export), ndjson
+or csv
+
+files are parsed as a stream and written in fixed size batches through
+save_bookmarks. The number of entries committed is saved with every batch,
+in the same transaction, so running the same file again continues after the
+last committed batch.
+"""
+import csv
+import hashlib
+import io
+import json
+import time
+from datetime import datetime, timezone
+from html.parser import HTMLParser
+
+from django.db import transaction
+
+from .bulk import save_bookmarks
+from .models import BookmarkImport
+
+BATCH_SIZE = 1000
+READ_SIZE = 64 * 1024
+EXTENSIONS = {
+    ".html": "html",
+    ".htm": "html",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".json": "ndjson",
+    ".csv": "csv",
+}
+
+
+def guess_format(fname):
+    for ext, fmt in EXTENSIONS.items():
+        if fname.lower().endswith(ext):
+            return fmt
+    return None
+
+
+def split_tags(value):
+    return [t.strip() for t in (value or "").split(",") if t.strip()]
+
+
+class NetscapeParser(HTMLParser):
+    """
+    collect <A> entries of a netscape bookmark file, with the <DD> text
+    that follows an entry as its comment
+    """
+
+    def __init__(self):
+        super(NetscapeParser, self).__init__(convert_charrefs=True)
+        self.items = []
+        self.text = None
+        self.in_comment = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            attrs = dict(attrs)
+            item = {"url": attrs.get("href") or "", "title": "", "comment": "",
+                    "tags": split_tags(attrs.get("tags"))}
+            if (attrs.get("add_date") or "").isdigit():
+                added = datetime.fromtimestamp(int(attrs["add_date"]), tz=timezone.utc)
+                item["added"] = added.isoformat()
+            self.items.append(item)
+            self.text = []
+            self.in_comment = False
+        elif tag == "dd" and self.items:
+            self.text = []
+            self.in_comment = True
+        elif tag in ("dt", "dl", "h3"):
+            self.finish_text()
+
+    def handle_endtag(self, tag):
+        if tag in ("a", "dl"):
+            self.finish_text()
+
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def finish_text(self):
+        if self.text is None:
+            return
+        text = "".join(self.text).strip()
+        if self.in_comment:
+            self.items[-1]["comment"] = text
+        else:
+            self.items[-1]["title"] = text
+        self.text = None
+        self.in_comment = False
+
+
+def parse_html(stream):
+    parser = NetscapeParser()
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        # the last entry may still get its title or comment from the next chunk
+        done, parser.items = parser.items[:-1], parser.items[-1:]
+        for item in done:
+            yield item
+    parser.close()
+    parser.finish_text()
+    for item in parser.items:
+        yield item
+
+
+def parse_ndjson(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            # keep the position, save_bookmarks reports it as failed
+            item = None
+        yield item
+
+
+def parse_csv(stream):
+    for row in csv.DictReader(stream):
+        item = {"url": row.get("url") or "", "title": row.get("title") or "",
+                "comment": row.get("comment") or "", "tags": split_tags(row.get("tags"))}
+        if row.get("added"):
+            item["added"] = row["added"]
+        yield item
+
+
+PARSERS = {
+    "html": parse_html,
+    "ndjson": parse_ndjson,
+    "csv": parse_csv,
+}
+
+
+def file_digest(fileobj):
+    """sha256 of a binary file object, leaves it rewound"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(READ_SIZE), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def import_bookmarks(user, fileobj, fmt, batch_size=BATCH_SIZE, progress=None, limit=None):
+    """
+    import a binary file object of format fmt for user
+
+    progress is called after every committed batch with the import record,
+    the size of the batch and the seconds it took. At most limit entries are
+    committed, the record is left unfinished when more are left and the next
+    run on the same file continues there. Returns the import record.
+    """
+    job, _ = BookmarkImport.objects.get_or_create(user=user, digest=file_digest(fileobj),
+                                                  defaults={"format": fmt})
+    if job.finished:
+        return job
+
+    stream = io.TextIOWrapper(fileobj, encoding="utf-8", errors="replace", newline="")
+    # entries before this were committed by an earlier run
+    position = 0
+    taken = 0
+    batch = []
+    for item in PARSERS[fmt](stream):
+        position += 1
+        if position <= job.committed:
+            continue
+        if limit is not None and taken >= limit:
+            commit_batch(job, batch, progress)
+            break
+        batch.append(item)
+        taken += 1
+        if len(batch) >= batch_size:
+            commit_batch(job, batch, progress)
+            batch = []
+    else:
+        commit_batch(job, batch, progress, finished=True)
+    stream.detach()
+    return job
+
+
+def commit_batch(job, batch, progress, finished=False):
+    start = time.perf_counter()
+    with transaction.atomic():
+        results = save_bookmarks(job.user, batch, overwrite=False) if batch else []
+        statuses = [r["status"] for r in results]
+        job.committed += len(batch)
+        job.created += statuses.count("created")
+        job.skipped += statuses.count("skipped")
+        job.failed += statuses.count("error")
+        job.finished = finished
+        job.save()
+    if progress is not None and batch:
+        progress(job, len(batch), time.perf_counter() - start)
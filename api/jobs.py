@@ -0,0 +1,172 @@
+"""
+a small job queue in the database, run by `manage.py worker`
+
+enqueue() adds jobs in the caller's transaction, so a job exists exactly
+when the write that asked for it was committed. A worker
+
+- claims a batch of due jobs with one UPDATE: queued jobs whose run_after
+  has passed and running jobs whose lease ran out, their worker died. They
+  get the worker's claim token and a lease. The due conditions are in the
+  UPDATE itself, so two workers racing for a job can not both get it.
+- runs the handler registered for the job kind, with the json payload as
+  keyword arguments, and deletes the job when it returns
+- queues a job that raised again after an exponential backoff, until it
+  used up max_attempts; then, or when it raised PermanentError, the job is
+  kept as failed with its last error
+
+every write after the claim is conditional on the claim token: a worker that
+outlived its lease lost the job to another one and must not touch it.
+"""
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.db import close_old_connections, connection
+from django.db.models import F, Q, Subquery
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger("booklets.jobs")
+
+HANDLERS = {}
+BATCH_SIZE = 10
+LEASE = 60
+BACKOFF_BASE = 30
+BACKOFF_MAX = 6 * 3600
+
+
+class PermanentError(Exception):
+    """raised by a handler when trying again can not help"""
+
+
+def handler(kind):
+    """register the decorated function as the handler of jobs of kind"""
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind, payloads, delay=0, max_attempts=5):
+    """add a job of kind for each payload dict, with one insert"""
+    run_after = timezone.now() + timedelta(seconds=delay)
+    Job.objects.bulk_create([Job(kind=kind, payload=json.dumps(payload), run_after=run_after,
+                                 max_attempts=max_attempts) for payload in payloads])
+
+
+def backoff(attempts):
+    """seconds before the next try after attempts failed ones, with some jitter"""
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX) * random.uniform(1, 1.2)
+
+
+def due(now):
+    return Q(state=Job.QUEUED, run_after__lte=now) | Q(state=Job.RUNNING, lease_until__lt=now)
+
+
+def claim(batch=BATCH_SIZE, lease=LEASE):
+    """take up to batch due jobs, oldest first, and return them"""
+    now = timezone.now()
+    token = uuid.uuid4().hex
+    oldest = Job.objects.filter(due(now)).order_by("run_after", "id").values("id")[:batch]
+    claimed = Job.objects.filter(due(now), id__in=Subquery(oldest)).update(
+        state=Job.RUNNING, claim=token, lease_until=now + timedelta(seconds=lease), attempts=F("attempts") + 1)
+    if not claimed:
+        return []
+    return list(Job.objects.filter(claim=token).order_by("run_after", "id"))
+
+
+def extend(token, lease=LEASE):
+    """renew the lease of the jobs of a claim still running"""
+    Job.objects.filter(claim=token, state=Job.RUNNING).update(
+        lease_until=timezone.now() + timedelta(seconds=lease))
+
+
+def release(jobs):
+    """give the jobs of a claim back without counting the attempt, for a worker that stops"""
+    if jobs:
+        Job.objects.filter(id__in=[job.id for job in jobs], claim=jobs[0].claim, state=Job.RUNNING).update(
+            state=Job.QUEUED, claim="", lease_until=None, attempts=F("attempts") - 1)
+
+
+def finish(job):
+    if not Job.objects.filter(id=job.id, claim=job.claim).delete()[0]:
+        logger.warning("job %s finished after its lease ran out, it ran twice", job.id)
+
+
+def fail(job, exc):
+    error = "{}: {}".format(exc.__class__.__name__, exc)
+    if isinstance(exc, PermanentError) or job.attempts >= job.max_attempts:
+        logger.error("job %s (%s) failed: %s", job.id, job.kind, error)
+        changes = dict(state=Job.FAILED, lease_until=None)
+    else:
+        delay = backoff(job.attempts)
+        logger.warning("job %s (%s) failed, try %s again in %.0f s: %s", job.id, job.kind, job.attempts,
+                       delay, error)
+        changes = dict(state=Job.QUEUED, run_after=timezone.now() + timedelta(seconds=delay), lease_until=None)
+    Job.objects.filter(id=job.id, claim=job.claim).update(claim="", last_error=error[:10000], **changes)
+
+
+def run_job(job):
+    """run a claimed job, True when it succeeded"""
+    try:
+        if job.attempts > job.max_attempts:
+            # the lease ran out on every try, its worker died each time
+            raise PermanentError("gave up after {} attempts".format(job.max_attempts))
+        func = HANDLERS.get(job.kind)
+        if func is None:
+            raise PermanentError("no handler for jobs of kind {}".format(job.kind))
+        func(**json.loads(job.payload))
+    except Exception as e:
+        fail(job, e)
+        return False
+    finish(job)
+    return True
+
+
+class Worker(object):
+    """claim and run jobs until stop() is called"""
+
+    def __init__(self, batch=BATCH_SIZE, lease=LEASE, poll=1.0):
+        self.batch = batch
+        self.lease = lease
+        self.poll = poll
+        self.stopping = threading.Event()
+        self.done = self.failed = 0
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def run_batch(self):
+        """run one claimed batch, returns the number of jobs claimed"""
+        jobs = claim(self.batch, self.lease)
+        for index, job in enumerate(jobs):
+            if self.stopping.is_set():
+                release(jobs[index:])
+                break
+            if index:
+                extend(job.claim, self.lease)
+            start = time.perf_counter()
+            ok = run_job(job)
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+            logger.debug("job %s (%s) %s in %.3f s", job.id, job.kind, "done" if ok else "failed",
+                         time.perf_counter() - start)
+        return len(jobs)
+
+    def run(self, once=False):
+        """run jobs, with once stop when none is due instead of waiting for more"""
+        while not self.stopping.is_set():
+            if not connection.in_atomic_block:
+                # a worker lives long, drop connections that broke or outlived CONN_MAX_AGE
+                close_old_connections()
+            if not self.run_batch():
+                if once:
+                    break
+                self.stopping.wait(self.poll)
@@ -0,0 +1,211 @@
+"""
+find dead bookmark links
+
+bookmarks are read in id order, in batches, and probed concurrently on an
+asyncio loop: at most `concurrency` requests in flight, at most `per_host`
+to one host and `delay` seconds between the starts of two requests to the
+same host. A url is asked with HEAD first and with GET when HEAD fails or is
+refused, many servers answer HEAD with 403, 404 or 405.
+
+the requests themselves are made with urllib on a thread pool, the loop only
+schedules them, so there is no dependency on an async http client. The
+outcome is saved on the bookmark without touching `updated` or the change
+sequence: link_status is the final http status, 0 when there was no answer
+at all, link_url where redirects ended and link_checked when. A run only
+checks bookmarks never checked or checked longer than max_age ago. Links
+to private addresses are not followed, see api.fetch.
+"""
+import asyncio
+import socket
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import HTTPRedirectHandler, Request
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .fetch import opener
+from .models import Bookmark
+
+USER_AGENT = "booklets-linkcheck/1.0"
+BATCH_SIZE = 500
+# answers to HEAD that say nothing about GET
+HEAD_REFUSED = {400, 403, 404, 405, 406, 429, 500, 501, 502, 503}
+
+LinkResult = namedtuple("LinkResult", "status url error")
+
+
+class KeepMethodRedirectHandler(HTTPRedirectHandler):
+    # urllib turns every redirect into a GET, a HEAD should stay a HEAD
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if new is not None and req.get_method() == "HEAD":
+            new.method = "HEAD"
+        return new
+
+
+def probe(opener, url, method, timeout):
+    """(status, final url) of one request, blocking. The body is not read"""
+    request = Request(url, method=method, headers={"User-Agent": USER_AGENT})
+    try:
+        with opener.open(request, timeout=timeout) as response:
+            return response.status, response.geturl()
+    except HTTPError as e:
+        e.close()
+        return e.code, e.geturl()
+
+
+def timed_out(exc):
+    # a connect timeout comes wrapped in a URLError, a read timeout is not
+    if isinstance(exc, URLError):
+        exc = exc.reason
+    return isinstance(exc, (asyncio.TimeoutError, socket.timeout))
+
+
+def error_text(exc):
+    if timed_out(exc):
+        return "timeout"
+    if isinstance(exc, URLError):
+        exc = exc.reason
+    return str(exc) or exc.__class__.__name__
+
+
+class Host(object):
+    """the requests in flight to one host and when the next may start"""
+
+    def __init__(self, per_host):
+        self.slots = asyncio.Semaphore(per_host)
+        self.lock = asyncio.Lock()
+        self.next_start = 0.0
+
+
+class LinkChecker(object):
+
+    def __init__(self, concurrency=20, per_host=2, delay=1.0, timeout=10.0):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.delay = delay
+        self.timeout = timeout
+        self.opener = opener(KeepMethodRedirectHandler())
+        self.hosts = {}
+
+    async def wait_turn(self, host):
+        async with host.lock:
+            now = time.monotonic()
+            if host.next_start > now:
+                await asyncio.sleep(host.next_start - now)
+            host.next_start = time.monotonic() + self.delay
+
+    async def request(self, url, method):
+        host = self.hosts.setdefault(urlsplit(url).hostname, Host(self.per_host))
+        async with host.slots:
+            await self.wait_turn(host)
+            async with self.slots:
+                loop = asyncio.get_event_loop()
+                call = loop.run_in_executor(self.executor, probe, self.opener, url, method, self.timeout)
+                # the socket timeout is per read, this one bounds the whole request
+                return await asyncio.wait_for(call, self.timeout * 2)
+
+    async def check(self, url):
+        """LinkResult of url, HEAD first and GET when HEAD gets no usable answer"""
+        try:
+            if urlsplit(url).scheme not in ("http", "https"):
+                return LinkResult(0, "", "not a http url")
+        except ValueError as e:
+            return LinkResult(0, "", str(e))
+        result = None
+        for method in ("HEAD", "GET"):
+            try:
+                status, final = await self.request(url, method)
+            except (asyncio.TimeoutError, OSError, ValueError) as e:
+                # URLError is an OSError, http.client errors too
+                result = LinkResult(0, "", error_text(e))
+                if timed_out(e):
+                    # a server too slow for HEAD will not be faster on GET
+                    break
+                continue
+            result = LinkResult(status, final, "")
+            if status not in HEAD_REFUSED:
+                break
+        return result
+
+    async def run(self, batches, save):
+        """
+        check the (id, url) rows of each batch, save(results) is called with
+        a list of (id, url, LinkResult) after each batch. batches and save are
+        called on the loop thread, they may use the ORM.
+        """
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.hosts = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as self.executor:
+            for batch in batches:
+                results = await asyncio.gather(*(self.check(url) for _pk, url in batch))
+                save([(pk, url, result) for (pk, url), result in zip(batch, results)])
+
+    def check_all(self, batches, save):
+        # asyncio.run by hand, it is python 3.7+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.run(batches, save))
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+def stale_bookmarks(user=None, max_age=timedelta(days=7), limit=None, batch_size=BATCH_SIZE):
+    """
+    (id, url) of the bookmarks due for a check, in batches by id. Keyset
+    pagination on id, so bookmarks saved as checked in between do not shift
+    the batches.
+    """
+    queryset = Bookmark.objects.all()
+    if user is not None:
+        queryset = queryset.filter(user=user)
+    if max_age is not None:
+        queryset = queryset.filter(Q(link_checked__isnull=True) | Q(link_checked__lt=timezone.now() - max_age))
+    last_id = 0
+    while limit is None or limit > 0:
+        size = batch_size if limit is None else min(batch_size, limit)
+        batch = list(queryset.filter(id__gt=last_id).order_by("id").values_list("id", "url")[:size])
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1][0]
+        if limit is not None:
+            limit -= len(batch)
+
+
+def save_results(results):
+    """store the outcome of a batch of checks, with bulk_update: no signals, no auto_now"""
+    now = timezone.now()
+    bookmarks = [Bookmark(id=pk, link_status=result.status, link_url=result.url[:1000], link_checked=now)
+                 for pk, _url, result in results]
+    Bookmark.objects.bulk_update(bookmarks, ["link_status", "link_url", "link_checked"])
+
+
+def check_links(user=None, max_age=timedelta(days=7), limit=None, batch_size=BATCH_SIZE, progress=None,
+                **options):
+    """
+    check the stale bookmarks of user, or of everyone, and save the results.
+    options go to LinkChecker. progress(results) is called after every batch.
+    Returns the number of bookmarks checked.
+    """
+    checked = [0]
+
+    def save(results):
+        save_results(results)
+        checked[0] += len(results)
+        if progress is not None:
+            progress(results)
+
+    LinkChecker(**options).check_all(stale_bookmarks(user, max_age, limit, batch_size), save)
+    return checked[0]
+
+
+def broken(status):
+    return status is not None and (status == 0 or status >= 400)
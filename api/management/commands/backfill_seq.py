@@ -0,0 +1,19 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from api.changes import backfill_seq
+
+
+class Command(BaseCommand):
+    help = ("Give bookmarks saved before delta sync existed a place in their user's change sequence, "
+            "so /api/bookmarks/changes/ returns them. migrate runs it too.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", nargs="*", help="only these users, all users by default")
+
+    def handle(self, *args, **options):
+        user_ids = None
+        if options["username"]:
+            user_ids = list(User.objects.filter(username__in=options["username"]).values_list("id", flat=True))
+        count = backfill_seq(user_ids)
+        self.stdout.write(self.style.SUCCESS("{} bookmarks numbered".format(count)))
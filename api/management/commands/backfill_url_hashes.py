@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from api.urlnorm import backfill_url_hashes
+
+
+class Command(BaseCommand):
+    help = ("Set the canonical url hash on bookmarks saved before it existed. migrate runs it too, "
+            "bookmarks that turn out to duplicate another one of the same user are merged into it.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        hashed, merged = backfill_url_hashes(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS("{} bookmarks hashed, {} duplicates merged".format(hashed, merged)))
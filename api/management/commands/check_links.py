@@ -0,0 +1,58 @@
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from api.linkcheck import BATCH_SIZE, broken, check_links
+
+
+class Command(BaseCommand):
+    help = ("Check bookmark links and save their http status, where redirects end and when they were checked. "
+            "Only bookmarks not checked for --max-age days are checked, so it can run from cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", nargs="?", help="the user whose bookmarks to check, everyone by default")
+        parser.add_argument("--max-age", type=float, default=7, help="days before a link is checked again")
+        parser.add_argument("--all", action="store_true", help="check every link, however recently checked")
+        parser.add_argument("--limit", type=int, help="check at most this many links")
+        parser.add_argument("--concurrency", type=int, default=20, help="requests in flight")
+        parser.add_argument("--per-host", type=int, default=2, help="requests in flight to one host")
+        parser.add_argument("--delay", type=float, default=1.0,
+                            help="seconds between the starts of two requests to one host")
+        parser.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for an answer")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        user = None
+        if options["username"]:
+            try:
+                user = User.objects.get(username=options["username"])
+            except User.DoesNotExist:
+                raise CommandError("user {} does not exist".format(options["username"]))
+        if options["concurrency"] < 1 or options["per_host"] < 1:
+            raise CommandError("--concurrency and --per-host must be at least 1")
+
+        start = time.perf_counter()
+        counts = {"ok": 0, "broken": 0}
+
+        def progress(results):
+            for _pk, url, result in results:
+                counts["broken" if broken(result.status) else "ok"] += 1
+                if broken(result.status) and options["verbosity"] > 1:
+                    self.stdout.write("  {} {}".format(result.status or result.error, url))
+            self.stdout.write("{ok} ok, {broken} broken, {rate:.1f} links/s".format(
+                rate=(counts["ok"] + counts["broken"]) / (time.perf_counter() - start), **counts))
+
+        checked = check_links(
+            user,
+            max_age=None if options["all"] else timedelta(days=options["max_age"]),
+            limit=options["limit"],
+            batch_size=options["batch_size"],
+            progress=progress,
+            concurrency=options["concurrency"],
+            per_host=options["per_host"],
+            delay=options["delay"],
+            timeout=options["timeout"],
+        )
+        self.stdout.write(self.style.SUCCESS("{} links checked, {} broken".format(checked, counts["broken"])))
@@ -0,0 +1,39 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from api.importer import BATCH_SIZE, PARSERS, guess_format, import_bookmarks
+
+
+class Command(BaseCommand):
+    help = ("Import bookmarks from a netscape bookmark html (browser export), ndjson or csv file. "
+            "Running it again on the same file continues after the last committed batch.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("file")
+        parser.add_argument("--format", choices=sorted(PARSERS), help="guessed from the file name by default")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist:
+            raise CommandError("user {} does not exist".format(options["username"]))
+        fmt = options["format"] or guess_format(options["file"])
+        if fmt is None:
+            raise CommandError("can not guess the format of {}, use --format".format(options["file"]))
+
+        start = time.perf_counter()
+        done = [0]
+
+        def progress(job, count, seconds):
+            done[0] += count
+            self.stdout.write("{} entries committed, {} created, {} skipped, {} failed, {:.0f} entries/s".format(
+                job.committed, job.created, job.skipped, job.failed, done[0] / (time.perf_counter() - start)))
+
+        with open(options["file"], "rb") as fh:
+            job = import_bookmarks(user, fh, fmt, batch_size=options["batch_size"], progress=progress)
+        self.stdout.write(self.style.SUCCESS("import finished: {} entries, {} created, {} skipped, {} failed".format(
+            job.committed, job.created, job.skipped, job.failed)))
@@ -0,0 +1,19 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from api.tagcounts import rebuild_tag_counts
+
+
+class Command(BaseCommand):
+    help = ("Recount the per-user tag counts from the bookmarks. Run it once after upgrading "
+            "an existing database, the counts are maintained on every write afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", nargs="*", help="only these users, all users by default")
+
+    def handle(self, *args, **options):
+        user_ids = None
+        if options["username"]:
+            user_ids = list(User.objects.filter(username__in=options["username"]).values_list("id", flat=True))
+        rebuild_tag_counts(user_ids)
+        self.stdout.write(self.style.SUCCESS("tag counts rebuilt"))
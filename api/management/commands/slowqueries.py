@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.slowqueries import read_log, summarize
+
+ORDERS = {
+    "total": "total_ms",
+    "count": "count",
+    "max": "max_ms",
+    "mean": "mean_ms",
+}
+
+
+def top(counts, limit=3):
+    return ", ".join("{} ({})".format(name, n) for name, n in sorted(counts.items(), key=lambda i: -i[1])[:limit])
+
+
+class Command(BaseCommand):
+    help = ("Summarize the slow query log by query fingerprint: how often each query shape was slow, "
+            "how long it took, which views and lines of code ran it and its query plan.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", help="the log to read, SLOW_QUERY_LOG by default")
+        parser.add_argument("--order", choices=sorted(ORDERS), default="total")
+        parser.add_argument("--limit", type=int, default=20)
+        parser.add_argument("--since", help="only entries from this time on, e.g. 2024-01-31 or 2024-01-31T12:00")
+
+    def handle(self, *args, **options):
+        path = options["file"] or settings.SLOW_QUERY_LOG
+        if not path:
+            raise CommandError("the slow query log is off, set BOOKLET_SLOW_QUERY_LOG or pass --file")
+        try:
+            entries = list(read_log(path))
+        except FileNotFoundError:
+            raise CommandError("{} does not exist, no query was slow yet".format(path))
+        if options["since"]:
+            entries = [e for e in entries if e["time"] >= options["since"]]
+
+        groups = sorted(summarize(entries), key=lambda g: -g[ORDERS[options["order"]]])
+        self.stdout.write("{} slow queries, {} query shapes\n".format(len(entries), len(groups)))
+        for group in groups[:options["limit"]]:
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                "{fingerprint}  {count} times, total {total_ms:.0f} ms, mean {mean_ms:.1f} ms, "
+                "max {max_ms:.1f} ms, last {last}".format(**group)))
+            self.stdout.write("  sql:   {}".format(group["sql"]))
+            if group["views"]:
+                self.stdout.write("  views: {}".format(top(group["views"])))
+            if group["sites"]:
+                self.stdout.write("  code:  {}".format(top(group["sites"])))
+            for line in group["plan"] or []:
+                style = self.style.WARNING if line in group["scans"] else (lambda text: text)
+                self.stdout.write(style("  plan:  {}".format(line)))
+            self.stdout.write("")
@@ -0,0 +1,28 @@
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.jobs import BATCH_SIZE, LEASE, Worker
+
+
+class Command(BaseCommand):
+    help = ("Run background jobs, such as fetching the title of bookmarks saved without one. "
+            "Several workers can run at once, each claims its own jobs. "
+            "SIGTERM or ctrl-c stop it after the job at hand.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="jobs claimed at once")
+        parser.add_argument("--lease", type=int, default=LEASE,
+                            help="seconds a claimed job stays ours, other workers take it over after that")
+        parser.add_argument("--poll", type=float, default=1.0, help="seconds to wait when no job is due")
+        parser.add_argument("--once", action="store_true", help="exit when no job is due instead of waiting")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1 or options["lease"] < 1:
+            raise CommandError("--batch-size and --lease must be at least 1")
+        worker = Worker(batch=options["batch_size"], lease=options["lease"], poll=options["poll"])
+        if not options["once"]:
+            signal.signal(signal.SIGTERM, worker.stop)
+            signal.signal(signal.SIGINT, worker.stop)
+        worker.run(once=options["once"])
+        self.stdout.write(self.style.SUCCESS("{} jobs done, {} failed".format(worker.done, worker.failed)))
@@ -0,0 +1,217 @@
+"""
+per request timing and metrics
+
+MetricsMiddleware sits first in MIDDLEWARE. For every request it takes the
+wall time, the number and duration of sql queries and the body size, and
+adds them to the histograms below under the url name of the view. The
+response gets a Server-Timing header, which browser dev tools show next to
+the request. /api/metrics serves everything in the prometheus text format.
+Slow queries are handed to api.slowqueries.
+
+recording a request is a handful of additions under one lock, cheap enough
+to leave on. The numbers live in the process: with several app.py workers
+each scrape sees the worker that answered it. Every series carries a
+`worker` label with the pid, so the workers' series stay apart and add up
+with sum without (worker) (...) once a few scrapes have reached them all.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from django.db import connection
+
+from . import slowqueries
+from .authentication import token_cache
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Histogram(object):
+    """cumulative prometheus histogram, one series per tuple of label values"""
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, values, value):
+        series = self.series.get(values)
+        if series is None:
+            # bucket counts, then sum and count
+            series = self.series[values] = [0] * len(self.buckets) + [0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        yield "# HELP {} {}".format(self.name, self.help)
+        yield "# TYPE {} histogram".format(self.name)
+        for values, series in sorted(self.series.items()):
+            labels = format_labels(self.labels, values)
+            total = 0
+            for bound, count in zip(self.buckets, series):
+                total += count
+                yield "{}_bucket{} {}".format(self.name, add_label(labels, "le", format_value(bound)), total)
+            yield "{}_bucket{} {}".format(self.name, add_label(labels, "le", "+Inf"), series[-1])
+            yield "{}_sum{} {}".format(self.name, labels, format_value(series[-2]))
+            yield "{}_count{} {}".format(self.name, labels, series[-1])
+
+
+class Counter(object):
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, values, value=1):
+        self.series[values] = self.series.get(values, 0) + value
+
+    def render(self):
+        yield "# HELP {} {}".format(self.name, self.help)
+        yield "# TYPE {} counter".format(self.name)
+        for values, value in sorted(self.series.items()):
+            yield "{}{} {}".format(self.name, format_labels(self.labels, values), format_value(value))
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(n, escape(v)) for n, v in zip(names, values)) + "}"
+
+
+def add_label(labels, name, value):
+    label = '{}="{}"'.format(name, value)
+    return "{" + label + "}" if not labels else labels[:-1] + "," + label + "}"
+
+
+def with_label(line, name, value):
+    """a rendered sample line with one more label"""
+    if line.startswith("#"):
+        return line
+    series, _, sample = line.rpartition(" ")
+    metric, brace, labels = series.partition("{")
+    return "{}{} {}".format(metric, add_label(brace + labels, name, value), sample)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            view = ("view", "method")
+            self.requests = Counter("booklets_requests_total", "Requests by view, method and status",
+                                    ("view", "method", "status"))
+            self.duration = Histogram("booklets_request_duration_seconds", "Time to answer a request",
+                                      view, LATENCY_BUCKETS)
+            self.queries = Histogram("booklets_request_queries", "SQL queries run by a request",
+                                     view, QUERY_BUCKETS)
+            self.query_time = Counter("booklets_db_query_seconds_total", "Time spent in SQL queries", view)
+            self.size = Histogram("booklets_response_bytes", "Size of response bodies, streamed ones excluded",
+                                  view, SIZE_BUCKETS)
+
+    def record(self, view, method, status, seconds, queries, query_seconds, size):
+        key = (view, method)
+        with self._lock:
+            self.requests.inc((view, method, status))
+            self.duration.observe(key, seconds)
+            self.queries.observe(key, queries)
+            self.query_time.inc(key, query_seconds)
+            if size is not None:
+                self.size.observe(key, size)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in (self.requests, self.duration, self.queries, self.query_time, self.size):
+                lines.extend(metric.render())
+        stats = token_cache.stats()
+        lines.extend([
+            "# HELP booklets_token_cache_hits_total Token lookups answered from the cache",
+            "# TYPE booklets_token_cache_hits_total counter",
+            "booklets_token_cache_hits_total {}".format(stats["hits"]),
+            "# HELP booklets_token_cache_misses_total Token lookups that went to the database",
+            "# TYPE booklets_token_cache_misses_total counter",
+            "booklets_token_cache_misses_total {}".format(stats["misses"]),
+            "# HELP booklets_token_cache_size Tokens in the cache",
+            "# TYPE booklets_token_cache_size gauge",
+            "booklets_token_cache_size {}".format(stats["size"]),
+            "# HELP booklets_process_start_time_seconds Start time of the process since the epoch",
+            "# TYPE booklets_process_start_time_seconds gauge",
+            "booklets_process_start_time_seconds {}".format(format_value(self.started)),
+        ])
+        worker = str(os.getpid())
+        return "\n".join(with_label(line, "worker", worker) for line in lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class QueryTimer(object):
+    """
+    execute wrapper counting queries and the time they take, queries slower
+    than slow seconds go to the slow query log
+    """
+
+    def __init__(self, request=None, slow=None):
+        self.request = request
+        self.slow = slow
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = execute(sql, params, many, context)
+            failed = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds += elapsed
+            self.count += 1
+            if self.slow is not None and elapsed >= self.slow and not failed:
+                slowqueries.record(sql, params, elapsed, context["connection"], many, self.request)
+
+
+class MetricsMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer(request, slowqueries.threshold())
+        start = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        seconds = time.perf_counter() - start
+
+        match = getattr(request, "resolver_match", None)
+        view = (match.url_name or match.view_name) if match else "other"
+        size = None if response.streaming else len(response.content)
+        metrics.record(view, request.method, response.status_code, seconds, timer.count, timer.seconds, size)
+        response["Server-Timing"] = 'app;dur={:.1f}, db;dur={:.1f};desc="{} queries"'.format(
+            seconds * 1000, timer.seconds * 1000, timer.count)
+        return response
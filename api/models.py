@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+from django.utils import timezone
 
 
 class Tag(models.Model):
@@ -19,9 +21,185 @@ class Bookmark(models.Model):
     updated = models.DateTimeField(auto_now=True)
     tags = models.ManyToManyField(Tag)
     user = models.ForeignKey('auth.User', related_name="bookmarks", on_delete=models.CASCADE, null=False)
+    # position in the user's change sequence, see ChangeCounter
+    seq = models.BigIntegerField(default=0)
+    # hash of the canonical url, see api.urlnorm. Set on save, null only for
+    # rows not backfilled yet, the backfill merges duplicates
+    url_hash = models.BigIntegerField(null=True)
+    # outcome of the last link check, see api.linkcheck. link_status is 0
+    # when the server did not answer, null when never checked
+    link_status = models.PositiveSmallIntegerField(null=True)
+    link_url = models.CharField(max_length=1000, blank=True)
+    link_checked = models.DateTimeField(null=True)
 
     def __str__(self):
         return self.url
 
+    def save(self, *args, **kwargs):
+        # seq is taken from the change counter in pre_save: commit both or
+        # neither, or a sync reading in between gets a token past this row.
+        # No savepoint, inside a caller's transaction that one covers both
+        with transaction.atomic(using=kwargs.get("using"), savepoint=False):
+            super(Bookmark, self).save(*args, **kwargs)
+
+    class Meta:
+        # a bookmark is known by its canonical url, matched through the hash
+        unique_together = ("user", "url_hash")
+        # keyset pagination walks these, see api.pagination.KeysetPagination
+        indexes = [
+            models.Index(fields=["user", "updated", "id"], name="api_bookmark_user_updated"),
+            models.Index(fields=["user", "added", "id"], name="api_bookmark_user_added"),
+            models.Index(fields=["user", "seq"], name="api_bookmark_user_seq"),
+            models.Index(fields=["user", "link_checked"], name="api_bookmark_user_checked"),
+        ]
+
+class BookmarkImport(models.Model):
+    """
+    progress of an import, so an interrupted import can pick up after the
+    last committed batch. Imports are told apart by a digest of the file.
+    """
+    user = models.ForeignKey('auth.User', related_name="imports", on_delete=models.CASCADE)
+    digest = models.CharField(max_length=64)
+    format = models.CharField(max_length=10)
+    committed = models.PositiveIntegerField(default=0)
+    created = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    started = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{} {}".format(self.format, self.digest[:8])
+
+    class Meta:
+        unique_together = ("user", "digest")
+
+
+class ChangeCounter(models.Model):
+    """
+    a version number for a set of rows, bumped on every write to them
+
+    `bookmarks:<user id>` covers the bookmarks of a user, `tags` covers all
+    tags, `tokens` moves with every token or user change so all server
+    processes can drop their cached tokens. Reading it is one primary key
+    lookup, which makes it a cheap validator for cached or conditional
+    responses.
+
+    the bookmark counter doubles as the user's change sequence: every saved
+    bookmark and every tombstone takes the next number, so "what changed
+    since N" is a range scan on seq.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    version = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(default=timezone.now)
+
+    TOKENS = "tokens"
+
+    def __str__(self):
+        return "{} {}".format(self.name, self.version)
+
+    @staticmethod
+    def bookmarks(user_id):
+        return "bookmarks:{}".format(user_id)
+
+    @classmethod
+    def bump(cls, name, count=1):
+        """
+        add count to the version and return the new one, the numbers in
+        between are the caller's. Call it inside a transaction so the
+        version read back is the one written.
+        """
+        now = timezone.now()
+        if not cls.objects.filter(name=name).update(version=F("version") + count, updated=now):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(name=name, version=count, updated=now)
+                return count
+            except IntegrityError:
+                # created by a concurrent writer in the meantime
+                cls.objects.filter(name=name).update(version=F("version") + count, updated=now)
+        return cls.objects.filter(name=name).values_list("version", flat=True).get()
+
+    @classmethod
+    def get(cls, name):
+        """(version, updated) of the counter, (0, None) for a set never written"""
+        row = cls.objects.filter(name=name).values_list("version", "updated").first()
+        return row or (0, None)
+
+
+class BookmarkTombstone(models.Model):
+    """
+    a deleted bookmark, kept so delta sync can tell clients to drop it
+
+    user has no database constraint: tombstones are written while a user's
+    bookmarks are deleted along with the user.
+    """
+    user = models.ForeignKey('auth.User', related_name="+", on_delete=models.DO_NOTHING, db_constraint=False)
+    bookmark_id = models.IntegerField()
+    seq = models.BigIntegerField()
+    deleted = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{} {}".format(self.bookmark_id, self.seq)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "seq"], name="api_tombstone_user_seq"),
+        ]
+
+class UserTag(models.Model):
+    """
+    how many bookmarks of a user carry a tag
+
+    a denormalized copy of the bookmark/tag through table, maintained by
+    api.tagcounts in the same transaction as every change of bookmark tags
+    """
+    user = models.ForeignKey('auth.User', related_name="tag_counts", on_delete=models.CASCADE)
+    tag = models.ForeignKey(Tag, related_name="user_counts", on_delete=models.CASCADE)
+    # not positive only: a check constraint would turn a stale count into a failed write
+    count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "{} {}".format(self.tag_id, self.count)
+
+    class Meta:
+        unique_together = ("user", "tag")
+        indexes = [
+            # a user's most used tags, see api.tagcounts.complete_tags
+            models.Index(fields=["user", "-count", "tag"], name="api_usertag_user_count"),
+        ]
+
+
+class Job(models.Model):
+    """
+    a unit of background work, see api.jobs
+
+    a worker claims a batch of jobs by stamping them with its claim token and
+    a lease. A job whose lease ran out, because its worker died, can be
+    claimed again. Finished jobs are deleted, failed ones are kept.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    FAILED = "failed"
+    STATES = ((QUEUED, QUEUED), (RUNNING, RUNNING), (FAILED, FAILED))
+
+    kind = models.CharField(max_length=50)
+    # json, the arguments of the handler
+    payload = models.TextField(default="{}")
+    state = models.CharField(max_length=10, choices=STATES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    claim = models.CharField(max_length=32, blank=True)
+    lease_until = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{} {} {}".format(self.kind, self.id, self.state)
+
     class Meta:
-        unique_together = ("user", "url")
+        indexes = [
+            models.Index(fields=["state", "run_after"], name="api_job_state_run_after"),
+            models.Index(fields=["claim"], name="api_job_claim"),
+        ]
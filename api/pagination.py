@@ -0,0 +1,107 @@
+import binascii
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class PageNumberPagination(pagination.PageNumberPagination):
+    """
+    page number pagination, clients can ask for bigger pages with `?page_size=`
+    """
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
+class KeysetPagination(pagination.BasePagination):
+    """
+    cursor pagination on (ordering field, id)
+
+    every page is a range scan starting right after the last row of the
+    previous page, so page 1000 costs the same as page 1 and rows inserted
+    meanwhile do not shift the pages. There is no count and no page numbers,
+    just a `next` link while there are more rows.
+
+    `?ordering=` picks the order, one of `-updated` (default), `updated`,
+    `-added` and `added`
+    """
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+    cursor_query_param = "cursor"
+    ordering_query_param = "ordering"
+    orderings = ("-updated", "updated", "-added", "added")
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = request.query_params.get(self.ordering_query_param, self.orderings[0])
+        if self.ordering not in self.orderings:
+            raise NotFound("Invalid ordering, use one of {}".format(", ".join(self.orderings)))
+        field = self.ordering.lstrip("-")
+        descending = self.ordering.startswith("-")
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            value, pk = cursor
+            op = "lt" if descending else "gt"
+            queryset = queryset.filter(
+                Q(**{"{}__{}".format(field, op): value}) |
+                Q(**{field: value, "id__{}".format(op): pk}))
+        if descending:
+            queryset = queryset.order_by("-" + field, "-id")
+        else:
+            queryset = queryset.order_by(field, "id")
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        self.last = (getattr(rows[-1], field), rows[-1].id) if rows else None
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+            if size > 0:
+                return min(size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            value, pk = b64decode(encoded.encode("ascii")).decode("ascii").rsplit("|", 1)
+            value = parse_datetime(value)
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if value is None:
+            raise NotFound(self.invalid_cursor_message)
+        return value, pk
+
+    def encode_cursor(self, value, pk):
+        encoded = b64encode("{}|{}".format(value.isoformat(), pk).encode("ascii")).decode("ascii")
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.cursor_query_param, encoded)
+        return replace_query_param(url, self.ordering_query_param, self.ordering)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(*self.last)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.get_next_link()),
+            ("results", data)
+        ]))
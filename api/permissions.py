@@ -7,12 +7,14 @@ class IsOwnerOrReadonly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
         if isinstance(obj, User):
-            return request.user == obj
-        return request.user == obj.user
+            return request.user.pk == obj.pk
+        # compare ids so the owner is not loaded from database
+        return request.user.pk == obj.user_id
 
 class IsOwner(permissions.BasePermission):
 
     def has_object_permission(self, request, view, obj):
         if isinstance(obj, User):
-            return request.user == obj
-        return request.user == obj.user
+            return request.user.pk == obj.pk
+        # compare ids so the owner is not loaded from database
+        return request.user.pk == obj.user_id
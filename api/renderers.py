@@ -0,0 +1,30 @@
+"""
+json renderer that encodes with orjson when it is installed
+
+the output is the same bytes JSONRenderer gives for the compact, non
+indented case: no spaces, non ascii kept as utf-8 and U+2028 / U+2029
+escaped. Anything orjson can not encode the same way is left to
+JSONRenderer.
+"""
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:  # optional, pip install orjson
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (orjson is None or data is None or not self.compact or self.ensure_ascii
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None):
+            return super(FastJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+        try:
+            # datetimes go through the drf encoder, it formats them differently
+            ret = orjson.dumps(data, default=self.encoder_class().default,
+                               option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            # big ints, non string keys, nan
+            return super(FastJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+        return ret.replace("\u2028".encode(), b"\\u2028").replace("\u2029".encode(), b"\\u2029")
@@ -0,0 +1,86 @@
+"""
+full text search over bookmark title, comment and url
+
+on sqlite the search is served by an fts5 table that indexes api_bookmark as
+external content. Triggers keep it in step with every insert, update and
+delete, so nothing in python has to remember to reindex.
+"""
+from django.db import connections
+from django.db.models import Q
+
+FTS_TABLE = "api_bookmark_fts"
+
+FTS_SQL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS api_bookmark_fts USING fts5(
+        title, comment, url, content='api_bookmark', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS api_bookmark_fts_ai AFTER INSERT ON api_bookmark BEGIN
+        INSERT INTO api_bookmark_fts(rowid, title, comment, url)
+        VALUES (new.id, new.title, new.comment, new.url);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS api_bookmark_fts_ad AFTER DELETE ON api_bookmark BEGIN
+        INSERT INTO api_bookmark_fts(api_bookmark_fts, rowid, title, comment, url)
+        VALUES ('delete', old.id, old.title, old.comment, old.url);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS api_bookmark_fts_au AFTER UPDATE OF title, comment, url ON api_bookmark BEGIN
+        INSERT INTO api_bookmark_fts(api_bookmark_fts, rowid, title, comment, url)
+        VALUES ('delete', old.id, old.title, old.comment, old.url);
+        INSERT INTO api_bookmark_fts(rowid, title, comment, url)
+        VALUES (new.id, new.title, new.comment, new.url);
+    END""",
+]
+
+
+def install_fts(sender, using="default", **kwargs):
+    """
+    post_migrate handler, create the fts table and its triggers
+
+    rebuilding api_bookmark in a migration drops the triggers with it, so
+    they are put back after every migrate. The index itself is only rebuilt
+    when the fts table is new.
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        tables = connection.introspection.table_names(cursor)
+        if "api_bookmark" not in tables:
+            return
+        for sql in FTS_SQL:
+            cursor.execute(sql)
+        if FTS_TABLE not in tables:
+            cursor.execute("INSERT INTO api_bookmark_fts(api_bookmark_fts) VALUES ('rebuild')")
+
+
+def fts_query(text):
+    """
+    turn user input into a fts5 query
+
+    every word is quoted so that fts5 operators in the input can not break
+    the query, a trailing * is kept as a prefix search. Words are AND-ed.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if not word:
+            continue
+        terms.append('"{}"{}'.format(word.replace('"', '""'), "*" if prefix else ""))
+    return " ".join(terms)
+
+
+def search(queryset, text):
+    """filter queryset to bookmarks matching text, best match first"""
+    query = fts_query(text)
+    if not query:
+        return queryset.none()
+    if connections[queryset.db].vendor != "sqlite":
+        for word in filter(None, (w.rstrip("*") for w in text.split())):
+            queryset = queryset.filter(
+                Q(title__icontains=word) | Q(comment__icontains=word) | Q(url__icontains=word))
+        return queryset
+    return queryset.extra(
+        tables=[FTS_TABLE],
+        where=["api_bookmark_fts.rowid = api_bookmark.id", "api_bookmark_fts MATCH %s"],
+        params=[query],
+        select={"rank": "bm25(api_bookmark_fts)"},
+        order_by=["rank", "id"])
@@ -2,9 +2,59 @@ from rest_framework import serializers
 from rest_framework.authtoken.models import Token
 
 from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
 from django.http import QueryDict
 
-from .models import Bookmark, Tag
+from .enrich import enqueue_enrichment
+from .models import Bookmark, ChangeCounter, Tag, UserTag
+from .tagcounts import tag_deltas, update_tag_counts
+
+
+def get_tag_data(initial_data):
+    """tags are posted as a list of names, either form data or json"""
+    if isinstance(initial_data, QueryDict):
+        return initial_data.getlist("tags", [])
+    return initial_data.get("tags", [])
+
+
+def set_tags(bookmark, tag_data):
+    """
+    make tag_data the tags of bookmark
+
+    only the difference to the current tags is written: one delete for the
+    removed links, one insert for the added ones. Both are idempotent, so a
+    concurrent writer touching the same links can not make this fail. Call it
+    inside a transaction, together with bookmark.save() which bumps the
+    bookmark change counter.
+    """
+    through = Bookmark.tags.through
+    names = set(tag_data)
+    current = set(through.objects.filter(bookmark_id=bookmark.id).values_list("tag_id", flat=True))
+    removed = current - names
+    added = names - current
+    if removed:
+        # one DELETE: the m2m_changed receiver keeps Django from fast deleting, counted below
+        links = through.objects.filter(bookmark_id=bookmark.id, tag_id__in=removed)
+        links._raw_delete(links.db)
+    if added:
+        Tag.objects.bulk_create([Tag(name=name) for name in added], ignore_conflicts=True)
+        through.objects.bulk_create([through(bookmark_id=bookmark.id, tag_id=name) for name in added],
+                                    ignore_conflicts=True)
+        ChangeCounter.bump("tags")
+    update_tag_counts(bookmark.user_id, tag_deltas(added, removed))
+    # tags were changed behind the related manager, drop any prefetched copy
+    getattr(bookmark, "_prefetched_objects_cache", {}).pop("tags", None)
+
+
+def duplicate_url(error):
+    """
+    the ValidationError for an IntegrityError from the (user, url_hash)
+    unique constraint, None for any other. sqlite and postgres both name the
+    columns or the constraint after them in the message.
+    """
+    if "url_hash" not in str(error):
+        return None
+    return serializers.ValidationError({"url": ["this url is bookmarked already"]})
 
 
 class TokenSerializer(serializers.ModelSerializer):
@@ -49,6 +99,13 @@ class TagSerializer(serializers.ModelSerializer):
         model = Tag
         fields = ("name", )
 
+class UserTagSerializer(serializers.ModelSerializer):
+    name = serializers.ReadOnlyField(source="tag_id")
+
+    class Meta:
+        model = UserTag
+        fields = ("name", "count")
+
 class BookmarkSerializer(serializers.ModelSerializer):
     tags = serializers.SlugRelatedField(
         many=True, read_only=True , slug_field="name")
@@ -60,37 +117,43 @@ class BookmarkSerializer(serializers.ModelSerializer):
                   "user")
 
     def create(self, validated_data):
-        initial_data = self.initial_data
-        if isinstance(initial_data, QueryDict):
-            tag_data = self.initial_data.getlist("tags", [])
-        else:
-            tag_data = self.initial_data.get("tags", [])
-
-        bookmark = Bookmark.objects.create(**validated_data)
-        for tag in tag_data:
-            t, _ = Tag.objects.get_or_create(name=tag)
-            bookmark.tags.add(t)
+        tag_data = get_tag_data(self.initial_data)
+
+        try:
+            with transaction.atomic():
+                bookmark = Bookmark.objects.create(**validated_data)
+                if tag_data:
+                    Tag.objects.bulk_create([Tag(name=tag) for tag in set(tag_data)], ignore_conflicts=True)
+                    ChangeCounter.bump("tags")
+                    # the related manager would look for existing links first, a new bookmark has none
+                    through = Bookmark.tags.through
+                    through.objects.bulk_create([through(bookmark_id=bookmark.id, tag_id=name)
+                                                 for name in set(tag_data)])
+                    update_tag_counts(bookmark.user_id, tag_deltas(set(tag_data)))
+                enqueue_enrichment([bookmark])
+        except IntegrityError as e:
+            error = duplicate_url(e)
+            if error is None:
+                raise
+            raise error
         return bookmark
 
     def update(self, bookmark, validated_data):
-        initial_data = self.initial_data
-        if isinstance(initial_data, QueryDict):
-            tag_data = self.initial_data.getlist("tags", [])
-        else:
-            tag_data = self.initial_data.get("tags", [])
+        tag_data = get_tag_data(self.initial_data)
 
         bookmark.url = validated_data.get("url")
         bookmark.comment = validated_data.get("comment", "")
         bookmark.title = validated_data.get("title", "")
 
-        # it seems that I can not use bookmark.tags.set() here
-        for i in bookmark.tags.all():
-            if i.name not in tag_data:
-                bookmark.tags.remove(i)
-        for tag in tag_data:
-            t, _ = Tag.objects.get_or_create(name=tag)
-            bookmark.tags.add(t)
-        bookmark.save()
+        try:
+            with transaction.atomic():
+                bookmark.save()
+                set_tags(bookmark, tag_data)
+        except IntegrityError as e:
+            error = duplicate_url(e)
+            if error is None:
+                raise
+            raise error
         return bookmark
 
     def validate_tags(self, value):
@@ -0,0 +1,106 @@
+"""
+keep ChangeCounter, UserTag, Bookmark.url_hash and the token cache in step
+with writes that go through the ORM
+
+bulk writes (bulk_create, bulk_update, queryset delete on the through table)
+send no signals, the code doing them bumps the counters itself. Tag changes
+through the related managers (bookmark.tags.add/remove/set/clear, the admin
+form) do send m2m_changed and are counted here. The price of listening is
+that Django no longer fast deletes rows of the through table, a delete there
+becomes a select plus a delete.
+"""
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import token_cache
+from .models import Bookmark, BookmarkTombstone, ChangeCounter, Tag
+from .tagcounts import tag_deltas, update_tag_counts
+from .urlnorm import url_hash
+
+
+@receiver(pre_save, sender=Bookmark)
+def bookmark_saving(sender, instance, **kwargs):
+    instance.seq = ChangeCounter.bump(ChangeCounter.bookmarks(instance.user_id))
+    key = url_hash(instance.url)
+    if instance.link_checked is not None and key != instance.url_hash:
+        # a new url, the last link check was about the old one
+        instance.link_status, instance.link_url, instance.link_checked = None, "", None
+    instance.url_hash = key
+
+
+@receiver(pre_delete, sender=Bookmark)
+def bookmark_deleting(sender, instance, **kwargs):
+    # the tag links go with the bookmark without signals of their own
+    tags = Bookmark.tags.through.objects.filter(bookmark_id=instance.id).values_list("tag_id", flat=True)
+    update_tag_counts(instance.user_id, tag_deltas(removed=list(tags)))
+
+
+@receiver(post_delete, sender=Bookmark)
+def bookmark_deleted(sender, instance, **kwargs):
+    seq = ChangeCounter.bump(ChangeCounter.bookmarks(instance.user_id))
+    BookmarkTombstone.objects.create(user_id=instance.user_id, bookmark_id=instance.id, seq=seq)
+
+
+def tag_links(instance, reverse, pk_set):
+    """(user id, tag) of the links an m2m change of bookmark tags is about"""
+    links = Bookmark.tags.through.objects.all()
+    if reverse:
+        links = links.filter(tag_id=instance.pk)
+        if pk_set is not None:
+            links = links.filter(bookmark_id__in=pk_set)
+    else:
+        links = links.filter(bookmark_id=instance.pk)
+        if pk_set is not None:
+            links = links.filter(tag_id__in=pk_set)
+    return list(links.values_list("bookmark__user_id", "tag_id"))
+
+
+def count_tag_links(links, sign):
+    tags = defaultdict(list)
+    for user_id, tag in links:
+        tags[user_id].append(tag)
+    for user_id, names in tags.items():
+        update_tag_counts(user_id, tag_deltas(added=names) if sign > 0 else tag_deltas(removed=names))
+
+
+@receiver(m2m_changed, sender=Bookmark.tags.through)
+def bookmark_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # pk_set of an add holds only the new links, of a remove whatever was
+    # asked for: look up which links exist before they go
+    if action in ("pre_remove", "pre_clear"):
+        instance._tag_links_removed = tag_links(instance, reverse, pk_set)
+    elif action in ("post_remove", "post_clear"):
+        count_tag_links(instance.__dict__.pop("_tag_links_removed", []), -1)
+    elif action == "post_add":
+        count_tag_links(tag_links(instance, reverse, pk_set), 1)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tag_changed(sender, **kwargs):
+    ChangeCounter.bump("tags")
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_changed(sender, instance, **kwargs):
+    # again after commit, a request racing the transaction may have cached it
+    token_cache.delete(instance.key)
+    transaction.on_commit(lambda: token_cache.delete(instance.key))
+    # and in the other server processes
+    ChangeCounter.bump(ChangeCounter.TOKENS)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # deactivated or deleted users must not keep authenticating
+    user_id = instance.pk
+    token_cache.delete_user(user_id)
+    transaction.on_commit(lambda: token_cache.delete_user(user_id))
+    ChangeCounter.bump(ChangeCounter.TOKENS)
@@ -0,0 +1,159 @@
+"""
+slow query log
+
+MetricsMiddleware times every query. One slower than SLOW_QUERY_MS is
+written as a json line to SLOW_QUERY_LOG with the view that ran it and the
+first frame of our own code on the stack, which is usually the queryset
+that needs an index. Query parameters are never logged, the statement
+keeps its placeholders.
+
+queries are grouped by a fingerprint of the statement with literals and
+IN lists folded. The first time a process sees a fingerprint it also
+records the sqlite EXPLAIN QUERY PLAN, so a full scan of api_bookmark
+shows up as "SCAN api_bookmark". `manage.py slowqueries` sums the log up
+by fingerprint.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger("booklets.slowqueries")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SKIP_FILES = (os.path.abspath(__file__), os.path.join(ROOT, "api", "metrics.py"))
+
+NORMALIZE = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),
+    (re.compile(r"\s+"), " "),
+]
+
+_lock = threading.Lock()
+_explained = set()
+
+
+def threshold():
+    """seconds, None when the log is off"""
+    if not getattr(settings, "SLOW_QUERY_LOG", None):
+        return None
+    return getattr(settings, "SLOW_QUERY_MS", 100) / 1000.0
+
+
+def normalize(sql):
+    for pattern, replacement in NORMALIZE:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def fingerprint(sql):
+    return hashlib.sha1(normalize(sql).encode("utf-8")).hexdigest()[:12]
+
+
+def call_site():
+    """file:line of the innermost frame in this project outside site-packages"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if (filename.startswith(ROOT) and filename not in SKIP_FILES
+                and "site-packages" not in filename):
+            return "{}:{} in {}".format(os.path.relpath(filename, ROOT), frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def explain(connection, sql, params):
+    """EXPLAIN QUERY PLAN lines, sqlite only"""
+    if connection.vendor != "sqlite":
+        return None
+    from django.db.backends.sqlite3.base import SQLiteCursorWrapper
+    # straight on the database connection, so the execute wrappers do not see it
+    cursor = connection.connection.cursor(factory=SQLiteCursorWrapper)
+    try:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+    except Exception:
+        return None
+    finally:
+        cursor.close()
+
+
+def record(sql, params, seconds, connection, many=False, request=None):
+    """log one slow query"""
+    key = fingerprint(sql)
+    entry = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "ms": round(seconds * 1000, 3),
+        "fingerprint": key,
+        "sql": sql,
+        "view": None,
+        "path": None,
+        "site": call_site(),
+    }
+    if request is not None:
+        match = getattr(request, "resolver_match", None)
+        entry["view"] = (match.url_name or match.view_name) if match else None
+        entry["path"] = request.path
+    with _lock:
+        new = key not in _explained
+        _explained.add(key)
+    if new and not many:
+        entry["plan"] = explain(connection, sql, params)
+
+    logger.warning("slow query %.1f ms in %s at %s: %s", entry["ms"], entry["view"], entry["site"], normalize(sql))
+    line = json.dumps(entry) + "\n"
+    with _lock:
+        with open(settings.SLOW_QUERY_LOG, "a") as f:
+            f.write(line)
+
+
+def read_log(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def summarize(entries):
+    """per fingerprint: count, total, max, views, sites, a statement and a plan"""
+    groups = {}
+    for entry in entries:
+        group = groups.get(entry["fingerprint"])
+        if group is None:
+            group = groups[entry["fingerprint"]] = {
+                "fingerprint": entry["fingerprint"],
+                "sql": normalize(entry["sql"]),
+                "count": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "views": {},
+                "sites": {},
+                "plan": None,
+                "last": None,
+            }
+        group["count"] += 1
+        group["total_ms"] += entry["ms"]
+        group["max_ms"] = max(group["max_ms"], entry["ms"])
+        group["last"] = entry["time"]
+        for field, counts in (("view", group["views"]), ("site", group["sites"])):
+            if entry.get(field):
+                counts[entry[field]] = counts.get(entry[field], 0) + 1
+        if entry.get("plan"):
+            group["plan"] = entry["plan"]
+    for group in groups.values():
+        group["mean_ms"] = group["total_ms"] / group["count"]
+        plan = group["plan"] or []
+        group["scans"] = [line for line in plan if line.startswith("SCAN")]
+    return list(groups.values())
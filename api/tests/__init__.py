@@ -1,2 +1,6 @@
 from api.tests.test_serializer import *
 from api.tests.test_api import *
+from api.tests.test_import import *
+from api.tests.test_urlnorm import *
+from api.tests.test_linkcheck import *
+from api.tests.test_jobs import *
@@ -0,0 +1,28 @@
+# a local http server for the tests of code that fetches urls
+
+import threading
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server has one from python 3.7
+    daemon_threads = True
+
+
+def start_server(handler):
+    """
+    serve handler on a free port of 127.0.0.1 in a thread. The handler can
+    record requests in server.seen, server.base is the url to prefix paths
+    with. The code under test needs FETCH_PRIVATE_ADDRESSES to reach it.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.seen = []
+    server.base = "http://127.0.0.1:{}".format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
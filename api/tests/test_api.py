@@ -1,9 +1,25 @@
 import base64
 import json
-from django.test import TestCase, Client
+import os
+import tempfile
+from collections import OrderedDict
+from io import StringIO
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError
 from django.utils.six import BytesIO
+from rest_framework import generics
 from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+from api.authentication import token_cache
+from api.cache import response_cache
+from api.conditional import ConditionalMixin
+from api import slowqueries
+from api.metrics import metrics
+from api.models import Bookmark, ChangeCounter, Tag, UserTag
+from api.serializers import BookmarkSerializer, TagSerializer
 
 
 class UserTest(TestCase):
@@ -18,6 +34,8 @@ class UserTest(TestCase):
         token.save()
         self.user = user
         self.client = Client()
+        token_cache.clear()
+        response_cache().clear()
 
 
     def test_list_users(self):
@@ -149,3 +167,566 @@ class UserTest(TestCase):
         res = self.client.post("/api/bookmarks/", data=data1, HTTP_AUTHORIZATION=auth)
         self.assertTrue(res.status_code == 201)
         self.assertTrue("google" in res.json()["tags"] and "apple" in res.json()["tags"])
+
+    def test_filter_bookmarks_by_tags(self):
+        auth = "Basic {}".format(base64.b64encode("{}:{}".format(self.username, self.password).encode()).decode())
+        for url, tags in [("http://a.org", ["linux", "python"]),
+                          ("http://b.org", ["linux"]),
+                          ("http://c.org", ["python", "django"]),
+                          ("http://d.org", ["go"])]:
+            res = self.client.post("/api/bookmarks/", data={"url": url, "tags": tags}, HTTP_AUTHORIZATION=auth)
+            self.assertEqual(res.status_code, 201)
+
+        def urls(query):
+            res = self.client.get("/api/bookmarks/?" + query, HTTP_AUTHORIZATION=auth)
+            self.assertEqual(res.status_code, 200)
+            return sorted(i["url"] for i in res.json()["results"])
+
+        self.assertEqual(urls("tag=linux"), ["http://a.org", "http://b.org"])
+        self.assertEqual(urls("tags=linux,python"), ["http://a.org"])
+        self.assertEqual(urls("any=django,go"), ["http://c.org", "http://d.org"])
+        self.assertEqual(urls("tag=python&exclude=linux"), ["http://c.org"])
+        self.assertEqual(urls("tags=linux&any=python,go&exclude=django"), ["http://a.org"])
+
+    def test_list_bookmarks_query_count(self):
+        tags = [Tag.objects.create(name="tag{}".format(i)) for i in range(5)]
+        for i in range(100):
+            b = Bookmark.objects.create(url="http://{}.org".format(i), title=str(i), user=self.user)
+            b.tags.add(*tags[:i % 5 + 1])
+
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+        # token lookup, change counter, count and the page with its tags
+        with self.assertNumQueries(4):
+            res = self.client.get("/api/bookmarks/?page_size=100", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.json()["results"]), 100)
+
+        # the token is cached now: updated time, bookmark and tags prefetch
+        with self.assertNumQueries(3):
+            res = self.client.get("/api/bookmarks/{}/".format(b.id), HTTP_AUTHORIZATION=auth)
+        self.assertEqual(len(res.json()["tags"]), 5)
+
+        with self.assertNumQueries(3):
+            res = self.client.get("/api/tags/?page_size=100", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.json()["count"], 5)
+
+    def test_list_fast_path_output(self):
+        from api.views import BookmarkList
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+        odd = ["a,b", 'qu"ote', "\u4e2d\u6587", "line\u2028sep", "ctl\x01\x1f", "back\\slash", "\U0001f600"]
+        for i, text in enumerate(odd):
+            data = {"url": "http://{}.org/?q={}".format(i, text), "title": text, "comment": text * 2,
+                    "tags": [text, "common", "z{}".format(i)]}
+            res = self.client.post("/api/bookmarks/", data=json.dumps(data), content_type="application/json",
+                                   HTTP_AUTHORIZATION=auth)
+            self.assertEqual(res.status_code, 201)
+        self.client.post("/api/bookmarks/", data={"url": "http://untagged.org"}, HTTP_AUTHORIZATION=auth)
+
+        queries = ["", "?page_size=3", "?page_size=3&page=2", "?tag=common", "?exclude=common",
+                   "?q=line", "?any=a,b,z1&page_size=1", "?format=json"]
+        for query in queries:
+            fast = self.client.get("/api/bookmarks/" + query, HTTP_AUTHORIZATION=auth).content
+            BookmarkList.fast_list = False
+            try:
+                response_cache().clear()
+                slow = self.client.get("/api/bookmarks/" + query, HTTP_AUTHORIZATION=auth).content
+            finally:
+                BookmarkList.fast_list = True
+            self.assertEqual(fast, slow, query)
+        self.assertEqual(json.loads(fast.decode())["results"][0]["tags"], sorted(["a,b", "common", "z0"]))
+
+        # and byte for byte what stock DRF makes of the same rows, BookmarkSerializer and JSONRenderer
+        bookmarks = Bookmark.objects.filter(user=self.user).order_by("id")
+        base = "http://testserver/api/bookmarks/"
+        pages = [("?page_size=100", None, None, bookmarks),
+                 ("?page_size=3&page=2", base + "?page=3&page_size=3", base + "?page_size=3", bookmarks[3:6])]
+        for query, next_link, previous, rows in pages:
+            expected = JSONRenderer().render(OrderedDict([
+                ("count", bookmarks.count()),
+                ("next", next_link),
+                ("previous", previous),
+                ("results", BookmarkSerializer(rows, many=True).data),
+            ]))
+            response_cache().clear()
+            self.assertEqual(self.client.get("/api/bookmarks/" + query, HTTP_AUTHORIZATION=auth).content,
+                             expected, query)
+            if rows is bookmarks:
+                # the untagged, untitled bookmark and the null links are in there
+                self.assertIn(b'"title":"","url":"http://untagged.org","comment":"","tags":[]', expected)
+                self.assertIn(b'"next":null,"previous":null', expected)
+
+    def test_list_response_cache(self):
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+        self.client.post("/api/bookmarks/", data={"url": "http://a.org", "tags": ["a"]}, HTTP_AUTHORIZATION=auth)
+        first = self.client.get("/api/bookmarks/?page_size=5", HTTP_AUTHORIZATION=auth)
+        # the change counter only, the page comes from the cache
+        with self.assertNumQueries(1):
+            res = self.client.get("/api/bookmarks/?page_size=5", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.content, first.content)
+        self.assertEqual(res["ETag"], first["ETag"])
+        self.assertEqual(res["Content-Type"], first["Content-Type"])
+
+        # the pagination links are absolute, other hosts and schemes get their own
+        self.client.post("/api/bookmarks/", data={"url": "http://c.org"}, HTTP_AUTHORIZATION=auth)
+        pages = [self.client.get("/api/bookmarks/?page_size=1", HTTP_AUTHORIZATION=auth, **extra)
+                 for extra in ({}, {"HTTP_HOST": "other.org"}, {"secure": True})]
+        self.assertEqual([res.json()["next"] for res in pages],
+                         ["http://testserver/api/bookmarks/?page=2&page_size=1",
+                          "http://other.org/api/bookmarks/?page=2&page_size=1",
+                          "https://testserver/api/bookmarks/?page=2&page_size=1"])
+        self.assertEqual(len({res["ETag"] for res in pages}), 3)
+
+        # a new bookmark bumps the counter, the cached page is not used
+        self.client.post("/api/bookmarks/", data={"url": "http://b.org", "tags": ["b"]}, HTTP_AUTHORIZATION=auth)
+        res = self.client.get("/api/bookmarks/?page_size=5", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.json()["count"], 3)
+        self.assertEqual(sorted(t["name"] for t in self.client.get("/api/tags/", HTTP_AUTHORIZATION=auth).json()["results"]),
+                         ["a", "b"])
+
+    def test_bulk_create_update_bookmarks(self):
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+        Tag.objects.create(name="linux")
+        old = Bookmark.objects.create(url="http://a.org", title="old", user=self.user)
+        old.tags.add("linux")
+
+        data = [{"url": "http://b.org/{}".format(i), "title": str(i), "tags": ["new", "tag{}".format(i % 3)]}
+                for i in range(50)]
+        data.append({"url": "http://a.org", "title": "a", "tags": ["python"]})
+        data.append({"title": "no url"})
+        # token, savepoint, select existing, change sequence, update, insert,
+        # select ids, tags, through select, delete and insert, tag counter,
+        # tag counts and release
+        with self.assertNumQueries(18):
+            res = self.client.post("/api/bookmarks/bulk/", data=json.dumps(data),
+                                   content_type="application/json", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.status_code, 200)
+        results = res.json()["results"]
+        self.assertEqual(len(results), 52)
+        self.assertEqual(results[0]["status"], "created")
+        self.assertEqual(results[50], {"status": "updated", "id": old.id, "url": "http://a.org"})
+        self.assertEqual(results[51]["status"], "error")
+        self.assertTrue("url" in results[51]["errors"])
+
+        self.assertEqual(Bookmark.objects.filter(user=self.user).count(), 51)
+        self.assertEqual(Bookmark.objects.get(id=old.id).title, "a")
+        self.assertEqual([t.name for t in Bookmark.objects.get(id=old.id).tags.all()], ["python"])
+        b = Bookmark.objects.get(id=results[4]["id"])
+        self.assertEqual(sorted(t.name for t in b.tags.all()), ["new", "tag1"])
+
+        res = self.client.post("/api/bookmarks/bulk/", data=json.dumps({"url": "http://a.org"}),
+                               content_type="application/json", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.status_code, 400)
+
+    def test_search_bookmarks(self):
+        other = User.objects.create(username="other")
+        Bookmark.objects.create(url="http://python.org", title="python", comment="python language", user=other)
+        a = Bookmark.objects.create(url="http://a.org", title="django docs", comment="python web framework", user=self.user)
+        b = Bookmark.objects.create(url="http://python.org", title="python", comment="python language", user=self.user)
+        c = Bookmark.objects.create(url="http://c.org", title="rust", comment="", user=self.user)
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+
+        def ids(q):
+            res = self.client.get("/api/bookmarks/", {"q": q}, HTTP_AUTHORIZATION=auth)
+            self.assertEqual(res.status_code, 200)
+            return [i["id"] for i in res.json()["results"]]
+
+        self.assertEqual(ids("python"), [b.id, a.id])
+        self.assertEqual(ids("pyth*"), [b.id, a.id])
+        self.assertEqual(ids("python web"), [a.id])
+        self.assertEqual(ids('"rust" OR ('), [])
+
+        c.title = "rust and python"
+        c.save()
+        self.assertEqual(set(ids("python")), {a.id, b.id, c.id})
+        b.delete()
+        self.assertEqual(set(ids("python")), {a.id, c.id})
+
+    def test_list_bookmarks_by_cursor(self):
+        for i in range(25):
+            Bookmark.objects.create(url="http://{}.org".format(i), user=self.user)
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+
+        def walk(url):
+            seen = []
+            while url:
+                res = self.client.get(url, HTTP_AUTHORIZATION=auth)
+                self.assertEqual(res.status_code, 200)
+                self.assertFalse("count" in res.json())
+                seen.extend(i["url"] for i in res.json()["results"])
+                url = res.json()["next"]
+                if len(seen) == 10:
+                    # rows added meanwhile do not shift the following pages
+                    Bookmark.objects.create(url="http://new.org", user=self.user)
+            return seen
+
+        seen = walk("/api/bookmarks/?cursor=&ordering=added")
+        self.assertEqual(seen, ["http://{}.org".format(i) for i in range(25)] + ["http://new.org"])
+        seen = walk("/api/bookmarks/?cursor=&page_size=7")
+        self.assertEqual(len(seen), 26)
+        self.assertEqual(seen[0], "http://new.org")
+
+        res = self.client.get("/api/bookmarks/?cursor=bad", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.status_code, 404)
+
+    def test_export_bookmarks(self):
+        Tag.objects.create(name="linux")
+        for i in range(3):
+            b = Bookmark.objects.create(url="http://{}.org".format(i), title="<{}>".format(i), user=self.user)
+            b.tags.add("linux")
+        Bookmark.objects.create(url="http://other.org", user=User.objects.create(username="other"))
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+
+        res = self.client.get("/api/bookmarks/export/", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.status_code, 200)
+        lines = b"".join(res.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        detail = self.client.get("/api/bookmarks/{}/".format(b.id), HTTP_AUTHORIZATION=auth).json()
+        self.assertEqual(json.loads(lines[-1]), detail)
+
+        res = self.client.get("/api/bookmarks/export/?format=csv", HTTP_AUTHORIZATION=auth)
+        lines = b"".join(res.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "id,title,url,comment,tags,added,updated")
+        self.assertEqual(len(lines), 4)
+
+        res = self.client.get("/api/bookmarks/export/?format=html", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res["Content-Disposition"], 'attachment; filename="bookmarks.html"')
+        html = b"".join(res.streaming_content).decode()
+        self.assertTrue(html.startswith("<!DOCTYPE NETSCAPE-Bookmark-file-1>"))
+        self.assertTrue('<A HREF="http://2.org"' in html and 'TAGS="linux">&lt;2&gt;</A>' in html)
+
+        res = self.client.get("/api/bookmarks/export/?format=xml", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.status_code, 400)
+
+    def test_conditional_get_and_update(self):
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+        res = self.client.post("/api/bookmarks/", data={"url": "http://a.org", "tags": ["a"]}, HTTP_AUTHORIZATION=auth)
+        _id = res.json()["id"]
+
+        for url in ("/api/bookmarks/", "/api/bookmarks/{}/".format(_id), "/api/tags/", "/api/tags/a/"):
+            res = self.client.get(url, HTTP_AUTHORIZATION=auth)
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(res.has_header("Last-Modified"))
+            etag = res["ETag"]
+            # the change counter only, the token is cached
+            with self.assertNumQueries(1):
+                res = self.client.get(url, HTTP_AUTHORIZATION=auth, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(res.status_code, 304)
+
+        list_etag = self.client.get("/api/bookmarks/", HTTP_AUTHORIZATION=auth)["ETag"]
+        self.assertNotEqual(list_etag, self.client.get("/api/bookmarks/?page_size=5", HTTP_AUTHORIZATION=auth)["ETag"])
+
+        url = "/api/bookmarks/{}/".format(_id)
+        etag = self.client.get(url, HTTP_AUTHORIZATION=auth)["ETag"]
+        data = json.dumps({"url": "http://a.org", "title": "first", "tags": ["a"]})
+        res = self.client.put(url, data=data, content_type="application/json", HTTP_AUTHORIZATION=auth, HTTP_IF_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res["ETag"], etag)
+
+        # a second writer still holding the old etag loses
+        data = json.dumps({"url": "http://a.org", "title": "second", "tags": ["a"]})
+        res = self.client.put(url, data=data, content_type="application/json", HTTP_AUTHORIZATION=auth, HTTP_IF_MATCH=etag)
+        self.assertEqual(res.status_code, 412)
+        res = self.client.delete(url, HTTP_AUTHORIZATION=auth, HTTP_IF_MATCH=etag)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(Bookmark.objects.get(id=_id).title, "first")
+
+        # the etag of another representation of the same state is good for a write
+        indented = self.client.get(url, HTTP_AUTHORIZATION=auth, HTTP_ACCEPT="application/json; indent=4")["ETag"]
+        self.assertNotEqual(indented, self.client.get(url, HTTP_AUTHORIZATION=auth)["ETag"])
+        data = json.dumps({"url": "http://a.org", "title": "third", "tags": ["a"]})
+        res = self.client.put(url, data=data, content_type="application/json", HTTP_AUTHORIZATION=auth,
+                              HTTP_IF_MATCH=indented)
+        self.assertEqual(res.status_code, 200)
+        # someone else learns nothing from the precondition, the permission check comes first
+        other = User.objects.create(username="other")
+        other_auth = "token {}".format(Token.objects.create(user=other).key)
+        for if_match in (res["ETag"], '"nothing"'):
+            res = self.client.put(url, data=data, content_type="application/json", HTTP_AUTHORIZATION=other_auth,
+                                  HTTP_IF_MATCH=if_match)
+            self.assertEqual(res.status_code, 403)
+        res = self.client.delete("/api/bookmarks/999999/", HTTP_AUTHORIZATION=other_auth, HTTP_IF_MATCH='"x"')
+        self.assertEqual(res.status_code, 404)
+
+        res = self.client.get("/api/bookmarks/", HTTP_AUTHORIZATION=auth, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(res.status_code, 200)
+
+        # a view without validators is served without conditional handling
+        class Plain(ConditionalMixin, generics.ListAPIView):
+            queryset = Tag.objects.all()
+            serializer_class = TagSerializer
+
+        res = Plain.as_view()(APIRequestFactory().get("/", HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(res.has_header("ETag"))
+
+    def test_bookmark_changes(self):
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+
+        def changes(since, **params):
+            res = self.client.get("/api/bookmarks/changes/", dict(params, since=since), HTTP_AUTHORIZATION=auth)
+            self.assertEqual(res.status_code, 200)
+            return res.json()
+
+        res = changes("")
+        self.assertEqual((res["changed"], res["deleted"], res["more"]), ([], [], False))
+        token = res["next"]
+
+        a = Bookmark.objects.create(url="http://a.org", user=self.user)
+        b = Bookmark.objects.create(url="http://b.org", user=self.user)
+        Bookmark.objects.create(url="http://other.org", user=User.objects.create(username="other"))
+        res = changes(token)
+        self.assertEqual([i["url"] for i in res["changed"]], ["http://a.org", "http://b.org"])
+        token = res["next"]
+
+        a.title = "a"
+        a.save()
+        b_id = b.id
+        b.delete()
+        data = [{"url": "http://{}.org".format(i)} for i in range(5)]
+        self.client.post("/api/bookmarks/bulk/", data=json.dumps(data), content_type="application/json",
+                         HTTP_AUTHORIZATION=auth)
+
+        # page through the changes three at a time
+        changed, deleted = [], []
+        while True:
+            res = changes(token, limit=3)
+            changed.extend(i["url"] for i in res["changed"])
+            deleted.extend(res["deleted"])
+            token = res["next"]
+            if not res["more"]:
+                break
+        self.assertEqual(changed, ["http://a.org"] + ["http://{}.org".format(i) for i in range(5)])
+        self.assertEqual(deleted, [b_id])
+        self.assertEqual(changes(token)["changed"], [])
+
+        res = self.client.get("/api/bookmarks/changes/?since=x", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.status_code, 400)
+
+    def test_changes_of_bookmarks_from_before_sync(self):
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+        other = User.objects.create(username="other")
+        for url in ("http://a.org", "http://b.org", "http://c.org"):
+            Bookmark.objects.create(url=url, user=self.user)
+        Bookmark.objects.create(url="http://d.org", user=other)
+        # as after an upgrade, the column default
+        Bookmark.objects.update(seq=0)
+        # a sync does not write, not even to number them
+        res = self.client.get("/api/bookmarks/changes/", {"since": 0}, HTTP_AUTHORIZATION=auth).json()
+        self.assertEqual(res["changed"], [])
+        self.assertEqual(Bookmark.objects.filter(seq=0).count(), 4)
+
+        # the post_migrate backfill, or the command, numbers them
+        call_command("backfill_seq", stdout=StringIO())
+        self.assertFalse(Bookmark.objects.filter(seq=0).exists())
+        self.assertEqual(Bookmark.objects.get(user=other).seq, 2)
+        res = self.client.get("/api/bookmarks/changes/", {"since": 0, "limit": 2}, HTTP_AUTHORIZATION=auth).json()
+        urls = [i["url"] for i in res["changed"]]
+        self.assertTrue(res["more"])
+        res = self.client.get("/api/bookmarks/changes/", {"since": res["next"]}, HTTP_AUTHORIZATION=auth).json()
+        urls += [i["url"] for i in res["changed"]]
+        self.assertEqual(urls, ["http://a.org", "http://b.org", "http://c.org"])
+        self.assertFalse(res["more"])
+
+    def test_token_cache(self):
+        token = Token.objects.get(user=self.user)
+        auth = "token {}".format(token.key)
+        for _ in range(3):
+            res = self.client.get("/api/bookmarks/", HTTP_AUTHORIZATION=auth)
+            self.assertEqual(res.status_code, 200)
+        self.assertEqual((token_cache.stats()["hits"], token_cache.stats()["misses"]), (2, 1))
+
+        # rotating the token drops the old one right away
+        basic = "Basic {}".format(base64.b64encode("{}:{}".format(self.username, self.password).encode()).decode())
+        res = self.client.post("/api/users/{}/token/".format(self.user.id), HTTP_AUTHORIZATION=basic)
+        self.assertEqual(self.client.get("/api/bookmarks/", HTTP_AUTHORIZATION=auth).status_code, 403)
+        auth = "token {}".format(res.json()["token"])
+        self.assertEqual(self.client.get("/api/bookmarks/", HTTP_AUTHORIZATION=auth).status_code, 200)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get("/api/bookmarks/", HTTP_AUTHORIZATION=auth).status_code, 403)
+
+        self.assertEqual(self.client.get("/api/tokens/cache/", HTTP_AUTHORIZATION=auth).status_code, 403)
+
+        # another worker process revokes a token: this one has it cached and
+        # only learns of it through the tokens counter, once the check is due
+        self.user.is_active = True
+        self.user.save()
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+        self.assertEqual(self.client.get("/api/bookmarks/", HTTP_AUTHORIZATION=auth).status_code, 200)
+        Token.objects.filter(user=self.user)._raw_delete("default")
+        ChangeCounter.bump(ChangeCounter.TOKENS)
+        self.assertEqual(self.client.get("/api/bookmarks/", HTTP_AUTHORIZATION=auth).status_code, 200)
+        token_cache._next_check = 0
+        self.assertEqual(self.client.get("/api/bookmarks/", HTTP_AUTHORIZATION=auth).status_code, 403)
+        User.objects.create_superuser("admin", "admin@booklets.org", "adminpassword")
+        admin = "Basic {}".format(base64.b64encode(b"admin:adminpassword").decode())
+        res = self.client.get("/api/tokens/cache/", HTTP_AUTHORIZATION=admin)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["maxsize"], 10000)
+
+    def test_metrics(self):
+        metrics.reset()
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+        self.client.post("/api/bookmarks/", data={"url": "http://a.org", "tags": ["a"]}, HTTP_AUTHORIZATION=auth)
+        for _ in range(2):
+            res = self.client.get("/api/bookmarks/", HTTP_AUTHORIZATION=auth)
+        self.assertRegex(res["Server-Timing"], r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="1 queries"$')
+
+        self.assertEqual(self.client.get("/api/metrics", HTTP_AUTHORIZATION=auth).status_code, 403)
+        User.objects.create_superuser("admin", "admin@booklets.org", "adminpassword")
+        admin = "Basic {}".format(base64.b64encode(b"admin:adminpassword").decode())
+        res = self.client.get("/api/metrics", HTTP_AUTHORIZATION=admin)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res["Content-Type"].startswith("text/plain; version=0.0.4"))
+        lines = res.content.decode().splitlines()
+        worker = 'worker="{}"'.format(os.getpid())
+        self.assertIn('booklets_requests_total{view="bookmark_list",method="GET",status="200",%s} 2' % worker,
+                      lines)
+        self.assertIn('booklets_requests_total{view="bookmark_list",method="POST",status="201",%s} 1' % worker,
+                      lines)
+        self.assertIn('booklets_request_duration_seconds_count{view="bookmark_list",method="GET",%s} 2' % worker,
+                      lines)
+        self.assertIn('booklets_request_queries_bucket{view="bookmark_list",method="GET",le="+Inf",%s} 2' % worker,
+                      lines)
+        # the second list came from the response cache: only the change counter
+        self.assertIn('booklets_request_queries_bucket{view="bookmark_list",method="GET",le="1",%s} 1' % worker,
+                      lines)
+        self.assertIn("# TYPE booklets_response_bytes histogram", lines)
+        self.assertIn("booklets_token_cache_hits_total{%s} 3" % worker, lines)
+
+    def test_slow_query_log(self):
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+        self.client.post("/api/bookmarks/", data={"url": "http://a.org", "tags": ["a"]}, HTTP_AUTHORIZATION=auth)
+        path = os.path.join(tempfile.mkdtemp(), "slow.log")
+        slowqueries._explained.clear()
+        # every query is slow with a 0 ms threshold
+        with override_settings(SLOW_QUERY_MS=0, SLOW_QUERY_LOG=path):
+            for page_size in (5, 6):
+                self.client.get("/api/bookmarks/?tag=a&page_size={}".format(page_size), HTTP_AUTHORIZATION=auth)
+
+        entries = list(slowqueries.read_log(path))
+        pages = [e for e in entries if "json_group_array" in e["sql"]]
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(pages[0]["fingerprint"], pages[1]["fingerprint"])
+        self.assertEqual(pages[0]["view"], "bookmark_list")
+        self.assertEqual(pages[0]["path"], "/api/bookmarks/")
+        self.assertTrue(pages[0]["site"].startswith("api/views.py:"), pages[0]["site"])
+        # the plan is taken the first time a query shape is seen
+        self.assertTrue(any("api_bookmark" in line for line in pages[0]["plan"]))
+        self.assertNotIn("plan", pages[1])
+        self.assertNotIn("a.org", json.dumps(entries))
+
+        out = StringIO()
+        call_command("slowqueries", file=path, order="count", stdout=out)
+        report = out.getvalue()
+        self.assertIn("{}  2 times".format(pages[0]["fingerprint"]), report)
+        self.assertIn("views: bookmark_list (2)", report)
+
+    def test_my_tag_counts(self):
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+        other = User.objects.create(username="other")
+        Tag.objects.create(name="linux")
+        Bookmark.objects.create(url="http://other.org", user=other).tags.add("linux")
+
+        def post(url, tags):
+            res = self.client.post("/api/bookmarks/", data={"url": url, "tags": tags}, HTTP_AUTHORIZATION=auth)
+            return res.json()["id"]
+
+        def mine():
+            res = self.client.get("/api/tags/?mine=1", HTTP_AUTHORIZATION=auth)
+            self.assertEqual(res.status_code, 200)
+            return [(i["name"], i["count"]) for i in res.json()["results"]]
+
+        a = post("http://a.org", ["linux", "python"])
+        post("http://b.org", ["python"])
+        self.assertEqual(mine(), [("python", 2), ("linux", 1)])
+
+        data = json.dumps({"url": "http://a.org", "tags": ["go", "python"]})
+        self.client.put("/api/bookmarks/{}/".format(a), data=data, content_type="application/json", HTTP_AUTHORIZATION=auth)
+        data = json.dumps([{"url": "http://b.org", "tags": ["go"]}, {"url": "http://c.org", "tags": ["go"]}])
+        self.client.post("/api/bookmarks/bulk/", data=data, content_type="application/json", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(mine(), [("go", 3), ("python", 1)])
+
+        self.client.delete("/api/bookmarks/{}/".format(a), HTTP_AUTHORIZATION=auth)
+        self.assertEqual(mine(), [("go", 2)])
+
+        # the maintained counts agree with a recount
+        call_command("rebuild_tag_counts", stdout=StringIO())
+        self.assertEqual(mine(), [("go", 2)])
+        self.assertEqual(UserTag.objects.get(user=other).count, 1)
+
+    def test_tag_counts_of_related_manager_changes(self):
+        Tag.objects.bulk_create([Tag(name=name) for name in ("a", "b", "c")])
+        first = Bookmark.objects.create(url="http://a.org", user=self.user)
+        second = Bookmark.objects.create(url="http://b.org", user=self.user)
+
+        def counts():
+            return dict(UserTag.objects.filter(user=self.user).values_list("tag_id", "count"))
+
+        first.tags.add("a", "b")
+        first.tags.add("a")
+        second.tags.set(["a"])
+        self.assertEqual(counts(), {"a": 2, "b": 1})
+        first.tags.remove("b", "c")
+        Tag.objects.get(name="c").bookmark_set.add(first, second)
+        self.assertEqual(counts(), {"a": 2, "c": 2})
+        Tag.objects.get(name="a").bookmark_set.clear()
+        second.tags.clear()
+        self.assertEqual(counts(), {"c": 1})
+
+        # the admin form sets the tags through the related manager too
+        admin = User.objects.create_superuser("admin", "admin@booklets.org", "adminpassword")
+        self.client.force_login(admin)
+        res = self.client.post("/admin/api/bookmark/{}/change/".format(first.id),
+                               {"url": first.url, "title": "", "comment": "", "tags": ["a", "b"],
+                                "user": self.user.id})
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(counts(), {"a": 1, "b": 1})
+
+        call_command("rebuild_tag_counts", stdout=StringIO())
+        self.assertEqual(counts(), {"a": 1, "b": 1})
+
+    def test_tag_complete(self):
+        auth = "token {}".format(Token.objects.get(user=self.user).key)
+        other = User.objects.create(username="other")
+        names = ["py", "python", "pytest", "pyramid", "perl", "Python3", "py\U0010ffff", "rust"]
+        Tag.objects.bulk_create([Tag(name=name) for name in names + ["pyside"]])
+        counts = {"py": 1, "python": 5, "pytest": 3, "pyramid": 3, "perl": 9, "Python3": 4, "py\U0010ffff": 2,
+                  "rust": 7}
+        UserTag.objects.bulk_create([UserTag(user=self.user, tag_id=name, count=n) for name, n in counts.items()])
+        UserTag.objects.create(user=other, tag_id="pyside", count=10)
+        # the token is cached after the first request
+        self.client.get("/api/tags/complete/", HTTP_AUTHORIZATION=auth)
+
+        def complete(**params):
+            with self.assertNumQueries(1):
+                res = self.client.get("/api/tags/complete/", params, HTTP_AUTHORIZATION=auth)
+            self.assertEqual(res.status_code, 200)
+            return [(i["name"], i["count"]) for i in res.json()["results"]]
+
+        self.assertEqual(complete(prefix="py"),
+                         [("python", 5), ("pyramid", 3), ("pytest", 3), ("py\U0010ffff", 2), ("py", 1)])
+        self.assertEqual(complete(prefix="py", limit=2), [("python", 5), ("pyramid", 3)])
+        self.assertEqual(complete(prefix="pyt"), [("python", 5), ("pytest", 3)])
+        self.assertEqual(complete(prefix="Py"), [("Python3", 4)])
+        self.assertEqual(complete(prefix="py\U0010ffff"), [("py\U0010ffff", 2)])
+        self.assertEqual(complete(prefix="x"), [])
+        self.assertEqual(complete(limit=3), [("perl", 9), ("rust", 7), ("python", 5)])
+
+        res = self.client.get("/api/tags/complete/", {"limit": "many"}, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.client.get("/api/tags/complete/", {"prefix": "py"}).status_code, 403)
+
+
+class ChangeSequenceTest(TransactionTestCase):
+
+    def test_change_sequence_rolls_back_with_the_row(self):
+        # outside any transaction, as a plain save() in autocommit mode
+        user = User.objects.create(username="test")
+        Bookmark.objects.create(url="http://a.org", user=user)
+        name = ChangeCounter.bookmarks(user.pk)
+        version = ChangeCounter.get(name)[0]
+        with self.assertRaises(IntegrityError):
+            Bookmark.objects.create(url="https://a.org/", user=user)
+        self.assertEqual(ChangeCounter.get(name)[0], version)
@@ -0,0 +1,125 @@
+# test bookmark import
+
+import io
+import json
+import os
+import tempfile
+from django.test import TestCase, Client
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from rest_framework.authtoken.models import Token
+from api.bulk import save_bookmarks
+from api.importer import import_bookmarks, parse_html
+from api.models import Bookmark, BookmarkImport, Job
+
+
+NETSCAPE = """<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">
+<TITLE>Bookmarks</TITLE>
+<H1>Bookmarks</H1>
+<DL><p>
+    <DT><H3>Linux</H3>
+    <DL><p>
+        <DT><A HREF="https://www.ubuntu.com" ADD_DATE="1500000000" TAGS="linux,ubuntu">Ubuntu &amp; friends</A>
+        <DD>ubuntu is the best linux distribution
+        <DT><A HREF="https://www.centos.org">Centos</A>
+    </DL><p>
+    <DT><A HREF="https://www.python.org">Python</A>
+</DL><p>
+"""
+
+
+class ImportTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="test")
+
+    def test_parse_html(self):
+        items = list(parse_html(io.StringIO(NETSCAPE)))
+        self.assertEqual([i["url"] for i in items],
+                         ["https://www.ubuntu.com", "https://www.centos.org", "https://www.python.org"])
+        self.assertEqual(items[0]["title"], "Ubuntu & friends")
+        self.assertEqual(items[0]["tags"], ["linux", "ubuntu"])
+        self.assertEqual(items[0]["comment"], "ubuntu is the best linux distribution")
+        self.assertEqual(items[0]["added"], "2017-07-14T02:40:00+00:00")
+        self.assertEqual(items[1]["comment"], "")
+
+    def test_import_in_batches_and_resume(self):
+        Bookmark.objects.create(url="http://3.org", title="keep me", user=self.user)
+        lines = [json.dumps({"url": "http://{}.org".format(i), "title": str(i), "tags": ["t"]}) for i in range(10)]
+        lines.insert(5, "not json")
+        data = ("\n".join(lines) + "\n").encode()
+
+        batches = []
+        import_bookmarks(self.user, io.BytesIO(data), "ndjson", batch_size=4,
+                         progress=lambda job, count, seconds: batches.append(job.committed))
+        self.assertEqual(batches, [4, 8, 11])
+        job = BookmarkImport.objects.get(user=self.user)
+        self.assertEqual((job.committed, job.created, job.skipped, job.failed), (11, 9, 1, 1))
+        self.assertEqual(Bookmark.objects.get(url="http://3.org").title, "keep me")
+
+        # pretend the run was interrupted after the first batch
+        job.committed, job.finished = 4, False
+        job.save()
+        Bookmark.objects.filter(url="http://9.org").delete()
+        batches = []
+        import_bookmarks(self.user, io.BytesIO(data), "ndjson", batch_size=4,
+                         progress=lambda job, count, seconds: batches.append(job.committed))
+        self.assertEqual(batches, [8, 11])
+        self.assertEqual(Bookmark.objects.filter(user=self.user).count(), 10)
+
+    def test_import_command_and_upload(self):
+        fname = self.tmp_file("bookmarks.html", NETSCAPE)
+        out = io.StringIO()
+        call_command("import_bookmarks", "test", fname, stdout=out)
+        self.assertTrue("3 entries, 3 created" in out.getvalue())
+        self.assertEqual(Bookmark.objects.filter(user=self.user).count(), 3)
+
+        auth = "token {}".format(Token.objects.create(user=self.user).key)
+        csv = "url,title,comment,tags\nhttp://a.org,a,,\"x,y\"\nhttps://www.python.org,Python,,\n"
+        upload = io.BytesIO(csv.encode())
+        upload.name = "bookmarks.csv"
+        res = Client().post("/api/bookmarks/import/", {"file": upload}, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["created"], 1)
+        self.assertEqual(res.json()["skipped"], 1)
+        tags = [t.name for t in Bookmark.objects.get(url="http://a.org").tags.all()]
+        self.assertEqual(tags, ["x", "y"])
+
+        # big files are taken a part per request, posting again continues
+        lines = "".join(json.dumps({"url": "http://{}.net".format(n)}) + "\n" for n in range(5))
+        parts = []
+        with self.settings(IMPORT_REQUEST_LIMIT=2):
+            for _ in range(3):
+                upload = io.BytesIO(lines.encode())
+                upload.name = "big.ndjson"
+                res = Client().post("/api/bookmarks/import/", {"file": upload}, HTTP_AUTHORIZATION=auth)
+                parts.append((res.json()["entries"], res.json()["finished"]))
+        self.assertEqual(parts, [(2, False), (4, False), (5, True)])
+        self.assertEqual(Bookmark.objects.filter(url__endswith=".net").count(), 5)
+
+    def tmp_file(self, name, content):
+        path = os.path.join(tempfile.mkdtemp(), name)
+        with open(path, "w") as fh:
+            fh.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_same_url_twice_in_a_batch(self):
+        items = [{"url": "http://a.org", "title": "", "tags": ["x"]},
+                 {"url": "https://a.org/", "title": "", "tags": ["y"]},
+                 {"url": "http://b.org", "title": "b"}]
+        results = save_bookmarks(self.user, items)
+        self.assertEqual([r["status"] for r in results], ["created", "updated", "created"])
+        self.assertEqual(results[0]["id"], results[1]["id"])
+        bookmark = Bookmark.objects.get(id=results[0]["id"])
+        self.assertEqual((bookmark.url, [t.name for t in bookmark.tags.all()]), ("https://a.org/", ["y"]))
+        self.assertEqual(Bookmark.objects.count(), 2)
+        # one enrichment job for the one bookmark without title
+        self.assertEqual(list(Job.objects.values_list("payload", flat=True)),
+                         [json.dumps({"bookmark_id": bookmark.id})])
+
+        items = [{"url": "http://c.org", "title": "first"}, {"url": "http://c.org/", "title": "second"}]
+        results = save_bookmarks(self.user, items, overwrite=False)
+        self.assertEqual([r["status"] for r in results], ["created", "skipped"])
+        self.assertEqual(Bookmark.objects.get(id=results[0]["id"]).title, "first")
@@ -0,0 +1,174 @@
+# test the job queue and bookmark enrichment against a local http server
+
+import json
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from io import StringIO
+from django.test import TestCase, Client, override_settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from api import jobs
+from api.bulk import save_bookmarks
+from api.enrich import page_title
+from api.models import Bookmark, ChangeCounter, Job
+from api.tests.server import start_server, stop_server
+
+PAGES = {
+    "/page": (200, "text/html; charset=utf-8", "<html><head><title> Hello\n  World </title></head></html>"),
+    "/latin": (200, "text/html; charset=iso-8859-1", "<title>caf\xe9</title>"),
+    "/plain": (200, "text/plain", "<title>not html</title>"),
+    "/error": (503, "text/html", "try later"),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.seen.append(self.path)
+        status, content_type, body = PAGES.get(self.path, (404, "text/html", "not found"))
+        body = body.encode(content_type.partition("charset=")[2] or "utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run_worker():
+    out = StringIO()
+    call_command("worker", "--once", stdout=out)
+    return out.getvalue()
+
+
+# the test server is on 127.0.0.1
+@override_settings(FETCH_PRIVATE_ADDRESSES=True)
+class JobTest(TestCase):
+
+    def setUp(self):
+        self.server = start_server(Handler)
+        self.base = self.server.base
+        self.user = User.objects.create(username="test")
+        self.auth = "token {}".format(Token.objects.create(user=self.user).key)
+        self.client = Client()
+
+    def tearDown(self):
+        stop_server(self.server)
+
+    def test_page_title(self):
+        self.assertEqual(page_title("<html><head><title>a &amp; b</title><title>c</title>"), "a & b")
+        self.assertEqual(page_title("<svg><title>icon</title></svg>"), "icon")
+        self.assertEqual(page_title("<title>cut"), "cut")
+        self.assertEqual(page_title("<p>no title</p>"), "")
+
+    def test_create_enqueues_enrichment(self):
+        res = self.client.post("/api/bookmarks/", data={"url": self.base + "/page"}, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual((res.status_code, res.json()["title"]), (201, ""))
+        self.client.post("/api/bookmarks/", data={"url": self.base + "/latin", "title": "given"},
+                         HTTP_AUTHORIZATION=self.auth)
+        self.client.post("/api/bookmarks/", data={"url": "javascript:void(0)"}, HTTP_AUTHORIZATION=self.auth)
+        # nothing was fetched while saving
+        self.assertEqual(self.server.seen, [])
+        job = Job.objects.get()
+        self.assertEqual((job.kind, json.loads(job.payload), job.state),
+                         ("enrich_bookmark", {"bookmark_id": res.json()["id"]}, Job.QUEUED))
+
+        seq = ChangeCounter.get(ChangeCounter.bookmarks(self.user.id))[0]
+        self.assertIn("1 jobs done, 0 failed", run_worker())
+        self.assertEqual(Bookmark.objects.get(id=res.json()["id"]).title, "Hello World")
+        self.assertEqual(ChangeCounter.get(ChangeCounter.bookmarks(self.user.id))[0], seq + 1)
+        self.assertFalse(Job.objects.exists())
+
+    def test_bulk_enqueues_enrichment(self):
+        save_bookmarks(self.user, [{"url": self.base + "/page"}, {"url": self.base + "/latin"},
+                                   {"url": self.base + "/plain"}, {"url": self.base + "/x", "title": "x"}])
+        self.assertEqual(Job.objects.count(), 3)
+        # a title given before the worker came along is kept
+        Bookmark.objects.filter(url=self.base + "/page").update(title="mine")
+        self.assertIn("3 jobs done, 0 failed", run_worker())
+        self.assertEqual(dict(Bookmark.objects.values_list("url", "title")), {
+            self.base + "/page": "mine",
+            self.base + "/latin": "caf\xe9",
+            self.base + "/plain": "",
+            self.base + "/x": "x",
+        })
+        self.assertEqual(sorted(self.server.seen), ["/latin", "/plain"])
+
+    def test_retry_with_backoff(self):
+        bookmark = Bookmark.objects.create(user=self.user, url=self.base + "/error")
+        jobs.enqueue("enrich_bookmark", [{"bookmark_id": bookmark.id}], max_attempts=2)
+        self.assertIn("0 jobs done, 1 failed", run_worker())
+        job = Job.objects.get()
+        self.assertEqual((job.state, job.attempts, job.claim), (Job.QUEUED, 1, ""))
+        self.assertIn("503", job.last_error)
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=jobs.BACKOFF_BASE - 1))
+        # not due yet
+        self.assertIn("0 jobs done, 0 failed", run_worker())
+
+        Job.objects.update(run_after=timezone.now())
+        run_worker()
+        job = Job.objects.get()
+        self.assertEqual((job.state, job.attempts), (Job.FAILED, 2))
+        Job.objects.update(run_after=timezone.now())
+        self.assertEqual(jobs.claim(), [])
+        self.assertEqual(self.server.seen, ["/error", "/error"])
+
+    def test_permanent_errors(self):
+        bookmark = Bookmark.objects.create(user=self.user, url=self.base + "/missing")
+        jobs.enqueue("enrich_bookmark", [{"bookmark_id": bookmark.id}])
+        jobs.enqueue("no_such_kind", [{}])
+        self.assertIn("0 jobs done, 2 failed", run_worker())
+        self.assertEqual(sorted(Job.objects.values_list("state", "attempts")), [(Job.FAILED, 1)] * 2)
+
+    def test_private_addresses(self):
+        bookmark = Bookmark.objects.create(user=self.user, url=self.base + "/page")
+        jobs.enqueue("enrich_bookmark", [{"bookmark_id": bookmark.id}])
+        with self.settings(FETCH_PRIVATE_ADDRESSES=False):
+            self.assertIn("0 jobs done, 1 failed", run_worker())
+        job = Job.objects.get()
+        self.assertEqual((job.state, job.attempts), (Job.FAILED, 1))
+        self.assertIn("a private address", job.last_error)
+        self.assertEqual(self.server.seen, [])
+
+    def test_claim_batch_and_lease(self):
+        jobs.enqueue("noop", [{"n": n} for n in range(25)])
+        jobs.enqueue("noop", [{"n": "later"}], delay=60)
+        with self.assertNumQueries(2):
+            first = jobs.claim(batch=10, lease=30)
+        self.assertEqual([json.loads(j.payload)["n"] for j in first], list(range(10)))
+        second = jobs.claim(batch=100, lease=30)
+        self.assertEqual(len(second), 15)
+        self.assertEqual(jobs.claim(), [])
+
+        # the first worker died, its jobs are taken over when the lease ran out
+        Job.objects.filter(claim=first[0].claim).update(lease_until=timezone.now() - timedelta(seconds=1))
+        third = jobs.claim(batch=100)
+        self.assertEqual(len(third), 10)
+        self.assertEqual(third[0].attempts, 2)
+        # and the late first worker can not touch them any more
+        jobs.finish(first[0])
+        jobs.fail(first[1], ValueError("late"))
+        self.assertEqual(Job.objects.filter(claim=third[0].claim).count(), 10)
+
+        # a stopping worker hands back what it did not run
+        jobs.release(third)
+        self.assertEqual(Job.objects.filter(state=Job.QUEUED, attempts=1, claim="").count(), 10)
+
+    def test_worker_stops_between_jobs(self):
+        ran = []
+        worker = jobs.Worker(batch=5)
+
+        @jobs.handler("stopper")
+        def stopper(n):
+            ran.append(n)
+            worker.stop()
+
+        jobs.enqueue("stopper", [{"n": n} for n in range(5)])
+        worker.run()
+        self.assertEqual(ran, [0])
+        self.assertEqual(Job.objects.filter(state=Job.QUEUED, attempts=0).count(), 4)
+        del jobs.HANDLERS["stopper"]
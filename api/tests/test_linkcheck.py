@@ -0,0 +1,148 @@
+# test the link checker against a local http server
+
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from io import StringIO
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils import timezone
+from api.fetch import public
+from api.linkcheck import LinkChecker, check_links
+from api.models import Bookmark
+from api.tests.server import start_server, stop_server
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+        self.answer()
+
+    def do_GET(self):
+        self.answer()
+
+    def answer(self):
+        self.server.seen.append((self.command, self.path, time.monotonic()))
+        path = self.path.split("?")[0]
+        if path == "/redirect":
+            self.send_response(301)
+            self.send_header("Location", "/ok")
+        elif path == "/nohead" and self.command == "HEAD":
+            self.send_response(405)
+        elif path == "/slow":
+            time.sleep(0.5)
+            self.send_response(200)
+        elif path in ("/ok", "/nohead"):
+            self.send_response(200)
+        else:
+            self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+# the test server is on 127.0.0.1
+@override_settings(FETCH_PRIVATE_ADDRESSES=True)
+class LinkCheckTest(TestCase):
+
+    def setUp(self):
+        self.server = start_server(Handler)
+        self.base = self.server.base
+        self.user = User.objects.create(username="test")
+
+    def tearDown(self):
+        stop_server(self.server)
+
+    def add(self, *paths):
+        for path in paths:
+            Bookmark.objects.create(user=self.user, url=self.base + path)
+
+    def links(self):
+        def path(url):
+            return url[len(self.base):] if url.startswith(self.base) else url
+        return {path(url): (status, path(link_url))
+                for url, status, link_url in Bookmark.objects.values_list("url", "link_status", "link_url")}
+
+    def test_check_links(self):
+        self.add("/ok", "/gone", "/nohead", "/redirect", "/slow")
+        Bookmark.objects.create(user=self.user, url="javascript:void(0)")
+        updated = dict(Bookmark.objects.values_list("id", "updated"))
+
+        checked = check_links(self.user, concurrency=4, per_host=4, delay=0, timeout=0.2)
+        self.assertEqual(checked, 6)
+        links = self.links()
+        self.assertEqual(links["/ok"], (200, "/ok"))
+        self.assertEqual(links["/gone"], (404, "/gone"))
+        self.assertEqual(links["/nohead"], (200, "/nohead"))
+        self.assertEqual(links["/redirect"], (200, "/ok"))
+        self.assertEqual(links["/slow"], (0, ""))
+        self.assertEqual(links["javascript:void(0)"], (0, ""))
+
+        requests = [(method, path) for method, path, _t in self.server.seen]
+        self.assertEqual(requests.count(("HEAD", "/ok")), 2)
+        self.assertNotIn(("GET", "/ok"), requests)
+        self.assertIn(("GET", "/nohead"), requests)
+        self.assertIn(("GET", "/gone"), requests)
+        self.assertNotIn(("GET", "/slow"), requests)
+        # checking is not an edit
+        self.assertEqual(dict(Bookmark.objects.values_list("id", "updated")), updated)
+
+        # only stale links are checked again
+        self.assertEqual(check_links(self.user, delay=0, timeout=0.2), 0)
+        Bookmark.objects.filter(url=self.base + "/gone").update(link_checked=timezone.now() - timedelta(days=8))
+        self.assertEqual(check_links(self.user, delay=0, timeout=0.2), 1)
+        self.assertEqual(check_links(self.user, max_age=None, limit=2, delay=0, timeout=0.2), 2)
+
+        # a new url drops the old result
+        bookmark = Bookmark.objects.get(url=self.base + "/gone")
+        bookmark.url = self.base + "/nohead?moved"
+        bookmark.save()
+        bookmark.refresh_from_db()
+        self.assertEqual((bookmark.link_status, bookmark.link_checked), (None, None))
+        self.assertEqual(check_links(self.user, delay=0, timeout=0.2), 1)
+        # other edits keep it
+        bookmark.refresh_from_db()
+        bookmark.title = "still ok"
+        bookmark.save()
+        bookmark.refresh_from_db()
+        self.assertEqual(bookmark.link_status, 200)
+
+    def test_politeness(self):
+        self.add("/ok", "/gone", "/nohead", "/ok?1", "/ok?2")
+        checker = LinkChecker(concurrency=10, per_host=1, delay=0.05, timeout=1)
+        rows = list(Bookmark.objects.values_list("id", "url"))
+        results = []
+        checker.check_all([rows], results.extend)
+        self.assertEqual(len(results), 5)
+        starts = sorted(t for _method, _path, t in self.server.seen)
+        # HEAD and GET for /gone and /nohead, one HEAD for the others
+        self.assertEqual(len(starts), 7)
+        self.assertGreaterEqual(min(b - a for a, b in zip(starts, starts[1:])), 0.04)
+
+    def test_command(self):
+        self.add("/ok", "/gone")
+        out = StringIO()
+        call_command("check_links", "test", "--delay", "0", "--verbosity", "2", stdout=out)
+        self.assertIn("404 {}/gone".format(self.base), out.getvalue())
+        self.assertIn("2 links checked, 1 broken", out.getvalue())
+
+    def test_private_addresses(self):
+        for address in ("127.0.0.1", "10.1.2.3", "192.168.1.1", "169.254.169.254", "0.0.0.0", "::1",
+                        "fe80::1%eth0", "::ffff:127.0.0.1", "fd00::1", "224.0.0.1"):
+            self.assertFalse(public(address), address)
+        for address in ("93.184.216.34", "2606:2800:220:1:248:1893:25c8:1946"):
+            self.assertTrue(public(address), address)
+
+        self.add("/ok")
+        with self.settings(FETCH_PRIVATE_ADDRESSES=False):
+            check_links(self.user, delay=0, timeout=0.2)
+        bookmark = Bookmark.objects.get()
+        self.assertEqual((bookmark.link_status, bookmark.link_url), (0, ""))
+        self.assertEqual(self.server.seen, [])
+        result = []
+        with self.settings(FETCH_PRIVATE_ADDRESSES=False):
+            LinkChecker(delay=0).check_all([[(1, self.base + "/ok")]], result.extend)
+        self.assertEqual(result[0][2].error, "127.0.0.1 resolves to 127.0.0.1, a private address")
@@ -93,6 +93,20 @@ class BookmarkSerializerTest(TestCase):
         self.assertEqual(len(bks.tags.all()), 3)
         self.assertTrue("Cnetos" in [i.name for i in bks.tags.all()])
 
+    def test_update_bookmark_tags_query_count(self):
+        bks = Bookmark.objects.get(url=self.url)
+        bks.tags.add(*[Tag.objects.create(name="old{}".format(i)) for i in range(20)])
+
+        tags = ["old{}".format(i) for i in range(10)] + ["new{}".format(i) for i in range(10)]
+        data = {"title": self.title, "url": self.url, "comment": self.comment, "tags": tags}
+        b = BookmarkSerializer(bks, data=data)
+        self.assertTrue(b.is_valid())
+        # savepoint, change sequence, update bookmark, current tags, delete
+        # links, insert tags, insert links, tag counter, tag counts and release
+        with self.assertNumQueries(14):
+            b.save()
+        bks = Bookmark.objects.get(url=self.url)
+        self.assertEqual(sorted(i.name for i in bks.tags.all()), sorted(tags))
 
     def test_create_user(self):
         username = "thisisatestuser"
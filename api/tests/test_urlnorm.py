@@ -0,0 +1,129 @@
+# test url normalization and duplicate detection
+
+import json
+from django.db import IntegrityError, transaction
+from django.test import TestCase, Client
+from django.contrib.auth.models import User
+from rest_framework.authtoken.models import Token
+from api.authentication import token_cache
+from api.bulk import save_bookmarks
+from api.models import Bookmark, BookmarkTombstone, Tag, UserTag
+from api.serializers import duplicate_url
+from api.tagcounts import rebuild_tag_counts
+from api.urlnorm import backfill_url_hashes, normalize_url, url_hash
+
+
+class UrlNormTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="test")
+        token = Token.objects.create(user=self.user)
+        self.auth = "token {}".format(token.key)
+        self.client = Client()
+        token_cache.clear()
+
+    def test_normalize_url(self):
+        same = [
+            "http://Example.com",
+            "https://example.com/",
+            "HTTPS://EXAMPLE.COM:443",
+            "http://example.com:80/#top",
+            "https://example.com./?utm_source=feed&utm_medium=rss&fbclid=x",
+        ]
+        self.assertEqual({normalize_url(url) for url in same}, {"https://example.com/"})
+        self.assertEqual(len({url_hash(url) for url in same}), 1)
+
+        self.assertEqual(normalize_url(" http://x.org/a/b/?b=2&a=1&gclid=z#frag "), "https://x.org/a/b?a=1&b=2")
+        self.assertEqual(normalize_url("http://x.org:8080/app#!/inbox"), "https://x.org:8080/app#!/inbox")
+        self.assertEqual(normalize_url("http://user:pw@x.org/"), "https://user:pw@x.org/")
+        self.assertEqual(normalize_url("ftp://X.org/file/"), "ftp://x.org/file")
+        self.assertEqual(normalize_url("mailto:Someone@x.org"), "mailto:Someone@x.org")
+        # path case and non tracking parameters matter
+        self.assertNotEqual(url_hash("http://x.org/A"), url_hash("http://x.org/a"))
+        self.assertNotEqual(url_hash("http://x.org/?id=1"), url_hash("http://x.org/?id=2"))
+        self.assertTrue(-2 ** 63 <= url_hash("http://x.org") < 2 ** 63)
+
+    def test_duplicate_bookmark(self):
+        res = self.client.post("/api/bookmarks/", data={"url": "http://x.org/page/"}, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(res.status_code, 201)
+        res = self.client.post("/api/bookmarks/", data={"url": "https://x.org/page?utm_campaign=a"},
+                               HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json()["url"], ["this url is bookmarked already"])
+
+        other = self.client.post("/api/bookmarks/", data={"url": "http://x.org/other"}, HTTP_AUTHORIZATION=self.auth)
+        data = json.dumps({"url": "https://x.org/page", "tags": []})
+        res = self.client.put("/api/bookmarks/{}/".format(other.json()["id"]), data=data,
+                              content_type="application/json", HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(res.status_code, 400)
+
+        # another user may have the same url
+        User.objects.create(username="other")
+        Bookmark.objects.create(user=User.objects.get(username="other"), url="http://x.org/page/")
+        self.assertEqual(Bookmark.objects.filter(url_hash=url_hash("http://x.org/page")).count(), 2)
+
+    def test_bulk_matches_canonical_urls(self):
+        save_bookmarks(self.user, [{"url": "http://x.org/", "title": "first"}])
+        results = save_bookmarks(self.user, [{"url": "https://x.org?utm_source=a", "title": "second"},
+                                             {"url": "https://y.org", "title": "y"}])
+        self.assertEqual([r["status"] for r in results], ["updated", "created"])
+        self.assertEqual(list(Bookmark.objects.order_by("id").values_list("url", "title")),
+                         [("http://x.org/", "second"), ("https://y.org", "y")])
+
+    def test_lookup(self):
+        res = self.client.post("/api/bookmarks/", data={"url": "http://x.org/page/", "title": "page"},
+                               HTTP_AUTHORIZATION=self.auth)
+        _id = res.json()["id"]
+        with self.assertNumQueries(1):
+            res = self.client.get("/api/bookmarks/lookup/", {"url": "https://X.org/page#section"},
+                                  HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(res.status_code, 200)
+        body = res.json()
+        self.assertEqual((body["url"], body["bookmarked"]), ("https://x.org/page", True))
+        self.assertEqual((body["bookmark"]["id"], body["bookmark"]["url"], body["bookmark"]["title"]),
+                         (_id, "http://x.org/page/", "page"))
+
+        res = self.client.get("/api/bookmarks/lookup/", {"url": "http://x.org/other"}, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual((res.json()["bookmarked"], res.json()["bookmark"]), (False, None))
+        res = self.client.get("/api/bookmarks/lookup/", HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.client.get("/api/bookmarks/lookup/", {"url": "http://x.org"}).status_code, 403)
+
+    def test_backfill(self):
+        # rows from before url_hash, bulk_create sends no pre_save to set it
+        Bookmark.objects.bulk_create([Bookmark(user=self.user, url=url, title=title, comment=comment)
+                                      for url, title, comment in (("http://a.org", "", "first"),
+                                                                  ("https://a.org/", "A", "second"),
+                                                                  ("http://b.org", "", ""),
+                                                                  ("http://c.org", "", ""),
+                                                                  ("http://A.org/?utm_source=x", "", "first"))])
+        through = Bookmark.tags.through
+        ids = dict(Bookmark.objects.values_list("url", "id"))
+        Tag.objects.bulk_create([Tag(name="x"), Tag(name="y")])
+        through.objects.bulk_create([through(bookmark_id=ids["http://a.org"], tag_id="x"),
+                                     through(bookmark_id=ids["https://a.org/"], tag_id="y")])
+        rebuild_tag_counts()
+
+        self.assertEqual(backfill_url_hashes(batch_size=3), (3, 2))
+        hashes = dict(Bookmark.objects.values_list("url", "url_hash"))
+        self.assertEqual(hashes, {"http://a.org": url_hash("https://a.org"), "http://b.org": url_hash("http://b.org"),
+                                  "http://c.org": url_hash("http://c.org")})
+        # the duplicates went into the first bookmark of their url
+        merged = Bookmark.objects.get(url="http://a.org")
+        self.assertEqual((merged.title, merged.comment), ("A", "first\n\nsecond"))
+        self.assertEqual(sorted(merged.tags.values_list("name", flat=True)), ["x", "y"])
+        self.assertEqual(dict(UserTag.objects.filter(user=self.user).values_list("tag_id", "count")), {"x": 1, "y": 1})
+        self.assertEqual(BookmarkTombstone.objects.filter(user=self.user).count(), 2)
+        # and every bookmark can be saved again
+        for bookmark in Bookmark.objects.all():
+            bookmark.save()
+        # nothing left to do
+        self.assertEqual(backfill_url_hashes(), (0, 0))
+
+    def test_other_integrity_errors(self):
+        Bookmark.objects.create(user=self.user, url="http://x.org")
+        with self.assertRaises(IntegrityError) as raised, transaction.atomic():
+            Bookmark.objects.create(user=self.user, url="https://x.org/")
+        self.assertEqual(duplicate_url(raised.exception).detail, {"url": ["this url is bookmarked already"]})
+        # any other constraint is not about the url, it is left to raise
+        self.assertIsNone(duplicate_url(IntegrityError("NOT NULL constraint failed: api_bookmark.user_id")))
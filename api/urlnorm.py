@@ -0,0 +1,144 @@
+"""
+canonical form of bookmark urls, for telling duplicates apart
+
+two urls are the same bookmark when they only differ in
+
+- http vs https
+- case of the scheme and host, a trailing dot on the host, the default port
+- a trailing slash on the path, an empty path and "/"
+- tracking parameters (utm_*, fbclid, gclid ...) and the order of the others
+- the fragment, except "#!" ones which single page apps use for routing
+
+the stored url is left as it was given, only url_hash, a 64 bit hash of the
+canonical form, is used to match. See Bookmark.url_hash.
+"""
+import hashlib
+import logging
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.db import connections, transaction
+
+logger = logging.getLogger("booklets.urlnorm")
+
+TRACKING_PARAMS = {
+    "fbclid", "gclid", "gclsrc", "dclid", "msclkid", "yclid", "igshid", "twclid",
+    "mc_cid", "mc_eid", "_ga", "_gl", "_hsenc", "_hsmi", "mkt_tok", "oly_anon_id", "oly_enc_id",
+}
+TRACKING_PREFIXES = ("utm_",)
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def tracking(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def normalize_url(url):
+    """the canonical form of url, urls that can not be parsed are only stripped"""
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    if not parts.netloc:
+        # mailto:, javascript: and relative junk from imports
+        return urlunsplit((scheme, "", parts.path, parts.query, parts.fragment))
+    if scheme in DEFAULT_PORTS:
+        if port == DEFAULT_PORTS[scheme]:
+            port = None
+        scheme = "https"
+
+    host = (parts.hostname or "").rstrip(".")
+    netloc = host
+    if ":" in host:
+        netloc = "[{}]".format(host)
+    if port is not None:
+        netloc = "{}:{}".format(netloc, port)
+    if parts.username is not None:
+        userinfo = parts.netloc.rpartition("@")[0]
+        netloc = "{}@{}".format(userinfo, netloc)
+
+    path = parts.path.rstrip("/") or "/"
+    query = urlencode(sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                             if not tracking(name)))
+    fragment = parts.fragment if parts.fragment.startswith("!") else ""
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def url_hash(url):
+    """signed 64 bit hash of the canonical url, fits a BigIntegerField"""
+    digest = hashlib.sha256(normalize_url(url).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+def backfill_url_hashes(batch_size=500, using="default"):
+    """
+    set url_hash on bookmarks saved before it existed, batch by batch in id
+    order, each batch in its own transaction. A bookmark whose canonical url
+    the user has bookmarked already is merged into that one, see
+    merge_duplicate: left without a hash it could not be saved again, the
+    next save would hash it into the other one. Returns (hashed, merged).
+    """
+    from .models import Bookmark
+    bookmarks = Bookmark.objects.using(using)
+    hashed = merged = 0
+    last_id = 0
+    while True:
+        with transaction.atomic(using=using):
+            rows = list(bookmarks.filter(url_hash__isnull=True, id__gt=last_id).order_by("id")
+                        .values_list("id", "user_id", "url")[:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            rows = [(pk, user_id, url_hash(url)) for pk, user_id, url in rows]
+            taken = {(user_id, key): pk for pk, user_id, key in
+                     bookmarks.filter(user_id__in={r[1] for r in rows}, url_hash__in={r[2] for r in rows})
+                     .values_list("id", "user_id", "url_hash")}
+            changed = []
+            duplicates = []
+            for pk, user_id, key in rows:
+                if (user_id, key) in taken:
+                    duplicates.append((pk, taken[(user_id, key)]))
+                    continue
+                taken[(user_id, key)] = pk
+                changed.append(Bookmark(id=pk, url_hash=key))
+            bookmarks.bulk_update(changed, ["url_hash"])
+            for pk, into in duplicates:
+                merge_duplicate(pk, into, using=using)
+            hashed += len(changed)
+            merged += len(duplicates)
+    return hashed, merged
+
+
+def merge_duplicate(pk, into, using="default"):
+    """
+    fold bookmark pk into bookmark into, which has the same canonical url:
+    into gets the tags of both, and the title or comment it lacks, then pk
+    is deleted. Both go through the normal save and delete, so tag counts,
+    the change sequence and tombstones follow.
+    """
+    from .models import Bookmark
+    from .serializers import set_tags
+    bookmarks = Bookmark.objects.using(using)
+    duplicate = bookmarks.get(id=pk)
+    bookmark = bookmarks.get(id=into)
+    tags = set(duplicate.tags.values_list("name", flat=True)) | set(bookmark.tags.values_list("name", flat=True))
+    bookmark.title = bookmark.title or duplicate.title
+    if duplicate.comment and duplicate.comment not in bookmark.comment:
+        bookmark.comment = "\n\n".join(c for c in (bookmark.comment, duplicate.comment) if c)
+    bookmark.save(using=using)
+    set_tags(bookmark, tags)
+    duplicate.delete(using=using)
+
+
+def install_url_hashes(sender, using="default", **kwargs):
+    """post_migrate handler, backfills url_hash after the column was added"""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if "api_bookmark" not in connection.introspection.table_names(cursor):
+            return
+    hashed, merged = backfill_url_hashes(using=using)
+    if hashed or merged:
+        logger.info("url hashes set on %s bookmarks, %s duplicates merged", hashed, merged)
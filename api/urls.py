@@ -5,11 +5,19 @@ from . import views
 urlpatterns = [
     path(r'', views.api_root, name='api_root'),
     path(r'tags/', views.TagList.as_view(), name='tag_list'),
+    path(r'tags/complete/', views.TagComplete.as_view(), name='tag_complete'),
     path(r'tags/<str:pk>/', views.TagDetails.as_view(), name='tag_detail'),
     path(r'bookmarks/', views.BookmarkList.as_view(), name='bookmark_list'),
+    path(r'bookmarks/bulk/', views.BookmarkBulk.as_view(), name='bookmark_bulk'),
+    path(r'bookmarks/export/', views.BookmarkExport.as_view(), name='bookmark_export'),
+    path(r'bookmarks/import/', views.BookmarkImportView.as_view(), name='bookmark_import'),
+    path(r'bookmarks/changes/', views.BookmarkChanges.as_view(), name='bookmark_changes'),
+    path(r'bookmarks/lookup/', views.BookmarkLookup.as_view(), name='bookmark_lookup'),
     path(r'bookmarks/<int:pk>/', views.BookmarkDetails.as_view(), name='bookmark_detail'),
     path(r'users/', views.UserList.as_view(), name='user_list'),
     path(r'users/<int:pk>/', views.UserDetails.as_view(), name='user_detail'),
     path(r'users/<int:pk>/token/', views.UserToken.as_view(), name='user_token'),
+    path(r'tokens/cache/', views.TokenCacheStats.as_view(), name='token_cache_stats'),
+    path(r'metrics', views.Metrics.as_view(), name='metrics'),
     path(r"auth/", include('rest_framework.urls'))
 ]
@@ -1,7 +1,10 @@
-from .models import Tag, Bookmark
+import time
+from .models import Tag, Bookmark, BookmarkTombstone, ChangeCounter, UserTag
 from rest_framework import generics
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.http import Http404
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
 from rest_framework import permissions
 from rest_framework import status
 from rest_framework.reverse import reverse
@@ -9,9 +12,23 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.decorators import api_view
 from rest_framework.authtoken.models import Token
+from rest_framework.renderers import BrowsableAPIRenderer
 
-from .serializers import TagSerializer, BookmarkSerializer, UserSerializer, TokenSerializer
+from .serializers import TagSerializer, BookmarkSerializer, UserSerializer, TokenSerializer, UserTagSerializer
 from .permissions import IsOwnerOrReadonly, IsOwner
+from .filters import filter_by_tags
+from .bulk import save_bookmarks
+from .search import search
+from .pagination import KeysetPagination
+from .export import iter_bookmarks, FORMATS
+from .importer import import_bookmarks, guess_format, PARSERS
+from .conditional import ConditionalMixin, ConditionalWriteMixin
+from .authentication import token_cache
+from .metrics import metrics
+from .listing import bookmark_rows, bookmark_data, format_datetime, supported
+from .renderers import FastJSONRenderer
+from .urlnorm import normalize_url, url_hash
+from .tagcounts import complete_tags
 
 @api_view(['GET'])
 def api_root(request, format=None):
@@ -21,16 +38,65 @@ def api_root(request, format=None):
         'bookmarks': reverse('bookmark_list', request=request, format=format)
     })
 
-class TagList(generics.ListCreateAPIView):
+class TagList(ConditionalMixin, generics.ListCreateAPIView):
     """
     List all tags, or create a new tag
+
+    `?mine=1` lists the tags of your bookmarks with their bookmark count
+    instead, most used first
     """
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
+    cache_responses = True
+
+    def mine(self):
+        return self.request.method == "GET" and self.request.query_params.get("mine") not in (None, "", "0")
+
+    def get_queryset(self):
+        if self.mine():
+            return UserTag.objects.filter(user=self.request.user, count__gt=0).order_by("-count", "tag_id")
+        return super(TagList, self).get_queryset()
+
+    def get_serializer_class(self):
+        if self.mine():
+            return UserTagSerializer
+        return TagSerializer
+
+    def get(self, request, *args, **kwargs):
+        if self.mine() and not request.user.is_authenticated:
+            return Response({"error": "login to list your tags"}, status=status.HTTP_403_FORBIDDEN)
+        return super(TagList, self).get(request, *args, **kwargs)
+
+    def get_validators(self, request):
+        if self.mine():
+            # tags of a user only change together with the user's bookmarks
+            return ChangeCounter.get(ChangeCounter.bookmarks(request.user.pk))
+        return ChangeCounter.get("tags")
 
 
-class TagDetails(generics.RetrieveUpdateDestroyAPIView):
+class TagComplete(APIView):
+    """
+    your most used tags starting with `?prefix=`, for completion while
+    typing. `?limit=` tells how many, 10 by default and at most 50.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    max_limit = 50
+
+    def get(self, request, format=None):
+        prefix = request.query_params.get("prefix", "")
+        try:
+            limit = min(int(request.query_params.get("limit", 10)), self.max_limit)
+        except ValueError:
+            return Response({"error": "limit must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        tags = complete_tags(request.user.pk, prefix, max(limit, 1))
+        return Response({
+            "prefix": prefix,
+            "results": [{"name": name, "count": count} for name, count in tags],
+        })
+
+
+class TagDetails(ConditionalWriteMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     Get, update or delete a Tag
     """
@@ -38,33 +104,220 @@ class TagDetails(generics.RetrieveUpdateDestroyAPIView):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
 
+    def get_validators(self, request):
+        return ChangeCounter.get("tags")
+
     def delete(self, request, *args, **kwargs):
         return Response({"error": "delete on tag is not allowed"}, status=status.HTTP_400_BAD_REQUEST)
 
 
-class BookmarkList(generics.ListCreateAPIView):
+class BookmarkList(ConditionalMixin, generics.ListCreateAPIView):
     """
     List all bookmarks, or create a new bookmark
+
+    bookmarks can be filtered by tags with `?tag=a`, `?tags=a,b` (all of),
+    `?any=c,d` (one of) and `?exclude=e` (none of), and searched by title,
+    comment and url with `?q=`, best match first
+
+    listing is paged by page number, pass `?cursor=` to page by cursor
+    instead, see KeysetPagination
     """
 
     def get_queryset(self):
         user = self.request.user
-        return Bookmark.objects.filter(user=user)
+        # a stable order, so pages fetched in parallel do not overlap
+        queryset = Bookmark.objects.filter(user=user).order_by("id").select_related("user").prefetch_related("tags")
+        queryset = filter_by_tags(queryset, self.request.query_params)
+        q = self.request.query_params.get("q", "").strip()
+        if q:
+            queryset = search(queryset, q)
+        return queryset
 
     permission_classes = (permissions.IsAuthenticatedOrReadOnly, IsOwnerOrReadonly)
     serializer_class = BookmarkSerializer
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
+    cache_responses = True
+    # read pages with values() instead of BookmarkSerializer, see api.listing
+    fast_list = True
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        if not (self.fast_list and request.user.is_authenticated and supported(queryset)
+                and not isinstance(self.paginator, KeysetPagination)):
+            return super(BookmarkList, self).list(request, *args, **kwargs)
+        page = self.paginate_queryset(bookmark_rows(queryset))
+        if page is None:
+            return Response(bookmark_data(bookmark_rows(queryset), request.user.username))
+        return self.get_paginated_response(bookmark_data(page, request.user.username))
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
-class BookmarkDetails(generics.RetrieveUpdateDestroyAPIView):
+    def get_validators(self, request):
+        if not request.user.is_authenticated:
+            return None
+        return ChangeCounter.get(ChangeCounter.bookmarks(request.user.pk))
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            if KeysetPagination.cursor_query_param in self.request.query_params:
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+class BookmarkBulk(APIView):
     """
-    Get, update or delete a Tag
+    create or update bookmarks in batch, post a list of bookmarks
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, format=None):
+        if not isinstance(request.data, list):
+            return Response({"error": "expect a list of bookmarks"}, status=status.HTTP_400_BAD_REQUEST)
+        results = save_bookmarks(request.user, request.data)
+        return Response({"results": results})
+
+class BookmarkExport(APIView):
+    """
+    download all bookmarks, `?format=` is one of ndjson (default), csv and html
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def perform_content_negotiation(self, request, force=False):
+        # format picks the export format here, not a renderer
+        return super(BookmarkExport, self).perform_content_negotiation(request, force=True)
+
+    def get(self, request):
+        fmt = request.query_params.get("format", "ndjson")
+        if fmt not in FORMATS:
+            return Response({"error": "format should be one of {}".format(", ".join(sorted(FORMATS)))},
+                            status=status.HTTP_400_BAD_REQUEST)
+        render, content_type = FORMATS[fmt]
+        rows = render(iter_bookmarks(request.user), request.user.username)
+        response = StreamingHttpResponse((line.encode("utf-8") for line in rows),
+                                         content_type="{}; charset=utf-8".format(content_type))
+        response["Content-Disposition"] = 'attachment; filename="bookmarks.{}"'.format(fmt)
+        return response
+
+class BookmarkImportView(APIView):
+    """
+    import bookmarks from an uploaded `file`, netscape bookmark html, ndjson
+    or csv. `format` is guessed from the file name when not given. Posting
+    the same file again continues an interrupted import.
+
+    one request imports at most IMPORT_REQUEST_LIMIT entries, so it does not
+    hold a server thread for long. `finished` is false when entries are
+    left: post the file again for the next part. `manage.py import_bookmarks`
+    takes a whole file at once.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request):
+        upload = request.FILES.get("file")
+        if upload is None:
+            return Response({"error": "no file uploaded"}, status=status.HTTP_400_BAD_REQUEST)
+        fmt = request.data.get("format") or guess_format(upload.name)
+        if fmt not in PARSERS:
+            return Response({"error": "format should be one of {}".format(", ".join(sorted(PARSERS)))},
+                            status=status.HTTP_400_BAD_REQUEST)
+        start = time.perf_counter()
+        counts = []
+        job = import_bookmarks(request.user, upload.file, fmt, limit=settings.IMPORT_REQUEST_LIMIT,
+                               progress=lambda job, count, seconds: counts.append(count))
+        seconds = time.perf_counter() - start
+        return Response({
+            "entries": job.committed,
+            "created": job.created,
+            "skipped": job.skipped,
+            "failed": job.failed,
+            "finished": job.finished,
+            "rate": round(sum(counts) / seconds),
+        })
+
+class BookmarkChanges(APIView):
+    """
+    bookmarks created, updated or deleted since a sync token
+
+    GET with `?since=<token>` (0 or nothing for a full sync) returns the
+    changed bookmarks, the ids of deleted ones and the token for the next
+    call. While `more` is true there are further changes, ask again with
+    the new token.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, format=None):
+        try:
+            since = int(request.query_params.get("since") or 0)
+        except ValueError:
+            return Response({"error": "bad sync token"}, status=status.HTTP_400_BAD_REQUEST)
+        limit = self.get_limit(request)
+        # read the sequence first, anything committed later is returned again next time
+        current, _ = ChangeCounter.get(ChangeCounter.bookmarks(request.user.pk))
+
+        bookmarks = list(Bookmark.objects.filter(user=request.user, seq__gt=since).order_by("seq")
+                         .select_related("user").prefetch_related("tags")[:limit + 1])
+        tombstones = list(BookmarkTombstone.objects.filter(user=request.user, seq__gt=since)
+                          .order_by("seq").values_list("seq", "bookmark_id")[:limit + 1])
+        changes = sorted([(b.seq, b) for b in bookmarks] + tombstones, key=lambda change: change[0])
+        more = len(changes) > limit
+        changes = changes[:limit]
+        token = changes[-1][0] if more else max(current, since)
+
+        changed = [b for _seq, b in changes if isinstance(b, Bookmark)]
+        return Response({
+            "since": since,
+            "next": str(token),
+            "more": more,
+            "changed": BookmarkSerializer(changed, many=True).data,
+            "deleted": [b for _seq, b in changes if not isinstance(b, Bookmark)],
+        })
+
+    def get_limit(self, request):
+        try:
+            return max(1, min(int(request.query_params["limit"]), 1000))
+        except (KeyError, ValueError):
+            return 500
+
+class BookmarkLookup(APIView):
+    """
+    is a url bookmarked already? GET with `?url=`, urls that only differ in
+    scheme, trailing slash, tracking parameters and the like match, see
+    api.urlnorm. `bookmark` is null when it is not bookmarked.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, format=None):
+        url = request.query_params.get("url", "").strip()
+        if not url:
+            return Response({"error": "pass the url to look up as ?url="}, status=status.HTTP_400_BAD_REQUEST)
+        # one probe of the (user, url_hash) unique index
+        bookmark = (Bookmark.objects.filter(user=request.user, url_hash=url_hash(url))
+                    .values("id", "url", "title", "updated").first())
+        if bookmark is not None:
+            bookmark["updated"] = format_datetime(bookmark["updated"], timezone.get_current_timezone())
+        return Response({
+            "url": normalize_url(url),
+            "bookmarked": bookmark is not None,
+            "bookmark": bookmark,
+        })
+
+class BookmarkDetails(ConditionalWriteMixin, generics.RetrieveUpdateDestroyAPIView):
+    """
+    Get, update or delete a bookmark
     """
     permission_classes = (permissions.IsAuthenticatedOrReadOnly, IsOwnerOrReadonly)
-    queryset = Bookmark.objects.all()
+    queryset = Bookmark.objects.select_related("user").prefetch_related("tags")
     serializer_class = BookmarkSerializer
 
+    def get_validators(self, request):
+        # every change to a bookmark, tags included, saves it
+        updated = Bookmark.objects.filter(pk=self.kwargs["pk"]).values_list("updated", flat=True).first()
+        if updated is None:
+            return None
+        return updated.isoformat(), updated
+
 class UserList(generics.ListCreateAPIView):
     """
     List all users, or create a new user
@@ -126,3 +379,24 @@ class UserToken(APIView):
             token = Token(user=user)
             token.save()
         return Response({"token": token.key}, status=status.HTTP_201_CREATED)
+
+
+class TokenCacheStats(APIView):
+    """
+    hit and miss counters of the token authentication cache, staff only
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, format=None):
+        return Response(token_cache.stats())
+
+
+class Metrics(APIView):
+    """
+    request, sql and cache metrics of this process in the prometheus text
+    format, staff only
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, format=None):
+        return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
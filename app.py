@@ -1,8 +1,230 @@
+import logging
 import os
+import select
+import signal
+import socket
+import sys
+import time
+
 from waitress import serve
-from booklets.wsgi import application
+from waitress.server import create_server
+
+logger = logging.getLogger("booklets.app")
+
+
+def env_int(name, default):
+    value = os.environ.get(name, None) or default
+    return int(value)
+
+
+port = env_int("BOOKLET_PORT", 8080)
+# number of worker processes, 1 keeps the plain single process server
+workers = env_int("BOOKLET_WORKERS", 1)
+# waitress threads in each worker
+threads = env_int("BOOKLET_THREADS", 4)
+# seconds a stopping worker gets to finish the requests it already accepted
+graceful_timeout = env_int("BOOKLET_GRACEFUL_TIMEOUT", 30)
+# seconds without a heartbeat before a worker is considered hung and killed
+worker_timeout = env_int("BOOKLET_WORKER_TIMEOUT", 30)
+
+
+def listen(port, backlog=1024):
+    """bind the socket in the parent, every forked worker accepts on it"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def run_worker(sock, heartbeat):
+    """serve on the shared socket until SIGTERM, then drain and exit"""
+    # imported after the fork, so a graceful restart picks up new code and
+    # no database connection is shared between processes
+    from booklets.wsgi import application
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    channels = {}
+    server = create_server(application, map=channels, sockets=[sock],
+                           threads=threads)
+    listeners = list(channels.values())
+    beat = 0
+    while not stopping:
+        server.asyncore.loop(timeout=1, map=channels, count=1)
+        now = time.monotonic()
+        if now - beat >= 1:
+            os.write(heartbeat, b".")
+            beat = now
+
+    # stop accepting, the other workers keep the socket open
+    for listener in listeners:
+        listener.close()
+    deadline = time.monotonic() + graceful_timeout
+    while time.monotonic() < deadline:
+        busy = False
+        for channel in list(channels.values()):
+            if channel.requests or channel.request or channel.total_outbufs_len:
+                busy = True
+            else:
+                channel.close()
+        if not busy:
+            break
+        server.asyncore.loop(timeout=0.1, map=channels, count=1)
+    server.task_dispatcher.shutdown()
+    server.asyncore.close_all(channels)
+
+
+class Worker(object):
+    def __init__(self, pid, heartbeat):
+        self.pid = pid
+        self.heartbeat = heartbeat
+        self.started = self.last_beat = time.monotonic()
+        self.retiring = None
+
+
+class Arbiter(object):
+    """pre-fork workers on one listening socket and keep them alive
+
+    SIGHUP starts a new set of workers and gracefully stops the old ones,
+    SIGTERM and SIGINT stop everything, SIGTTIN and SIGTTOU add or remove a
+    worker. A worker that dies or stops sending heartbeats is replaced.
+    """
+
+    def __init__(self, sock, count):
+        self.sock = sock
+        self.count = count
+        self.workers = {}
+        self.signals = []
+
+    def spawn(self):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            for worker in self.workers.values():
+                os.close(worker.heartbeat)
+            code = 0
+            try:
+                run_worker(self.sock, write)
+            except Exception:
+                logger.exception("worker %s failed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write)
+        os.set_blocking(read, False)
+        self.workers[pid] = Worker(pid, read)
+        logger.info("started worker %s", pid)
+
+    def active(self):
+        return [w for w in self.workers.values() if w.retiring is None]
+
+    def retire(self, worker, sig=signal.SIGTERM):
+        if worker.retiring is None:
+            worker.retiring = time.monotonic()
+        try:
+            os.kill(worker.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.heartbeat)
+            if worker.retiring is None:
+                logger.warning("worker %s exited with status %s", pid, status)
+                if time.monotonic() - worker.started < 1:
+                    # do not spin when workers crash on start
+                    time.sleep(1)
+
+    def check(self):
+        now = time.monotonic()
+        for worker in list(self.workers.values()):
+            if worker.retiring is None:
+                if now - worker.last_beat > worker_timeout:
+                    logger.warning("worker %s is not responding, killing", worker.pid)
+                    self.retire(worker, signal.SIGKILL)
+            elif now - worker.retiring > graceful_timeout + 5:
+                self.retire(worker, signal.SIGKILL)
+
+    def wait(self, timeout=1):
+        fds = {w.heartbeat: w for w in self.workers.values()}
+        try:
+            ready, _, _ = select.select(list(fds), [], [], timeout)
+        except InterruptedError:
+            return
+        for fd in ready:
+            try:
+                if os.read(fd, 4096):
+                    fds[fd].last_beat = time.monotonic()
+            except BlockingIOError:
+                pass
+
+    def handle_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                       signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(signum, self.handle_signal)
+        logger.info("serving on port %s with %s workers of %s threads",
+                    port, self.count, threads)
+        stopping = False
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    stopping = True
+                elif signum == signal.SIGHUP:
+                    logger.info("graceful restart")
+                    old = self.active()
+                    for _ in range(self.count):
+                        self.spawn()
+                    for worker in old:
+                        self.retire(worker)
+                elif signum == signal.SIGTTIN:
+                    self.count += 1
+                elif signum == signal.SIGTTOU and self.count > 1:
+                    self.count -= 1
+            if stopping:
+                break
+            self.reap()
+            self.check()
+            active = self.active()
+            for worker in active[self.count:]:
+                self.retire(worker)
+            for _ in range(self.count - len(active)):
+                self.spawn()
+            self.wait()
+
+        for worker in list(self.workers.values()):
+            self.retire(worker)
+        deadline = time.monotonic() + graceful_timeout + 5
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for worker in list(self.workers.values()):
+            self.retire(worker, signal.SIGKILL)
+            os.waitpid(worker.pid, 0)
+
 
-port = os.environ.get("BOOKLET_PORT", None) or 8080
-port = int(port)
 if __name__ == '__main__':
-    serve(application, port=port)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    if workers > 1:
+        Arbiter(listen(port), workers).run()
+    else:
+        from booklets.wsgi import application
+        serve(application, port=port, threads=threads)
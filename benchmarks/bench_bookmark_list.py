@@ -0,0 +1,45 @@
+"""
+compare BookmarkSerializer with the values() read path of api.listing on
+GET /api/bookmarks/, for a few page sizes. The response cache is off so
+every request renders its page.
+"""
+from utils import test_database, measure, report
+
+from django.contrib.auth.models import User
+from django.test import Client
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+
+from api.bulk import save_bookmarks
+from api.views import BookmarkList
+
+
+def main():
+    with test_database(), override_settings(RESPONSE_CACHE=None):
+        user = User.objects.create(username="bench")
+        token = Token.objects.create(user=user)
+        items = [{"url": "http://{}.org/some/path".format(i), "title": "bookmark number {}".format(i),
+                  "comment": "a comment about bookmark {}".format(i),
+                  "tags": ["tag{}".format((i + j) % 50) for j in range(5)]}
+                 for i in range(5000)]
+        save_bookmarks(user, items)
+
+        client = Client()
+        auth = "token {}".format(token.key)
+        for size in (10, 100, 1000):
+            url = "/api/bookmarks/?page_size={}&page=2".format(size)
+            bodies = []
+            for name, fast in (("serializer", False), ("values", True)):
+                BookmarkList.fast_list = fast
+
+                def run():
+                    bodies.append(client.get(url, HTTP_AUTHORIZATION=auth).content)
+
+                seconds, queries = measure(run, repeat=20)
+                report("{} list, page of {}".format(name, size), seconds, queries)
+            BookmarkList.fast_list = True
+            assert bodies[0] == bodies[-1], "outputs differ"
+
+
+if __name__ == "__main__":
+    main()
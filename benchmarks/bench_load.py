@@ -0,0 +1,330 @@
+"""
+load test the api through the wsgi application on a synthetic dataset
+
+every scenario sends requests to booklets.wsgi.application, the same
+object app.py serves, and reports p50/p90/p99 latency, throughput and sql
+queries per request. The dataset comes from seed.py.
+
+    python benchmarks/bench_load.py --bookmarks 100000 --out before.json
+    python benchmarks/bench_load.py --bookmarks 100000 --out after.json
+    python benchmarks/bench_load.py --compare before.json after.json
+
+seeding a million bookmarks takes a while, keep the database around with
+`--db /tmp/bench.sqlite3`, later runs with the same path reuse it.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+
+from utils import test_database
+
+import django
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+
+from api.authentication import token_cache
+from api.models import Bookmark, UserTag
+from booklets.wsgi import application
+
+import seed as seeder
+
+SAMPLE = 200
+created = itertools.count()
+
+
+class User(object):
+    def __init__(self, user_id, token, count):
+        self.id = user_id
+        self.token = token
+        self.count = count
+        self.bookmarks = []
+        self.tags = []
+
+
+def load_users(rng):
+    users = []
+    keys = dict(Token.objects.values_list("user_id", "key"))
+    counts = dict(Bookmark.objects.values_list("user_id").annotate(n=Count("id")))
+    for user_id, count in sorted(counts.items(), key=lambda item: -item[1]):
+        user = User(user_id, keys[user_id], count)
+        seqs = rng.sample(range(1, count + 1), min(SAMPLE, count))
+        user.bookmarks = list(Bookmark.objects.filter(user_id=user_id, seq__in=seqs).values_list("id", "url"))
+        user.tags = list(UserTag.objects.filter(user_id=user_id).order_by("-count")
+                         .values_list("tag_id", flat=True)[:10])
+        users.append(user)
+    return users
+
+
+# a scenario gives (method, path, json body) for a user
+
+def list_page(rng, user):
+    pages = max(1, user.count // 10)
+    # mostly the first pages, now and then a deep one
+    return "GET", "/api/bookmarks/?page={}".format(min(pages, 1 + int(rng.expovariate(0.3)))), None
+
+
+def list_cursor(rng, user):
+    return "GET", "/api/bookmarks/?cursor=&page_size=50", None
+
+
+def list_tag(rng, user):
+    return "GET", "/api/bookmarks/?tag={}".format(rng.choice(user.tags or ["python"])), None
+
+
+def search(rng, user):
+    return "GET", "/api/bookmarks/?q={}".format(rng.choice(seeder.WORDS)), None
+
+
+def detail(rng, user):
+    return "GET", "/api/bookmarks/{}/".format(rng.choice(user.bookmarks)[0]), None
+
+
+def create(rng, user):
+    return "POST", "/api/bookmarks/", {
+        "url": "https://bench.example.com/{}/{}".format(user.id, next(created)),
+        "title": seeder.sentence(rng, 5),
+        "tags": rng.sample(user.tags or seeder.WORDS, min(3, len(user.tags or seeder.WORDS))),
+    }
+
+
+def update(rng, user):
+    pk, url = rng.choice(user.bookmarks)
+    return "PUT", "/api/bookmarks/{}/".format(pk), {
+        "url": url,
+        "title": seeder.sentence(rng, 5),
+        "tags": rng.sample(user.tags or seeder.WORDS, min(2, len(user.tags or seeder.WORDS))),
+    }
+
+
+def user_tags(rng, user):
+    return "GET", "/api/tags/?mine=1", None
+
+
+def token_auth(rng, user):
+    # cheapest authenticated request, with the token cache emptied first
+    token_cache.clear()
+    return "GET", "/api/", None
+
+
+SCENARIOS = [
+    ("list", list_page),
+    ("list_cursor", list_cursor),
+    ("list_tag", list_tag),
+    ("search", search),
+    ("detail", detail),
+    ("create", create),
+    ("update", update),
+    ("tags", user_tags),
+    ("token_auth", token_auth),
+]
+
+
+def call(method, path, token, body=None):
+    """one request through the wsgi app, return (status code, body size)"""
+    environ = {}
+    setup_testing_defaults(environ)
+    path, _, query = path.partition("?")
+    data = json.dumps(body).encode() if body is not None else b""
+    environ.update({
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "HTTP_AUTHORIZATION": "token {}".format(token),
+        "HTTP_ACCEPT": "application/json",
+        "CONTENT_TYPE": "application/json",
+        "CONTENT_LENGTH": str(len(data)),
+        "wsgi.input": BytesIO(data),
+    })
+    status = []
+
+    def start_response(line, headers, exc_info=None):
+        status.append(int(line.split(" ", 1)[0]))
+
+    result = application(environ, start_response)
+    try:
+        size = sum(len(chunk) for chunk in result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return status[0], size
+
+
+def percentile(values, p):
+    # nearest rank
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+def run_scenario(scenario, users, requests, warmup, threads, seed):
+    weights = [user.count for user in users]
+    samples = []
+    lock = threading.Lock()
+    remaining = [warmup + requests]
+
+    def worker(index):
+        rng = random.Random("{}-{}".format(seed, index))
+        queries = [0]
+
+        def count(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            while True:
+                with lock:
+                    if not remaining[0]:
+                        break
+                    remaining[0] -= 1
+                    n = remaining[0]
+                user = rng.choices(users, weights=weights)[0]
+                method, path, body = scenario(rng, user)
+                queries[0] = 0
+                start = time.perf_counter()
+                status, size = call(method, path, user.token, body)
+                elapsed = time.perf_counter() - start
+                if n < requests:
+                    with lock:
+                        samples.append((elapsed, queries[0], status, size))
+        connection.close()
+
+    start = time.perf_counter()
+    if threads == 1:
+        worker(0)
+    else:
+        pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+    wall = time.perf_counter() - start
+
+    latencies = sorted(sample[0] for sample in samples)
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for sample in samples if sample[2] >= 400),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        # warmup included in the wall time, it is a small share
+        "throughput": round((warmup + requests) / wall, 1),
+        "queries": round(sum(sample[1] for sample in samples) / len(samples), 2),
+        "bytes": round(sum(sample[3] for sample in samples) / len(samples)),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_row(name, result):
+    print("{:<14} {:>9} {:>9} {:>9} {:>10} {:>8} {:>6}".format(
+        name, result["p50_ms"], result["p90_ms"], result["p99_ms"], result["throughput"],
+        result["queries"], result["errors"]))
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print("{} -> {}".format(old["meta"].get("commit"), new["meta"].get("commit")))
+    print("{:<14} {:>18} {:>18} {:>20} {:>12}".format("scenario", "p50 ms", "p99 ms", "req/s", "queries"))
+    for name, after in new["scenarios"].items():
+        before = old["scenarios"].get(name)
+        if before is None:
+            continue
+        cells = []
+        for key in ("p50_ms", "p99_ms", "throughput"):
+            change = (after[key] - before[key]) / before[key] * 100 if before[key] else 0
+            cells.append("{:>9} {:>+7.1f}%".format(after[key], change))
+        print("{:<14} {:>18} {:>18} {:>20} {:>5} -> {:<5}".format(
+            name, cells[0], cells[1], cells[2], before["queries"], after["queries"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--bookmarks", type=int, default=20000)
+    parser.add_argument("--tags", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests before them")
+    parser.add_argument("--threads", type=int, default=1, help="concurrent clients")
+    parser.add_argument("--scenario", action="append", help="run only these, repeatable")
+    parser.add_argument("--db", help="sqlite file to seed once and keep, default a temporary file")
+    parser.add_argument("--response-cache", action="store_true", help="leave the response cache on")
+    parser.add_argument("--out", help="write the results as json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+    cache = {} if args.response_cache else {"RESPONSE_CACHE": None}
+    with test_database(path, keep=bool(args.db)), override_settings(**cache):
+        if not Bookmark.objects.exists():
+            start = time.perf_counter()
+            seeder.seed(args.users, args.bookmarks, args.tags, args.seed)
+            print("seeded {} bookmarks in {:.1f}s".format(args.bookmarks, time.perf_counter() - start))
+        users = load_users(random.Random(args.seed))
+        dataset = {
+            "users": len(users),
+            "bookmarks": Bookmark.objects.count(),
+            "tags": UserTag.objects.values("tag_id").distinct().count(),
+            "seed": args.seed,
+        }
+
+        print("{:<14} {:>9} {:>9} {:>9} {:>10} {:>8} {:>6}".format(
+            "scenario", "p50 ms", "p90 ms", "p99 ms", "req/s", "queries", "errors"))
+        results = {}
+        for name, scenario in SCENARIOS:
+            if args.scenario and name not in args.scenario:
+                continue
+            results[name] = run_scenario(scenario, users, args.requests, args.warmup, args.threads, args.seed)
+            print_row(name, results[name])
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "sqlite_profile": settings.SQLITE_PROFILE,
+            "response_cache": args.response_cache,
+            "threads": args.threads,
+            "requests": args.requests,
+        },
+        "dataset": dataset,
+        "scenarios": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print("results written to {}".format(args.out), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
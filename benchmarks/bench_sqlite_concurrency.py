@@ -0,0 +1,104 @@
+"""
+mixed readers and writers on one sqlite file, default vs production profile
+
+mimics waitress: every thread has its own connection, readers page through
+a user's bookmarks, writers insert and update in short transactions. Run
+with e.g. `python benchmarks/bench_sqlite_concurrency.py --readers 8 --writers 2`
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from utils import report_rate
+
+from django.conf import settings
+
+from api.db import apply_pragmas
+
+SCHEMA = """
+CREATE TABLE bookmark (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, url TEXT, title TEXT, updated REAL);
+CREATE INDEX bookmark_user_updated ON bookmark (user_id, updated, id);
+"""
+USERS = 10
+
+
+def connect(path, profile):
+    # python's sqlite3 waits 5s on a locked database by default, like django
+    db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    apply_pragmas(db.cursor(), settings.SQLITE_PROFILES[profile])
+    return db
+
+
+def seed(path, profile, rows):
+    db = connect(path, profile)
+    db.executescript(SCHEMA)
+    db.execute("BEGIN")
+    db.executemany("INSERT INTO bookmark (user_id, url, title, updated) VALUES (?, ?, ?, ?)",
+                   [(i % USERS, "http://{}.org".format(i), "title {}".format(i), time.time()) for i in range(rows)])
+    db.execute("COMMIT")
+    db.close()
+
+
+def reader(db, stop, counts):
+    while not stop.is_set():
+        try:
+            db.execute("SELECT id, url, title FROM bookmark WHERE user_id = ? ORDER BY updated DESC, id DESC LIMIT 50",
+                       (random.randrange(USERS),)).fetchall()
+            counts["reads"] += 1
+        except sqlite3.OperationalError:
+            counts["errors"] += 1
+
+
+def writer(db, stop, counts):
+    while not stop.is_set():
+        try:
+            # like an atomic block in django: a deferred BEGIN
+            db.execute("BEGIN")
+            db.execute("INSERT INTO bookmark (user_id, url, title, updated) VALUES (?, ?, ?, ?)",
+                       (random.randrange(USERS), "http://new/{}".format(random.random()), "new", time.time()))
+            db.execute("UPDATE bookmark SET title = 'changed', updated = ? WHERE id = ?",
+                       (time.time(), random.randrange(1, 1000)))
+            db.execute("COMMIT")
+            counts["writes"] += 1
+        except sqlite3.OperationalError:
+            counts["errors"] += 1
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+
+
+def run(profile, readers, writers, seconds, rows):
+    path = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+    seed(path, profile, rows)
+    stop = threading.Event()
+    # one counter per thread, summed at the end
+    counts = [{"reads": 0, "writes": 0, "errors": 0} for _ in range(readers + writers)]
+    targets = [reader] * readers + [writer] * writers
+    threads = [threading.Thread(target=target, args=(connect(path, profile), stop, count))
+               for target, count in zip(targets, counts)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    for name in ("reads", "writes", "errors"):
+        report_rate("{} profile, {}".format(profile, name), sum(c[name] for c in counts), seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--rows", type=int, default=50000)
+    args = parser.parse_args()
+    for profile in ("default", "production"):
+        run(profile, args.readers, args.writers, args.seconds, args.rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+GET /api/tags/complete/ for a user with 100k tags, with prefixes matching
+from nearly all of them down to a handful, and the query plan behind it.
+Tag counts follow a zipf like distribution, as real tagging does.
+"""
+import random
+
+from utils import test_database, measure, report
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+
+from api.models import Tag, UserTag
+from api.tagcounts import complete_tags
+
+TAGS = 100000
+SYLLABLES = ["py", "tho", "n", "go", "la", "ng", "ru", "st", "li", "nux", "da", "ta", "we", "b", "co", "de"]
+
+
+def tag_names(count, rng):
+    names = set()
+    while len(names) < count:
+        names.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 5))) + str(rng.randint(0, 99)))
+    return sorted(names)
+
+
+def main():
+    rng = random.Random(25)
+    with test_database():
+        user = User.objects.create(username="bench")
+        token = Token.objects.create(user=user)
+        names = tag_names(TAGS, rng)
+        Tag.objects.bulk_create([Tag(name=name) for name in names], batch_size=400)
+        UserTag.objects.bulk_create([UserTag(user=user, tag_id=name, count=int(1000 / rng.randint(1, 1000)) + 1)
+                                     for name in names], batch_size=400)
+
+        client = Client()
+        auth = "token {}".format(token.key)
+        for prefix in ("", "p", "py", "pyth", "pythonru", "zz"):
+            matches = sum(1 for name in names if name.startswith(prefix))
+
+            def run():
+                res = client.get("/api/tags/complete/", {"prefix": prefix}, HTTP_AUTHORIZATION=auth)
+                assert res.status_code == 200, res.content
+
+            seconds, queries = measure(run, repeat=50)
+            report("complete {!r}, {} matching".format(prefix, matches), seconds, queries)
+
+        for prefix in ("", "py"):
+            print("plan for {!r}: {}".format(prefix, query_plan(user.id, prefix)))
+
+
+def query_plan(user_id, prefix):
+    with CaptureQueriesContext(connection) as queries:
+        complete_tags(user_id, prefix)
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + queries.captured_queries[-1]["sql"])
+        return "; ".join(row[-1] for row in cursor.fetchall())
+
+
+if __name__ == "__main__":
+    main()
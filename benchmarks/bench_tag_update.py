@@ -0,0 +1,52 @@
+"""
+compare the old per-tag update loop with the set based tag diff used by
+BookmarkSerializer.update, on bookmarks with many tags
+"""
+from utils import test_database, measure, report
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from api.models import Bookmark, Tag
+from api.serializers import set_tags
+
+
+def loop_update(bookmark, tag_data):
+    # the implementation BookmarkSerializer.update used before the tag diff
+    for i in bookmark.tags.all():
+        if i.name not in tag_data:
+            bookmark.tags.remove(i)
+    for tag in tag_data:
+        t, _ = Tag.objects.get_or_create(name=tag)
+        bookmark.tags.add(t)
+
+
+def diff_update(bookmark, tag_data):
+    with transaction.atomic():
+        set_tags(bookmark, tag_data)
+
+
+def main():
+    with test_database():
+        user = User.objects.create(username="bench")
+        for n in (20, 100, 500):
+            for name, func in (("loop", loop_update), ("diff", diff_update)):
+                bookmark = Bookmark.objects.create(url="http://{}/{}".format(name, n), user=user)
+                first = ["a{}".format(i) for i in range(n)]
+                # keep half of the tags, replace the other half
+                second = first[:n // 2] + ["b{}".format(i) for i in range(n - n // 2)]
+                Tag.objects.bulk_create([Tag(name=t) for t in first], ignore_conflicts=True)
+                bookmark.tags.add(*first)
+
+                state = {"tags": second}
+
+                def run():
+                    func(bookmark, state["tags"])
+                    state["tags"] = first if state["tags"] is second else second
+
+                seconds, queries = measure(run, repeat=10)
+                report("{} update, {} tags".format(name, n), seconds, queries)
+
+
+if __name__ == "__main__":
+    main()
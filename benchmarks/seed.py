@@ -0,0 +1,134 @@
+"""
+synthetic users, bookmarks and tags for load tests
+
+the shape follows what a bookmark service sees: a few heavy users own most
+bookmarks, tag use is zipf distributed (a handful of tags everywhere, a long
+tail used once or twice), most bookmarks carry 1-4 tags, a few none, and
+most have no comment. Everything comes from one seeded random generator, so
+the same arguments give the same dataset.
+
+rows are written with bulk inserts in big transactions, skipping the model
+signals; the change counters and per-user tag counts are filled in at the
+end the way the signals would have left them.
+"""
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from api.models import Bookmark, ChangeCounter, Tag
+from api.tagcounts import rebuild_tag_counts
+from api.urlnorm import url_hash
+
+WORDS = (
+    "python linux django rust go javascript css html database sqlite postgres "
+    "docker kubernetes security network cooking travel music video reading "
+    "science math history design photo news blog tutorial reference tool "
+    "api cloud performance testing git vim emacs shell book game health "
+    "finance work home garden movie research paper talk course hardware"
+).split()
+DOMAINS = ["example.com", "github.com", "news.ycombinator.com", "wikipedia.org",
+           "stackoverflow.com", "medium.com", "youtube.com", "arxiv.org",
+           "docs.python.org", "developer.mozilla.org"]
+# how many bookmarks carry 0, 1, 2 ... tags
+TAGS_PER_BOOKMARK = (5, 25, 30, 20, 10, 5, 3, 1, 1)
+PASSWORD = "benchmark"
+BATCH = 5000
+
+
+def zipf_weights(n, s):
+    total, weights = 0.0, []
+    for rank in range(n):
+        total += 1.0 / (rank + 1) ** s
+        weights.append(total)
+    return weights
+
+
+def tag_names(count):
+    names = list(WORDS)
+    i = 0
+    while len(names) < count:
+        names.append("{}-{}".format(WORDS[i % len(WORDS)], i // len(WORDS)))
+        i += 1
+    return names[:count]
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def bookmark_counts(users, bookmarks):
+    """split bookmarks over users, heavy users first"""
+    weights = [1.0 / (rank + 1) ** 0.8 for rank in range(users)]
+    total = sum(weights)
+    counts = [max(1, int(bookmarks * w / total)) for w in weights]
+    counts[0] += bookmarks - sum(counts)
+    return counts
+
+
+@contextmanager
+def explicit_times():
+    """let bulk_create keep the generated added and updated times"""
+    fields = [Bookmark._meta.get_field(name) for name in ("added", "updated")]
+    saved = [(f.auto_now, f.auto_now_add) for f in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def seed(users=100, bookmarks=100000, tags=2000, seed=0):
+    """
+    write the dataset, return [(user id, token key, bookmark count)],
+    heaviest user first
+    """
+    rng = random.Random(seed)
+    names = tag_names(tags)
+    tag_weights = zipf_weights(len(names), 1.1)
+    tag_counts = list(range(len(TAGS_PER_BOOKMARK)))
+    start = timezone.now() - timedelta(days=5 * 365)
+    password = make_password(PASSWORD)
+
+    with transaction.atomic():
+        User.objects.bulk_create([User(username="user{}".format(i), password=password,
+                                       email="user{}@example.com".format(i)) for i in range(users)])
+        user_ids = list(User.objects.filter(username__startswith="user").order_by("id").values_list("id", flat=True))
+        Token.objects.bulk_create([Token(key=Token.generate_key(), user_id=uid) for uid in user_ids])
+        Tag.objects.bulk_create([Tag(name=name) for name in names], ignore_conflicts=True)
+
+    through = Bookmark.tags.through
+    counts = bookmark_counts(users, bookmarks)
+    for user_id, count in zip(user_ids, counts):
+        for offset in range(0, count, BATCH):
+            size = min(BATCH, count - offset)
+            rows, links = [], {}
+            for i in range(offset, offset + size):
+                added = start + timedelta(seconds=rng.randrange(5 * 365 * 86400))
+                updated = added if rng.random() < 0.8 else added + timedelta(days=rng.randrange(1, 365))
+                url = "https://{}/{}/{}".format(rng.choice(DOMAINS), sentence(rng, 2).replace(" ", "-"), i)
+                rows.append(Bookmark(user_id=user_id, url=url, title=sentence(rng, rng.randrange(2, 9)),
+                                     comment=sentence(rng, 12) if rng.random() < 0.3 else "",
+                                     added=added, updated=updated, seq=i + 1, url_hash=url_hash(url)))
+                n = rng.choices(tag_counts, weights=TAGS_PER_BOOKMARK)[0]
+                links[url] = set(rng.choices(names, cum_weights=tag_weights, k=n))
+            with transaction.atomic(), explicit_times():
+                Bookmark.objects.bulk_create(rows)
+                ids = dict(Bookmark.objects.filter(user_id=user_id, seq__gt=offset, seq__lte=offset + size)
+                           .values_list("url", "id"))
+                through.objects.bulk_create([through(bookmark_id=ids[url], tag_id=tag)
+                                             for url, chosen in links.items() for tag in chosen])
+    ChangeCounter.objects.bulk_create([ChangeCounter(name=ChangeCounter.bookmarks(uid), version=count)
+                                       for uid, count in zip(user_ids, counts)])
+    ChangeCounter.objects.create(name="tags", version=1)
+    rebuild_tag_counts()
+
+    keys = dict(Token.objects.values_list("user_id", "key"))
+    return [(uid, keys[uid], count) for uid, count in zip(user_ids, counts)]
@@ -0,0 +1,60 @@
+"""
+helpers shared by the benchmark scripts
+
+every benchmark runs against a throwaway test database, never against
+db.sqlite3. Run them from the repo root, e.g. `python benchmarks/bench_tag_update.py`
+"""
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "booklets.settings")
+
+import django
+django.setup()
+
+from django.db import connection
+
+
+@contextmanager
+def test_database(path=None, keep=False):
+    """
+    create a test database for the duration of the block
+
+    in memory unless path is given. With keep the file is left in place and
+    reused by the next run, handy for datasets that take long to seed.
+    """
+    old_name = connection.settings_dict["NAME"]
+    if path:
+        connection.settings_dict["TEST"]["NAME"] = path
+    connection.creation.create_test_db(verbosity=0, serialize=False, keepdb=keep)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keep)
+
+
+def measure(func, repeat=1):
+    """run func repeat times, return (seconds per run, queries per run)"""
+    queries = [0]
+
+    def count(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = time.perf_counter() - start
+    return elapsed / repeat, queries[0] / repeat
+
+
+def report(name, seconds, queries):
+    print("{:<40} {:>10.2f} ms {:>8.1f} queries".format(name, seconds * 1000, queries))
+
+
+def report_rate(name, count, seconds):
+    print("{:<40} {:>10.0f} /s {:>10} total".format(name, count / seconds, count))
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -26,15 +28,25 @@ SECRET_KEY = 'd(4elkzr4q_bo!-a&^t3!l_k-)k^shlu7(e4s@=1uaegfvk#l6'
 DEBUG = False
 
 REST_FRAMEWORK = {
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
     'DEFAULT_AUTHENTICATION_CLASSES': (
                 'rest_framework.authentication.SessionAuthentication',
                 'rest_framework.authentication.BasicAuthentication',
-                'rest_framework.authentication.TokenAuthentication',
+                'api.authentication.CachedTokenAuthentication',
     )
 }
 
+# token -> user lookups cached per process, see api.authentication
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 60
+# seconds a revoked token may still work in other worker processes
+TOKEN_CACHE_CHECK = 1
+
+# entries imported by one POST /api/bookmarks/import/, the client posts the
+# file again for the rest. manage.py import_bookmarks has no limit.
+IMPORT_REQUEST_LIMIT = 5000
+
 ALLOWED_HOSTS = ["*"]
 
 
@@ -53,6 +65,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so its timings cover the whole stack
+    'api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -94,6 +108,75 @@ DATABASES = {
     }
 }
 
+# sqlite tuning, pick a profile with BOOKLET_SQLITE_PROFILE. production is
+# meant for app.py: waitress serves requests from several threads, WAL lets
+# them read while one writes and busy_timeout makes writers queue up
+# instead of failing with "database is locked". Connections are kept open
+# between requests.
+SQLITE_PROFILES = {
+    'default': {},
+    'production': {
+        'journal_mode': 'wal',
+        'busy_timeout': 5000,
+        'synchronous': 'normal',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'temp_store': 'memory',
+    },
+}
+SQLITE_PROFILE = os.environ.get("BOOKLET_SQLITE_PROFILE", None) or 'default'
+if SQLITE_PROFILE not in SQLITE_PROFILES:
+    raise ImproperlyConfigured("BOOKLET_SQLITE_PROFILE is {!r}, it must be one of {}".format(
+        SQLITE_PROFILE, ", ".join(sorted(SQLITE_PROFILES))))
+SQLITE_PRAGMAS = SQLITE_PROFILES[SQLITE_PROFILE]
+if SQLITE_PROFILE == 'production':
+    DATABASES['default']['CONN_MAX_AGE'] = 600
+    DATABASES['default']['OPTIONS'] = {'timeout': 5}
+
+# cache of rendered bookmark and tag lists, pick a backend with
+# BOOKLET_RESPONSE_CACHE. locmem is per process, with several workers use
+# file or db, db keeps the entries in a table of the sqlite database that
+# all workers share. off disables the cache. The file cache lives in
+# BOOKLET_RESPONSE_CACHE_DIR, cache/responses of the checkout by default.
+RESPONSE_CACHES = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': (os.environ.get("BOOKLET_RESPONSE_CACHE_DIR", None)
+                     or os.path.join(BASE_DIR, 'cache', 'responses')),
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+    'db': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'api_response_cache',
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+}
+RESPONSE_CACHE_BACKEND = os.environ.get("BOOKLET_RESPONSE_CACHE", None) or 'locmem'
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+RESPONSE_CACHE = None
+if RESPONSE_CACHE_BACKEND != 'off':
+    CACHES['responses'] = dict(RESPONSE_CACHES[RESPONSE_CACHE_BACKEND], TIMEOUT=600)
+    RESPONSE_CACHE = 'responses'
+
+# queries slower than BOOKLET_SLOW_QUERY_MS are appended to the slow query
+# log at BOOKLET_SLOW_QUERY_LOG, see api.slowqueries and `manage.py
+# slowqueries`. Off unless a path is given.
+SLOW_QUERY_MS = float(os.environ.get("BOOKLET_SLOW_QUERY_MS", None) or 100)
+SLOW_QUERY_LOG = os.environ.get("BOOKLET_SLOW_QUERY_LOG", None) or None
+
+# the link checker and the title fetcher refuse urls that resolve to
+# private, loopback or link-local addresses, see api.fetch. Set
+# BOOKLET_FETCH_PRIVATE_ADDRESSES=1 to let them reach the local network.
+FETCH_PRIVATE_ADDRESSES = os.environ.get("BOOKLET_FETCH_PRIVATE_ADDRESSES", None) == "1"
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -7,8 +7,14 @@ import requests
 import click
 import json
 import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from prompt_toolkit import prompt
+from prompt_toolkit.completion import Completer, Completion, ThreadedCompleter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 template = """# insert bookmark url here
 url: {}
@@ -82,17 +88,120 @@ class Config(object):
 config = Config()
 
 
+class Cache(object):
+    """
+    local sqlite mirror of the user's bookmarks
+
+    kept current with the server's delta sync (/bookmarks/changes/) and with
+    the responses of our own writes, so reads never need the network
+    """
+
+    path = Path.joinpath(Path.home(), ".booklets", "cache.sqlite3")
+    # sync before answering from a cache older than this, in seconds
+    max_age = 300
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS bookmark (id INTEGER PRIMARY KEY, url TEXT, data TEXT);
+    CREATE TABLE IF NOT EXISTS bookmark_tag (bookmark_id INTEGER, tag TEXT, PRIMARY KEY (tag, bookmark_id));
+    CREATE INDEX IF NOT EXISTS bookmark_tag_bookmark ON bookmark_tag (bookmark_id);
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.path))
+            self._db.executescript(self.schema)
+            owner = "{}@{}".format(self.config.username, self.config.server)
+            if self.get_meta("owner") != owner:
+                # a different account or server, start over
+                with self._db:
+                    self._db.execute("DELETE FROM bookmark")
+                    self._db.execute("DELETE FROM bookmark_tag")
+                    self._db.execute("DELETE FROM meta")
+                    self.set_meta("owner", owner)
+        return self._db
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def is_stale(self):
+        return time.time() - float(self.get_meta("synced", 0)) > self.max_age
+
+    def put(self, bookmark):
+        with self.db:
+            self._put(bookmark)
+
+    def _put(self, bookmark):
+        self.db.execute("INSERT OR REPLACE INTO bookmark (id, url, data) VALUES (?, ?, ?)",
+                        (bookmark["id"], bookmark["url"], json.dumps(bookmark)))
+        self.db.execute("DELETE FROM bookmark_tag WHERE bookmark_id = ?", (bookmark["id"],))
+        self.db.executemany("INSERT OR IGNORE INTO bookmark_tag (bookmark_id, tag) VALUES (?, ?)",
+                            [(bookmark["id"], tag) for tag in bookmark["tags"]])
+
+    def remove(self, _id):
+        with self.db:
+            self._remove(_id)
+
+    def _remove(self, _id):
+        self.db.execute("DELETE FROM bookmark WHERE id = ?", (_id,))
+        self.db.execute("DELETE FROM bookmark_tag WHERE bookmark_id = ?", (_id,))
+
+    def apply(self, changes):
+        """apply one page of /bookmarks/changes/ and remember its token"""
+        with self.db:
+            for bookmark in changes["changed"]:
+                self._put(bookmark)
+            for _id in changes["deleted"]:
+                self._remove(_id)
+            self.set_meta("token", changes["next"])
+            if not changes["more"]:
+                self.set_meta("synced", time.time())
+
+    def get(self, _id):
+        row = self.db.execute("SELECT data FROM bookmark WHERE id = ?", (int(_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def by_tag(self, tag):
+        rows = self.db.execute("SELECT b.data FROM bookmark_tag t JOIN bookmark b ON b.id = t.bookmark_id "
+                               "WHERE t.tag = ? ORDER BY b.id", (tag,))
+        return [json.loads(row[0]) for row in rows]
+
+    def tags(self):
+        return self.db.execute("SELECT tag, count(*) FROM bookmark_tag GROUP BY tag ORDER BY tag").fetchall()
+
+
 class BookletsClient(object):
 
+    # pages fetched at the same time, and rows per page
+    workers = 8
+    page_size = 100
+
     def __init__(self, config):
         self.config = config
         self.client = requests.Session()
+        # one pooled connection per worker, idempotent requests are retried with backoff
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, max_retries=retry)
+        self.client.mount("http://", adapter)
+        self.client.mount("https://", adapter)
+        self.cache = Cache(config)
 
     def save(self, data):
         "save data to bookmark server"
         res = self.client.post(self.get_server("/bookmarks/"), data=data,
                                headers={"Authorization": "token {}".format(self.config.token)})
         assert_code(res, 201)
+        self.cache.put(res.json())
         click.echo(res.json())
 
     def update(self, _id, data):
@@ -100,14 +209,36 @@ class BookletsClient(object):
         res = self.client.put(self.get_server("/bookmarks/{}/".format(_id)), data=data,
                               headers={"Authorization": "token {}".format(self.config.token)})
         assert_code(res, 200)
+        self.cache.put(res.json())
         click.echo(res.json())
 
     def delete(self, _id):
         """ delete bookmark"""
-        res = self.client.delete(self.get_server("/bookmarks/{}/").format(_id),
+        res = self.client.delete(self.get_server("/bookmarks/{}/".format(_id)),
                                  headers={"Authorization": "token {}".format(self.config.token)})
         assert_code(res, 204)
-        click.echo(res.json())
+        self.cache.remove(_id)
+
+    def sync(self):
+        """pull the changes since the last sync into the cache"""
+        headers = {"Authorization": "token {}".format(self.config.token)}
+        while True:
+            res = self.client.get(self.get_server("/bookmarks/changes/"), headers=headers,
+                                  params={"since": self.cache.get_meta("token", "0")})
+            assert_code(res, 200)
+            changes = res.json()
+            self.cache.apply(changes)
+            if not changes["more"]:
+                return
+
+    def refresh(self):
+        """sync a stale cache, keep working from the cache when offline"""
+        if not self.cache.is_stale():
+            return
+        try:
+            self.sync()
+        except requests.exceptions.RequestException as e:
+            click.echo("server unreachable, showing cached bookmarks ({})".format(e), err=True)
 
     def create_user(self, username, email, password):
         data = {
@@ -129,22 +260,121 @@ class BookletsClient(object):
             raise Exception("booklets server is not configured")
         return "{}/api{}".format(server, path)
 
-    def get_bookmarks(self, tagorid):
+    def get_bookmarks(self, tagorid, online=False):
+        """bookmarks by id or tag, answered from the local cache unless online"""
+        if online and not tagorid.isdigit():
+            return self.list_bookmarks({"tag": tagorid})
+        self.refresh()
         if tagorid.isdigit():
-            path = "/bookmarks/{}/".format(tagorid)
-        else:
-            path = "/bookmarks/".format(tagorid)
+            bookmark = self.cache.get(tagorid)
+            if bookmark is not None:
+                return [bookmark]
+            # not ours, or created elsewhere after the last sync
+            res = self.client.get(self.get_server("/bookmarks/{}/".format(tagorid)),
+                                  headers={"Authorization": "token {}".format(self.config.token)})
+            assert_code(res, 200)
+            return [res.json()]
+        return self.cache.by_tag(tagorid)
 
-        res = self.client.get(self.get_server(path), headers={"Authorization":
-                                                              "token {}".format(self.config.token)})
+    def complete_tags(self, prefix, limit=10):
+        """names of our most used tags starting with prefix"""
+        res = self.client.get(self.get_server("/tags/complete/"), params={"prefix": prefix, "limit": limit},
+                              headers={"Authorization": "token {}".format(self.config.token)}, timeout=3)
         assert_code(res, 200)
-        if tagorid.isdigit():
-            return [res.json()]
-        else:
-            return [i for i in res.json()["results"] if tagorid in i["tags"]]
+        return [tag["name"] for tag in res.json()["results"]]
+
+    def search(self, query):
+        """full text search in title, comment and url"""
+        return self.list_bookmarks({"q": query})
+
+    def export(self, fmt, fname):
+        """stream all bookmarks into fname"""
+        res = self.client.get(self.get_server("/bookmarks/export/"), params={"format": fmt}, stream=True,
+                              headers={"Authorization": "token {}".format(self.config.token)})
+        assert_code(res, 200)
+        with open(fname, "wb") as fh:
+            for chunk in res.iter_content(chunk_size=64 * 1024):
+                fh.write(chunk)
+
+    def get_page(self, params):
+        res = self.client.get(self.get_server("/bookmarks/"), params=params,
+                              headers={"Authorization": "token {}".format(self.config.token)})
+        assert_code(res, 200)
+        return res.json()
+
+    def list_bookmarks(self, params):
+        """
+        yield all bookmarks of a listing
+
+        the first page tells how many pages there are, the others are then
+        fetched in parallel. Rows are yielded in order as soon as their page
+        and the pages before it are in.
+        """
+        params = dict(params, page_size=self.page_size)
+        first = self.get_page(dict(params, page=1))
+        for row in first["results"]:
+            yield row
+        # the server may cap the page size
+        size = len(first["results"]) or 1
+        pages = (first["count"] + size - 1) // size
+        if pages < 2:
+            return
+        params["page_size"] = size
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self.get_page, dict(params, page=page)) for page in range(2, pages + 1)]
+            for future in futures:
+                for row in future.result()["results"]:
+                    yield row
 
 bk = BookletsClient(config)
 
+
+class TagCompleter(Completer):
+    """
+    complete the tag being typed on a comma separated tag line, most used
+    first. A prefix that matched fewer than limit tags answers every longer
+    prefix too, so typing on needs no more requests. When the server can not
+    answer, the (tag, count) rows of cached are used instead.
+
+    prompt_toolkit calls it on a thread of its own: it must not touch the
+    local cache, its sqlite connection belongs to the main thread.
+    """
+
+    def __init__(self, client, cached=(), limit=10):
+        self.client = client
+        self.limit = limit
+        self.known = {}
+        self.cached = sorted(cached, key=lambda row: -row[1])
+
+    def lookup(self, prefix):
+        for size in range(len(prefix), -1, -1):
+            tags = self.known.get(prefix[:size])
+            if tags is not None and (size == len(prefix) or len(tags) < self.limit):
+                return [tag for tag in tags if tag.startswith(prefix)]
+        try:
+            tags = self.client.complete_tags(prefix, self.limit)
+        except Exception:
+            # offline, or an error answer from assert_code
+            tags = [tag for tag, _count in self.cached if tag.startswith(prefix)][:self.limit]
+        self.known[prefix] = tags
+        return tags
+
+    def get_completions(self, document, complete_event):
+        word = document.text_before_cursor.split(",")[-1].lstrip()
+        entered = {tag.strip() for tag in document.text.split(",")}
+        for tag in self.lookup(word):
+            if tag == word or tag not in entered:
+                yield Completion(tag, start_position=-len(word))
+
+
+def prompt_tags(default=""):
+    """ask for the tags of a bookmark, with completion"""
+    # read here, on the thread that owns the cache connection
+    completer = TagCompleter(bk, cached=bk.cache.tags())
+    text = prompt("Tags (comma separated): ", default=default,
+                  completer=ThreadedCompleter(completer), complete_while_typing=True)
+    return ",".join(tag.strip() for tag in text.split(",") if tag.strip())
+
 @click.group()
 def entry_point():
     config.load()
@@ -153,21 +383,61 @@ def entry_point():
 def refresh_token():
     pass
 
+def print_rows(rows, columns):
+    """print rows as they come in, for listings fetched from the server"""
+    click.echo("{:>6}  {}".format(columns[0], "  ".join(columns[1:])))
+    for i in rows:
+        values = [",".join(i["tags"]) if c == "tags" else str(i[c]) for c in columns]
+        click.echo("{:>6}  {}".format(values[0], "  ".join(values[1:])))
+
 @click.command()
+@click.option("--online", is_flag=True, help="ask the server instead of the local cache")
 @click.argument("tagorid")
-def show(tagorid):
+def show(tagorid, online):
     # list all bookmarks or under a tag
-    data = bk.get_bookmarks(tagorid)
+    data = bk.get_bookmarks(tagorid, online=online)
+    if online:
+        print_rows(data, ["id", "url", "tags"])
+        return
     table = [["id", "url", "tag(s)"]]
     for i in data:
         table.append([i["id"], i["url"], ",".join(i["tags"])])
     print(tabulate.tabulate(table, headers="firstrow"))
 
+@click.command()
+def sync():
+    """update the local bookmark cache from the server"""
+    bk.sync()
+    click.echo("bookmark cache is up to date")
+
+@click.command()
+def tags():
+    """list tags with the number of bookmarks"""
+    bk.refresh()
+    table = [["tag", "bookmarks"]] + bk.cache.tags()
+    print(tabulate.tabulate(table, headers="firstrow"))
+
+@click.command()
+@click.argument("query", nargs=-1, required=True)
+def search(query):
+    """search bookmarks by title, comment and url"""
+    print_rows(bk.search(" ".join(query)), ["id", "url", "title", "tags"])
+
+@click.command()
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "csv", "html"]), default="ndjson",
+              help="html can be imported by browsers")
+@click.argument("fname")
+def export(fmt, fname):
+    """export all bookmarks to a file"""
+    bk.export(fmt, fname)
+    click.echo("bookmarks exported to {}".format(fname))
+
 @click.command()
 def new():
     # create a bookmark
+    tags = prompt_tags()
     temp =  tempfile.NamedTemporaryFile(mode="w+")
-    temp.write(template.format("", "", "", ""))
+    temp.write(template.format("", "", tags, ""))
     temp.flush()
     while True:
         retcode = subprocess.call([editor, temp.name])
@@ -221,9 +491,9 @@ def init():
 def edit(_id):
     """edit a bookmark"""
     bookmark = bk.get_bookmarks(_id)[0]
+    tags = prompt_tags(",".join(bookmark["tags"]))
     temp =  tempfile.NamedTemporaryFile(mode="w+")
-    temp.write(template.format(bookmark["url"], bookmark["title"],
-                               ",".join(bookmark["tags"]),
+    temp.write(template.format(bookmark["url"], bookmark["title"], tags,
                                bookmark["comment"]))
     temp.flush()
     while True:
@@ -253,6 +523,10 @@ entry_point.add_command(new)
 entry_point.add_command(delete)
 entry_point.add_command(init)
 entry_point.add_command(show)
+entry_point.add_command(search)
+entry_point.add_command(sync)
+entry_point.add_command(tags)
+entry_point.add_command(export)
 entry_point.add_command(edit)
 entry_point.add_command(refresh_token)
 